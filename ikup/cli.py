@@ -6,6 +6,7 @@ from datetime import datetime
 from typing import Optional, List
 
 import ikup
+import ikup.daemon
 from ikup.id_manager import IDSpace, IDSubspace
 from ikup.ikup_terminal import ImageInfo, ImageInstance, ValidationError
 from ikup.utils import *
@@ -228,10 +229,22 @@ def status(command: str):
 
 
 def printerr(ikupterm: ikup.IkupTerminal, msg):
-    ikupterm.term.out_display.flush()
+    ikupterm.term.flush()
     print(msg, file=sys.stderr, flush=True)
 
 
+def report_failed_uploads(ikupterm: ikup.IkupTerminal) -> bool:
+    """Waits for the terminal to process the uploads sent with response checking and
+    reports the failed ones. Returns False if there were failures."""
+    failed = ikupterm.wait_for_upload_responses()
+    for upload in failed:
+        printerr(
+            ikupterm,
+            f"error: Terminal failed to upload {upload.inst.path}: {upload.message}",
+        )
+    return not failed
+
+
 def parse_as_id(image: str) -> Optional[int]:
     """Parse the argument as an ID of one of the following forms:
     - A decimal number
@@ -248,6 +261,55 @@ def parse_as_id(image: str) -> Optional[int]:
         return None
 
 
+def display_many(
+    ikupterm: ikup.IkupTerminal,
+    images: List[str],
+    rows: Optional[int],
+    cols: Optional[int],
+    use_line_feeds: bool,
+) -> bool:
+    """Upload and display multiple images in batches. Returns False if there were
+    errors."""
+    success = True
+
+    def on_error(image, e):
+        nonlocal success
+        printerr(ikupterm, f"error: Failed to upload {image}: {e}")
+        success = False
+
+    def flush_batch(batch):
+        if batch:
+            ikupterm.upload_and_display_many(
+                batch,
+                rows=rows,
+                cols=cols,
+                use_line_feeds=use_line_feeds,
+                on_error=on_error,
+            )
+            batch.clear()
+
+    batch = []
+    for image in images:
+        # Handle the case where image is an id, not a filename.
+        if not os.path.exists(image):
+            id = parse_as_id(image)
+            if id is not None:
+                # image is ImageInstance from now on (containing id, rows and cols).
+                image = ikupterm.get_image_instance(id)
+                if image is None:
+                    # Display the preceding images first to keep the order of errors.
+                    flush_batch(batch)
+                    printerr(
+                        ikupterm,
+                        f"error: ID is not assigned or assignment is broken: {id}",
+                    )
+                    success = False
+                    continue
+        batch.append(image)
+    flush_batch(batch)
+    return report_failed_uploads(ikupterm) and success
+
+
 def handle_command(
     command: str,
     images: List[str],
@@ -297,6 +359,17 @@ def handle_command(
             "Cannot use --force-id and specify multiple images at the same time."
         )
 
+    if command == "display" and not no_upload and len(images) > 1:
+        if not display_many(
+            ikupterm,
+            images,
+            rows=rows,
+            cols=cols,
+            use_line_feeds=(use_line_feeds == "true"),
+        ):
+            sys.exit(1)
+        return
+
     for image in images:
         # Handle the case where image is an id, not a filename.
         if not os.path.exists(image):
@@ -352,6 +425,8 @@ def handle_command(
         except (FileNotFoundError, OSError) as e:
             printerr(ikupterm, f"error: Failed to upload {image}: {e}")
             errors = True
+    if not report_failed_uploads(ikupterm):
+        errors = True
     if errors:
         sys.exit(1)
 
@@ -592,46 +667,28 @@ def foreach(
         image_filenames.append(image)
         not_encountered.append(image)
 
-    # The filtered list of image infos.
-    image_infos = []
-
-    # Get all image infos from the ID manager and filter them.
-    # TODO: It's better to build sql queries, of course.
-    index = 0
-    for iminfo in ikupterm.id_manager.get_all():
-        if all:
-            image_infos.append(iminfo)
-            continue
-        matches = False
-        # Check if the ID is in the list.
-        id = iminfo.id
-        if id in image_ids:
-            not_encountered = [x for x in not_encountered if x != id]
-            matches = True
-        # Then check if the filename is in the list.
-        if image_filenames:
-            inst = ImageInstance.from_info(iminfo)
-            if inst and inst.path in image_filenames:
-                not_encountered = [x for x in not_encountered if x != inst.path]
-                matches = True
-        # If the image matched an ID or a filename, add it to the list.
-        if matches:
-            image_infos.append(iminfo)
-            continue
-        # Then check the query.
-        if not query_specified:
-            continue
-        if newer_dt and iminfo.atime <= newer_dt:
-            # Images are sorted by atime, so we can stop here.
-            break
-        if older_dt and iminfo.atime >= older_dt:
-            continue
-        index += 1
-        if last and index > last:
-            break
-        if except_last and index <= except_last:
-            continue
-        image_infos.append(iminfo)
+    # Get the filtered list of image infos from the ID manager.
+    if all:
+        image_infos = list(ikupterm.id_manager.query())
+    elif images:
+        image_infos = list(
+            ikupterm.id_manager.query(ids=image_ids, paths=image_filenames)
+        )
+        for iminfo in image_infos:
+            not_encountered = [x for x in not_encountered if x != iminfo.id]
+            if image_filenames:
+                inst = ImageInstance.from_info(iminfo)
+                if inst:
+                    not_encountered = [x for x in not_encountered if x != inst.path]
+    else:
+        image_infos = list(
+            ikupterm.id_manager.query(
+                older=older_dt,
+                newer=newer_dt,
+                last=last or None,
+                except_last=except_last,
+            )
+        )
 
     # Whether we should exit with an error code.
     errors = False
@@ -648,17 +705,19 @@ def foreach(
     # otherwise there is a risk of buffering issues.
     write = ikupterm.term.write
 
+    # Bulk operations are applied to all the images at once.
+    if command == "forget":
+        ikupterm.id_manager.del_ids(iminfo.id for iminfo in image_infos)
+    if command == "dirty":
+        ikupterm.id_manager.mark_dirty_many(iminfo.id for iminfo in image_infos)
+    if quiet and command in ("forget", "dirty"):
+        image_infos = []
+
     # Now process the images.
     for iminfo in image_infos:
         inst = ImageInstance.from_info(iminfo)
         id = iminfo.id
 
-        if command == "forget":
-            ikupterm.id_manager.del_id(id)
-
-        if command == "dirty":
-            ikupterm.id_manager.mark_dirty(id)
-
         if command == "reupload" or command == "fix":
             if inst is None:
                 printerr(
@@ -752,6 +811,8 @@ def foreach(
                 )
         write("-" * min(max_cols_int, 80) + "\n")
 
+    if not report_failed_uploads(ikupterm):
+        errors = True
     if errors:
         exit(1)
 
@@ -767,6 +828,30 @@ def cleanup(command: str):
     ikupterm.cleanup_current_database()
 
 
+def daemon(command: str, action: str, idle_timeout: float):
+    _ = command
+    if action == "start":
+        socket_path = ikup.daemon.start_in_background(idle_timeout=idle_timeout)
+        print(f"Daemon socket: {socket_path}")
+    elif action == "run":
+        ikup.daemon.serve(
+            ikup.daemon.get_socket_path(),
+            session=os.getsid(0),
+            idle_timeout=idle_timeout,
+        )
+    elif action == "stop":
+        if ikup.daemon.send_control_command("stop") is None:
+            print("The daemon is not running")
+            exit(1)
+    elif action == "status":
+        reply = ikup.daemon.send_control_command("ping")
+        if reply is None:
+            print("The daemon is not running")
+            exit(1)
+        print(f"The daemon is running, pid: {reply.get('pid')}")
+        print(f"Socket: {ikup.daemon.get_socket_path()}")
+
+
 def main_unwrapped():
     parser = argparse.ArgumentParser(
         description="", formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -839,6 +924,11 @@ def main_unwrapped():
         help="Trigger db cleanup.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
+    p_daemon = subparsers.add_parser(
+        "daemon",
+        help="Manage the daemon that runs ikup commands of the current session.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
     p_help = subparsers.add_parser(
         "help",
         help="Show additional help.",
@@ -854,6 +944,21 @@ def main_unwrapped():
         help="The help topic to show. If not specified, show the list of topics.",
     )
 
+    # Arguments unique to daemon
+    p_daemon.add_argument(
+        "action",
+        choices=["start", "run", "stop", "status"],
+        help="Start the daemon in the background, run it in the foreground, stop it, "
+        "or check whether it's running.",
+    )
+    p_daemon.add_argument(
+        "--idle-timeout",
+        metavar="SECONDS",
+        type=float,
+        default=3600.0,
+        help="Exit after this many seconds without requests.",
+    )
+
     # Arguments unique to dump-config
     p_dump_config.add_argument(
         "--no-provenance",
@@ -1182,6 +1287,8 @@ def main_unwrapped():
         foreach(**vardict)
     elif args.command == "cleanup":
         cleanup(**vardict)
+    elif args.command == "daemon":
+        daemon(**vardict)
     elif args.command == "help":
         help(**vardict)
     else:
@@ -1190,6 +1297,14 @@ def main_unwrapped():
 
 
 def main():
+    if ikup.daemon.should_forward(sys.argv):
+        exit_code = ikup.daemon.forward_to_daemon(sys.argv[1:])
+        if exit_code is not None:
+            sys.exit(exit_code)
+    main_in_process()
+
+
+def main_in_process():
     try:
         main_unwrapped()
         sys.stdout.flush()
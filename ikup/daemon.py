@@ -0,0 +1,393 @@
+"""
+A per-session server process that runs ikup commands on behalf of the CLI.
+
+Starting the CLI involves importing ikup and PIL, detecting the terminal, and opening
+the ID database. When the same shell session runs `ikup` many times (e.g. in a loop),
+most of this work is repeated for nothing. The daemon imports everything once and then
+forks a child for each request, so the cost of a command becomes a round-trip over a
+unix socket plus a `fork`.
+
+The client sends its arguments, working directory, environment, and its stdin, stdout,
+stderr and controlling tty (as file descriptors) to the daemon. The forked child
+installs them and runs the command in-process exactly as the CLI would, then reports
+the exit code back to the client.
+
+The socket lives in the state directory and is named after the session id of the
+client, so each shell session gets its own daemon.
+"""
+
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import traceback
+from typing import Dict, List, Optional
+
+import platformdirs
+
+# The header of each message: the length of the json payload.
+_HEADER = struct.Struct("!I")
+# The daemon replies with the pid of the child and then with its exit code.
+_REPLY = struct.Struct("!i")
+# The maximum number of file descriptors passed along with a request.
+_MAX_FDS = 4
+# How long `start_in_background` waits for the daemon to start accepting connections.
+_START_TIMEOUT = 30.0
+
+
+def get_state_dir() -> str:
+    """Returns the directory where the daemon socket is created. We don't read the
+    config file here to keep the client lightweight, but we respect the environment
+    override of `id_database_dir`."""
+    state_dir = os.environ.get("IKUP_ID_DATABASE_DIR")
+    if not state_dir:
+        state_dir = platformdirs.user_state_dir("ikup")
+    return state_dir
+
+
+def get_socket_path(session: Optional[int] = None) -> str:
+    """Returns the path of the daemon socket for the given session id (the session of
+    the current process by default)."""
+    if session is None:
+        session = os.getsid(0)
+    return os.path.join(get_state_dir(), f"daemon-{session}.sock")
+
+
+def should_forward(argv: List[str]) -> bool:
+    """Returns true if the command line should be forwarded to a running daemon."""
+    if os.environ.get("IKUP_NO_DAEMON"):
+        return False
+    # Commands managing the daemon itself always run in-process.
+    return "daemon" not in argv[1:2]
+
+
+def _send_message(sock: socket.socket, message: dict, fds: Optional[List[int]] = None):
+    payload = json.dumps(message).encode("utf-8")
+    data = _HEADER.pack(len(payload)) + payload
+    sent = socket.send_fds(sock, [data], fds or [])
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _recv_message(sock: socket.socket) -> Optional[tuple]:
+    """Receives a message and the file descriptors sent along with it. Returns None if
+    the connection was closed or the message is malformed."""
+    data, fds, _, _ = socket.recv_fds(sock, _HEADER.size, _MAX_FDS)
+    if len(data) < _HEADER.size:
+        rest = _recv_exactly(sock, _HEADER.size - len(data))
+        if rest is None:
+            for fd in fds:
+                os.close(fd)
+            return None
+        data += rest
+    (length,) = _HEADER.unpack(data)
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        for fd in fds:
+            os.close(fd)
+        return None
+    return json.loads(payload.decode("utf-8")), fds
+
+
+def _connect(socket_path: str) -> Optional[socket.socket]:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def forward_to_daemon(argv: List[str]) -> Optional[int]:
+    """Runs the command `argv` (without the program name) in the daemon of the current
+    session. Returns the exit code, or None if there is no reachable daemon, in which
+    case the command has not been run and must be run in-process."""
+    sock = _connect(get_socket_path())
+    if sock is None:
+        return None
+    tty_fd = None
+    try:
+        try:
+            tty_fd = os.open("/dev/tty", os.O_RDWR | os.O_NOCTTY)
+        except OSError:
+            pass
+        fds = [0, 1, 2] + ([tty_fd] if tty_fd is not None else [])
+        request = {
+            "command": "run",
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+            "pid": os.getpid(),
+            "has_tty": tty_fd is not None,
+        }
+        try:
+            sys.stdout.flush()
+            _send_message(sock, request, fds)
+            reply = _recv_exactly(sock, _REPLY.size)
+        except OSError:
+            return None
+        if reply is None:
+            # The daemon didn't start the command, so it's safe to run it ourselves.
+            return None
+        (child_pid,) = _REPLY.unpack(reply)
+        while True:
+            try:
+                reply = _recv_exactly(sock, _REPLY.size)
+                break
+            except KeyboardInterrupt:
+                # Let the child handle the interrupt as if it were us.
+                try:
+                    os.kill(child_pid, signal.SIGINT)
+                except OSError:
+                    pass
+            except OSError:
+                reply = None
+                break
+        if reply is None:
+            print("error: The ikup daemon terminated unexpectedly", file=sys.stderr)
+            return 1
+        return _REPLY.unpack(reply)[0]
+    finally:
+        if tty_fd is not None:
+            os.close(tty_fd)
+        sock.close()
+
+
+def send_control_command(command: str, session: Optional[int] = None) -> Optional[dict]:
+    """Sends a control command ('ping' or 'stop') to the daemon. Returns the reply or
+    None if the daemon is not reachable."""
+    sock = _connect(get_socket_path(session))
+    if sock is None:
+        return None
+    try:
+        _send_message(sock, {"command": command})
+        received = _recv_message(sock)
+        if received is None:
+            return None
+        return received[0]
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+
+def _install_std_streams():
+    """Recreates the python std streams after replacing the fds 0, 1, 2."""
+    sys.stdin = os.fdopen(0, "r", closefd=False)
+    sys.stdout = os.fdopen(1, "w", buffering=1 if os.isatty(1) else -1, closefd=False)
+    sys.stderr = os.fdopen(2, "w", buffering=1, closefd=False)
+
+
+def _run_request(conn: socket.socket, request: Dict, fds: List[int]) -> int:
+    """Runs the CLI command described by `request` in the current (forked) process."""
+    import ikup.cli
+    import ikup.graphics_terminal
+    import ikup.terminal_detection
+
+    for target, fd in enumerate(fds[:3]):
+        os.dup2(fd, target)
+    _install_std_streams()
+    if request.get("has_tty") and len(fds) > 3:
+        tty_fd = fds[3]
+        try:
+            tty_filename = os.ttyname(tty_fd)
+        except OSError:
+            tty_filename = f"/dev/fd/{tty_fd}"
+        ikup.graphics_terminal.DEFAULT_TTY_FILENAME = tty_filename
+
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    ikup.terminal_detection.CLIENT_PID = request["pid"]
+    sys.argv = ["ikup"] + request["argv"]
+
+    try:
+        ikup.cli.main_in_process()
+        exit_code = 0
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except OSError:
+        pass
+    return exit_code
+
+
+def _handle_connection(conn: socket.socket) -> bool:
+    """Handles one connection. Returns False if the daemon must stop."""
+    received = _recv_message(conn)
+    if received is None:
+        return True
+    request, fds = received
+    command = request.get("command")
+    if command == "ping":
+        _send_message(conn, {"pid": os.getpid()})
+        return True
+    if command == "stop":
+        _send_message(conn, {"pid": os.getpid()})
+        return False
+    if command != "run":
+        for fd in fds:
+            os.close(fd)
+        return True
+
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            # Commands may run subprocesses and wait for them (e.g. tmux).
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            conn.sendall(_REPLY.pack(os.getpid()))
+            exit_code = _run_request(conn, request, fds)
+            conn.sendall(_REPLY.pack(exit_code))
+        finally:
+            os._exit(exit_code)
+    for fd in fds:
+        os.close(fd)
+    return True
+
+
+def _preload():
+    """Imports everything a command may need, so that forked children don't have to."""
+    import ikup.cli  # noqa: F401
+    from PIL import Image
+
+    Image.init()
+
+
+def _is_session_alive(session: int) -> bool:
+    try:
+        os.kill(session, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def serve(
+    socket_path: str,
+    *,
+    session: Optional[int] = None,
+    idle_timeout: float = 3600.0,
+    ready_fd: Optional[int] = None,
+):
+    """Runs the daemon loop until it's stopped, the idle timeout expires, or the
+    session leader exits. If `ready_fd` is specified, a byte is written to it and it's
+    closed as soon as the socket accepts connections."""
+    _preload()
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    # Remove a stale socket left by a daemon that didn't exit cleanly.
+    if os.path.exists(socket_path):
+        sock = _connect(socket_path)
+        if sock is not None:
+            sock.close()
+            raise RuntimeError(f"The ikup daemon is already running: {socket_path}")
+        os.unlink(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    if ready_fd is not None:
+        os.write(ready_fd, b"\0")
+        os.close(ready_fd)
+    # Children are reaped automatically.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    try:
+        idle_time = 0.0
+        poll_interval = min(60.0, idle_timeout)
+        while True:
+            ready, _, _ = select.select([server], [], [], poll_interval)
+            if not ready:
+                idle_time += poll_interval
+                if idle_time >= idle_timeout:
+                    return
+                if session is not None and not _is_session_alive(session):
+                    return
+                continue
+            idle_time = 0.0
+            conn, _ = server.accept()
+            try:
+                if not _handle_connection(conn):
+                    return
+            except OSError:
+                pass
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def start_in_background(idle_timeout: float = 3600.0) -> str:
+    """Starts the daemon for the current session in a detached process and waits until
+    it accepts connections. Returns the path of the socket."""
+    session = os.getsid(0)
+    socket_path = get_socket_path(session)
+    if send_control_command("ping", session) is not None:
+        return socket_path
+    # The daemon signals that it's ready through a pipe. If it dies before that, the
+    # pipe is closed without writing anything.
+    ready_read, ready_write = os.pipe()
+    pid = os.fork()
+    if pid != 0:
+        os.close(ready_write)
+        try:
+            # Wait for the intermediate child, the daemon itself is its child.
+            os.waitpid(pid, 0)
+            ready, _, _ = select.select([ready_read], [], [], _START_TIMEOUT)
+            started = bool(ready) and os.read(ready_read, 1) == b"\0"
+        finally:
+            os.close(ready_read)
+        # Another process may have started the daemon at the same time.
+        if not started and send_control_command("ping", session) is None:
+            raise RuntimeError(f"Failed to start the ikup daemon: {socket_path}")
+        return socket_path
+    try:
+        os.close(ready_read)
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        serve(
+            socket_path,
+            session=session,
+            idle_timeout=idle_timeout,
+            ready_fd=ready_write,
+        )
+    finally:
+        os._exit(0)
@@ -1,7 +1,10 @@
 import base64
+import binascii
 import dataclasses
 import io
+import os
 import select
+import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, is_dataclass
 from enum import Enum
@@ -11,6 +14,8 @@ from typing import (
     Callable,
     Dict,
     Iterator,
+    List,
+    Literal,
     Optional,
     Tuple,
     TypeVar,
@@ -18,6 +23,19 @@ from typing import (
 )
 
 
+# The limits of the adaptive number of chunks written with a single `write` when
+# sending a direct transmission. The number is doubled after a write that took less
+# than `_FAST_WRITE_SECONDS` and halved after a write that took more than
+# `_SLOW_WRITE_SECONDS`, so that a fast terminal gets few large writes, while a slow
+# one (e.g. over a slow ssh connection) keeps getting small ones and the progress of
+# the upload is reported regularly.
+_MAX_CHUNKS_PER_WRITE = 64
+_FAST_WRITE_SECONDS = 0.002
+_SLOW_WRITE_SECONDS = 0.02
+
+ChunksPerWrite = Union[int, Literal["adaptive"]]
+
+
 class Quietness(Enum):
     VERBOSE = 0
     QUIET_UNLESS_ERROR = 1
@@ -164,6 +182,7 @@ class GraphicsCommand(ABC):
         template: bytes,
         max_size: Optional[int] = None,
         callback: Optional[Callable[["GraphicsCommand"], None]] = None,
+        chunks_per_write: ChunksPerWrite = 1,
     ) -> None:
         """Sends the command to a stream.
 
@@ -177,6 +196,11 @@ class GraphicsCommand(ABC):
                 `select.PIPE_BUF`.
             callback: A callback that will be called for each command after it's sent.
                 This can be used to track the progress of a split transmission command.
+            chunks_per_write: The number of chunks of a direct transmission to write
+                with a single `write`, or "adaptive" to choose it based on how long
+                the writes take. Note that writes of more than `select.PIPE_BUF` bytes
+                are not atomic, so values other than 1 are unsafe if other processes
+                may write to the same stream concurrently.
         """
         if max_size is None:
             max_size = select.PIPE_BUF
@@ -198,6 +222,11 @@ class GraphicsCommand(ABC):
                 "The maximum payload size is too small. "
                 f"Increase the max_size parameter (now {max_size})"
             )
+        if self.medium == TransmissionMedium.DIRECT:
+            self._send_direct(
+                out, template, max_payload_size, callback, chunks_per_write
+            )
+            return
         for cmd in self.split(max_payload_size=max_payload_size):
             out.write(template % cmd.content_to_bytes())
             out.flush()
@@ -209,6 +238,69 @@ class GraphicsCommand(ABC):
         return None
 
 
+def _read_chunks(data: Union[bytes, BinaryIO], size: int) -> Iterator[memoryview]:
+    """Yields the contents of `data` in chunks of `size` bytes (the last one may be
+    shorter). The first chunk is yielded even if it's empty. When reading from a file,
+    the chunks are views of two alternating buffers, so a chunk stays valid only until
+    the chunk after the next one is requested."""
+    if isinstance(data, bytes):
+        view = memoryview(data)
+        yield view[:size]
+        for start in range(size, len(data), size):
+            yield view[start : start + size]
+        return
+    data.seek(0)
+    if not hasattr(data, "readinto"):
+        chunk = data.read(size)
+        yield memoryview(chunk)
+        while chunk:
+            chunk = data.read(size)
+            if chunk:
+                yield memoryview(chunk)
+        return
+    buffers = [memoryview(bytearray(size)), memoryview(bytearray(size))]
+    first = True
+    while True:
+        buffer = buffers[0]
+        buffers.reverse()
+        # `readinto` may return less than requested before the end of the file.
+        filled = 0
+        while filled < size:
+            n = data.readinto(buffer[filled:])
+            if not n:
+                break
+            filled += n
+        if filled or first:
+            yield buffer[:filled]
+        first = False
+        if filled < size:
+            return
+
+
+def _write_parts(out: BinaryIO, parts: List[bytes]) -> None:
+    """Writes and flushes `parts` to `out`, with a single `writev` if `out` is backed by
+    a file descriptor."""
+    try:
+        fd = out.fileno()
+    except (AttributeError, OSError, ValueError):
+        fd = None
+    if fd is None or not hasattr(os, "writev"):
+        for part in parts:
+            out.write(part)
+        out.flush()
+        return
+    # Don't let the buffered data get ahead of (or behind) the parts.
+    out.flush()
+    views = [memoryview(part) for part in parts]
+    while views:
+        written = os.writev(fd, views)
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if views and written:
+            views[0] = views[0][written:]
+
+
 def normalize_header_value(value: Any) -> bytes | int:
     """Normalizes a header value to a byte string or an integer."""
     if isinstance(value, str):
@@ -364,6 +456,81 @@ class TransmitCommand(GraphicsCommand):
             data = data.read()
         return data
 
+    def _send_direct(
+        self,
+        out: BinaryIO,
+        template: bytes,
+        max_payload_size: int,
+        callback: Optional[Callable[["GraphicsCommand"], None]],
+        chunks_per_write: ChunksPerWrite = 1,
+    ) -> None:
+        """Sends a direct transmission chunk by chunk. Produces exactly the same bytes
+        as formatting each command from `split` with the template, but encodes each
+        chunk straight from a reusable buffer and writes it together with the
+        precomputed header and the template suffix, without concatenating them.
+        Several chunks may be written at once, see `send`."""
+        adaptive = chunks_per_write == "adaptive"
+        batch_size = 1 if adaptive else max(1, int(chunks_per_write))
+        # The parts and the commands (for the callback) of the chunks to be written.
+        parts: List[bytes] = []
+        pending: List[GraphicsCommand] = []
+        template_prefix, template_suffix = template.split(b"%b")
+        first_more = self.more or False
+        # The prefixes (everything up to the base64 payload) of all possible commands,
+        # indexed by the value of `more`.
+        first_prefixes = [
+            template_prefix + self.clone_with(data=b"", more=m).header_to_bytes() + b";"
+            for m in [first_more, True]
+        ]
+        more_prefixes = [
+            template_prefix
+            + MoreDataCommand(
+                image_id=self.image_id, image_number=self.image_number, more=m
+            ).header_to_bytes()
+            + b";"
+            for m in [first_more, True]
+        ]
+        chunks = _read_chunks(self.data, max_payload_size)
+        cur_chunk = next(chunks)
+        first = True
+        while cur_chunk is not None:
+            next_chunk = next(chunks, None)
+            has_more = next_chunk is not None
+            prefix = (first_prefixes if first else more_prefixes)[has_more]
+            payload = binascii.b2a_base64(cur_chunk, newline=False)
+            parts += [prefix, payload, template_suffix]
+            if callback is not None:
+                # The callback may keep the command, so it gets a copy of the chunk.
+                more = first_more or has_more
+                if first:
+                    cmd: GraphicsCommand = self.clone_with(
+                        data=bytes(cur_chunk), more=more
+                    )
+                else:
+                    cmd = MoreDataCommand(
+                        image_id=self.image_id,
+                        image_number=self.image_number,
+                        data=bytes(cur_chunk),
+                        more=more,
+                    )
+                pending.append(cmd)
+            if len(parts) >= 3 * batch_size or not has_more:
+                start = time.perf_counter()
+                _write_parts(out, parts)
+                elapsed = time.perf_counter() - start
+                if adaptive:
+                    if elapsed < _FAST_WRITE_SECONDS:
+                        batch_size = min(batch_size * 2, _MAX_CHUNKS_PER_WRITE)
+                    elif elapsed > _SLOW_WRITE_SECONDS:
+                        batch_size = max(batch_size // 2, 1)
+                parts = []
+                if callback is not None:
+                    for cmd in pending:
+                        callback(cmd)
+                pending = []
+            first = False
+            cur_chunk = next_chunk
+
     def set_filename(self, filename: str) -> "TransmitCommand":
         """Sets the data to be a filename."""
         self.data = filename.encode()
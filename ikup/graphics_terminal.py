@@ -1,15 +1,18 @@
 import base64
+import contextlib
 import copy
 import fcntl
 import io
 import os
 import random
+import re
 import select
+import stat
 import struct
 import termios
 import time
 import sys
-from typing import BinaryIO, List, Optional, TextIO, Tuple, Union, Callable
+from typing import Any, BinaryIO, List, Optional, TextIO, Tuple, Union, Callable
 
 from ikup import (
     GraphicsCommand,
@@ -18,13 +21,30 @@ from ikup import (
     PutCommand,
     TransmitCommand,
 )
-from ikup.graphics_command import TransmissionMedium
+from ikup.graphics_command import ChunksPerWrite, TransmissionMedium
 from ikup.placeholder import (
     AdditionalFormatting,
     ImagePlaceholder,
     ImagePlaceholderMode,
+    lines_to_bytes_abs_position,
+    lines_to_bytes_at_cursor,
+    placeholders_side_by_side_to_lines,
 )
 
+# The tty used when no tty filename is given explicitly. The ikup daemon overrides it
+# with the tty of the client it serves.
+DEFAULT_TTY_FILENAME = "/dev/tty"
+
+# The amount of buffered frame data after which it's written out at the next flush.
+MAX_FRAME_BUFFER_SIZE = 64 * 1024
+
+# The maximum number of bytes read from the response stream with a single read.
+RESPONSE_READ_SIZE = 4096
+
+_GRAPHICS_RESPONSE_START = b"\033_G"
+_GRAPHICS_RESPONSE_END = b"\033\\"
+_CURSOR_POSITION_RESPONSE = re.compile(rb"\033\[(\d+);(\d+)R")
+
 
 class TtySettingsGuard:
     def __init__(self, tty: BinaryIO):
@@ -41,6 +61,183 @@ class TtySettingsGuard:
         )
 
 
+class Frame:
+    """The data written to the output streams of a `GraphicsTerminal` during a frame.
+    The data is kept as a sequence of segments in the order it was written, so the
+    order of writes to different streams (which may be the same terminal) is
+    preserved, and consecutive writes to the same stream are merged."""
+
+    def __init__(self, max_size: int = MAX_FRAME_BUFFER_SIZE):
+        self.max_size = max_size
+        self.segments: List[Tuple[BinaryIO, bytearray]] = []
+        self.size = 0
+
+    def write(self, out: BinaryIO, data: Union[bytes, bytearray]):
+        if self.segments and self.segments[-1][0] is out:
+            self.segments[-1][1].extend(data)
+        else:
+            self.segments.append((out, bytearray(data)))
+        self.size += len(data)
+
+    def write_out(self):
+        """Writes the buffered data, one write per segment."""
+        segments = self.segments
+        self.segments = []
+        self.size = 0
+        for out, data in segments:
+            # The segment is dropped after this, so it doesn't need to be copied.
+            out.write(data)
+            out.flush()
+
+
+class FrameStream:
+    """A write-only stream that appends the data to a `Frame`. Flushes are ignored
+    unless the frame is too large. It deliberately has no `fileno`, so that nobody
+    writes to the underlying file descriptor directly, bypassing the frame."""
+
+    def __init__(self, frame: Frame, out: BinaryIO):
+        self.frame = frame
+        self.out = out
+
+    def write(self, data: Union[bytes, bytearray]) -> int:
+        self.frame.write(self.out, data)
+        return len(data)
+
+    def flush(self):
+        # Flushes happen at command boundaries, so it's safe to write out here.
+        if self.frame.size >= self.frame.max_size:
+            self.frame.write_out()
+
+    def isatty(self) -> bool:
+        return self.out.isatty()
+
+    def fileno(self) -> int:
+        raise io.UnsupportedOperation("fileno")
+
+
+class ResponseReader:
+    """Reads terminal responses in bulk (all the available bytes with a single read)
+    into a persistent buffer. The bytes following a response are kept for the next
+    call, and the buffer is scanned incrementally, so parsing many queued responses
+    takes linear time."""
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.buffer = bytearray()
+        # The number of already consumed bytes at the start of `buffer`.
+        self.start = 0
+
+    def _consume(self, end: int) -> bytes:
+        """Consumes and returns the unconsumed bytes up to the position `end`."""
+        data = bytes(self.buffer[self.start : end])
+        self.start = end
+        if self.start == len(self.buffer):
+            self.buffer.clear()
+            self.start = 0
+        elif self.start >= RESPONSE_READ_SIZE and 2 * self.start >= len(self.buffer):
+            del self.buffer[: self.start]
+            self.start = 0
+        return data
+
+    def _read_until(self, find: Callable[[], Any], timeout: float) -> Any:
+        """Reads data until `find` returns something other than None and returns it.
+        Returns None on timeout or end of file. Polls the stream at least once even if
+        the timeout is zero."""
+        end_time = time.time() + timeout
+        while True:
+            result = find()
+            if result is not None:
+                return result
+            timeout = end_time - time.time()
+            ready, _, _ = select.select([self.stream], [], [], max(timeout, 0))
+            data = os.read(self.stream.fileno(), RESPONSE_READ_SIZE) if ready else b""
+            if not data:
+                return None
+            self.buffer += data
+            if timeout <= 0:
+                return find()
+
+    def read_graphics_response(self, timeout: float) -> Tuple[bytes, Optional[bytes]]:
+        """Reads the next graphics response. Returns the bytes preceding it and its
+        contents without the `ESC _ G` and `ESC \\` delimiters. On timeout returns
+        the unconsumed bytes and None, except for the beginning of a response, which is
+        kept until the rest of it arrives."""
+        begin = -1
+        scan_pos = self.start
+
+        def find() -> Optional[int]:
+            nonlocal begin, scan_pos
+            if begin < 0:
+                begin = self.buffer.find(_GRAPHICS_RESPONSE_START, scan_pos)
+                if begin < 0:
+                    # The start may be split between reads.
+                    scan_pos = max(scan_pos, len(self.buffer) - 2)
+                    return None
+                scan_pos = begin + len(_GRAPHICS_RESPONSE_START)
+            end = self.buffer.find(_GRAPHICS_RESPONSE_END, scan_pos)
+            if end < 0:
+                scan_pos = max(scan_pos, len(self.buffer) - 1)
+                return None
+            return end
+
+        end = self._read_until(find, timeout)
+        if end is None:
+            if begin < 0:
+                begin = len(self.buffer)
+                for length in range(len(_GRAPHICS_RESPONSE_START) - 1, 0, -1):
+                    if self.buffer.endswith(_GRAPHICS_RESPONSE_START[:length]):
+                        begin -= length
+                        break
+            return self._consume(max(begin, self.start)), None
+        non_response = bytes(self.buffer[self.start : begin])
+        response = bytes(self.buffer[begin + len(_GRAPHICS_RESPONSE_START) : end])
+        self._consume(end + len(_GRAPHICS_RESPONSE_END))
+        return non_response, response
+
+    def read_cursor_position_response(
+        self, timeout: float
+    ) -> Optional[Tuple[int, int]]:
+        """Reads the response to a cursor position request (`ESC [ row ; col R`) and
+        returns the one-based row and column, or None on timeout. Other bytes,
+        including the ones preceding the response, are left in the buffer."""
+        scan_pos = self.start
+
+        def find() -> Optional[re.Match]:
+            nonlocal scan_pos
+            match = _CURSOR_POSITION_RESPONSE.search(self.buffer, scan_pos)
+            if match is None:
+                # An incomplete response may only start at the last ESC.
+                last_esc = self.buffer.rfind(b"\033", scan_pos)
+                scan_pos = last_esc if last_esc >= 0 else len(self.buffer)
+            return match
+
+        match = self._read_until(find, timeout)
+        if match is None:
+            return None
+        # The match refers to the buffer, so extract the groups before modifying it.
+        position = int(match.group(1)), int(match.group(2))
+        if match.start() == self.start:
+            self._consume(match.end())
+        else:
+            del self.buffer[match.start() : match.end()]
+        return position
+
+    def has_data(self) -> bool:
+        """Whether there are unconsumed buffered bytes or bytes that can be read
+        without blocking."""
+        if self.start < len(self.buffer):
+            return True
+        ready, _, _ = select.select([self.stream], [], [], 0)
+        return bool(ready)
+
+    def read_buffered(self) -> bytes:
+        """Consumes and returns all the buffered bytes without reading."""
+        return self._consume(len(self.buffer))
+
+    def get_buffered(self) -> bytes:
+        return bytes(self.buffer[self.start :])
+
+
 class ShellScriptBinaryIOHelper(BinaryIO):
     def __init__(self, shellscript_out: TextIO):
         self.shellscript_out: TextIO = shellscript_out
@@ -172,13 +369,14 @@ class GraphicsTerminal:
         num_tmux_layers: int = 0,
         shellscript_out: Optional[TextIO] = None,
         reset_by_scrolling: bool = False,
+        chunks_per_write: ChunksPerWrite = 1,
     ):
         # If tty_filename is not provided, we will use stdout as the default out_display
         # and /dev/tty for everything else.
         if tty_filename is None:
             if out_display is None:
                 out_display = sys.stdout.buffer
-            tty_filename = "/dev/tty"
+            tty_filename = DEFAULT_TTY_FILENAME
 
         # If some of the streams are missing, use tty_filename as the default.
         if (
@@ -206,6 +404,7 @@ class GraphicsTerminal:
         self.out_display: BinaryIO = self._open(out_display, write=True)
         self.in_response: BinaryIO = self._open(in_response, write=False)
         self.in_userinput: BinaryIO = self._open(in_userinput, write=False)
+        self.response_reader: ResponseReader = ResponseReader(self.in_response)
 
         self.max_command_size: Optional[int] = max_command_size
         self.force_placeholders: bool = force_placeholders
@@ -213,7 +412,19 @@ class GraphicsTerminal:
         self.num_tmux_layers: int = num_tmux_layers
         self.shellscript_out: Optional[TextIO] = shellscript_out
         self.reset_by_scrolling: bool = reset_by_scrolling
+        self.chunks_per_write: ChunksPerWrite = chunks_per_write
         self.tracked_cursor_position: Optional[Tuple[int, int]] = None
+        # The current frame, its nesting depth, and the streams it replaced.
+        self._frame: Optional[Frame] = None
+        self._frame_depth: int = 0
+        self._frame_streams: Tuple[BinaryIO, BinaryIO] = (
+            self.out_command,
+            self.out_display,
+        )
+        # Things to undo at the end of the current frame.
+        self._frame_exit_stack = contextlib.ExitStack()
+        # Whether `in_response` is in immediate input mode, see `immediate_input`.
+        self._immediate_input: bool = False
 
     @staticmethod
     def _open(filename: Union[str, BinaryIO, None], write: bool) -> BinaryIO:
@@ -247,6 +458,52 @@ class GraphicsTerminal:
             res.num_tmux_layers = num_tmux_layers
         return res
 
+    def begin_frame(self):
+        """Starts buffering everything written to `out_command` and `out_display`
+        until `end_frame`, so that one logical operation results in as few writes as
+        possible. The order of writes is preserved even if the streams are different.
+        Frames may be nested, only the outermost one writes the data."""
+        self._frame_depth += 1
+        if self._frame_depth > 1:
+            return
+        self._frame = Frame()
+        self._frame_streams = (self.out_command, self.out_display)
+        self.out_command = FrameStream(self._frame, self.out_command)  # type: ignore
+        self.out_display = FrameStream(self._frame, self.out_display)  # type: ignore
+
+    def end_frame(self):
+        """Ends the frame started by `begin_frame` and writes the buffered data."""
+        if self._frame_depth <= 0:
+            raise RuntimeError("end_frame called without begin_frame")
+        self._frame_depth -= 1
+        if self._frame_depth > 0:
+            return
+        frame = self._frame
+        self._frame = None
+        self.out_command, self.out_display = self._frame_streams
+        assert frame is not None
+        try:
+            frame.write_out()
+        finally:
+            self._frame_exit_stack.close()
+
+    @contextlib.contextmanager
+    def frame(self):
+        """A context manager calling `begin_frame` and `end_frame`."""
+        self.begin_frame()
+        try:
+            yield
+        finally:
+            self.end_frame()
+
+    def flush(self):
+        """Writes out all buffered data, including the data of the current frame (the
+        frame continues)."""
+        self.out_display.flush()
+        self.out_command.flush()
+        if self._frame is not None:
+            self._frame.write_out()
+
     def _write_to_shellscript(self, data: bytes, comment: str = ""):
         if self.shellscript_out is not None:
             ShellScriptBinaryIOHelper.write_to_shellscript(
@@ -315,25 +572,50 @@ class GraphicsTerminal:
         if end_row is not None:
             placeholder.end_row = end_row
 
-        placeholder.to_stream(
-            self.out_display,
+        # The whole placeholder, including cursor movements, is written with a single
+        # write (and a single syscall if the output is unbuffered).
+        data = placeholder.to_bytes(
             pos=pos,
             mode=mode,
             formatting=formatting,
             use_save_cursor=use_save_cursor,
             use_line_feeds=use_line_feeds,
         )
+        self.out_display.write(data)
 
         if self.shellscript_out is not None:
             self.shellscript_out.write(f"# Placeholder {placeholder}\n")
-            placeholder.to_stream(
-                ShellScriptBinaryIOHelper(self.shellscript_out),
-                pos=pos,
-                mode=mode,
-                formatting=formatting,
+            ShellScriptBinaryIOHelper(self.shellscript_out).write(data)
+            self.shellscript_out.write("\n")
+
+    def print_placeholders_side_by_side(
+        self,
+        placeholders: List[ImagePlaceholder],
+        pos: Optional[Tuple[int, int]] = None,
+        mode: ImagePlaceholderMode = ImagePlaceholderMode.default(),
+        formatting: AdditionalFormatting = None,
+        use_save_cursor: bool = True,
+        use_line_feeds: bool = False,
+    ):
+        """Prints placeholders with the same number of rows next to each other, like
+        `print_placeholder` does for a single one."""
+        lines = placeholders_side_by_side_to_lines(placeholders, mode, formatting)
+        if pos is not None:
+            if use_line_feeds:
+                raise ValueError("use_line_feeds=True cannot be used with pos")
+            data = lines_to_bytes_abs_position(lines, pos)
+        else:
+            data = lines_to_bytes_at_cursor(
+                lines,
+                sum(p.end_col - p.start_col for p in placeholders),
                 use_save_cursor=use_save_cursor,
                 use_line_feeds=use_line_feeds,
             )
+        self.out_display.write(data)
+
+        if self.shellscript_out is not None:
+            self.shellscript_out.write(f"# Placeholders {placeholders}\n")
+            ShellScriptBinaryIOHelper(self.shellscript_out).write(data)
             self.shellscript_out.write("\n")
 
     def print_placeholder_for_put(
@@ -391,6 +673,7 @@ class GraphicsTerminal:
         force_placeholders: Optional[bool] = None,
         force_direct_transmission: Optional[bool] = None,
         callback: Optional[Callable[[GraphicsCommand], None]] = None,
+        chunks_per_write: Optional[ChunksPerWrite] = None,
     ):
         # Convert a classic placement to a unicode placeholder placement if requested.
         if force_placeholders is None:
@@ -448,13 +731,29 @@ class GraphicsTerminal:
 
             callback = _callback
 
+        # Writes to pipes must stay atomic, so don't coalesce chunks when writing to
+        # a pipe (e.g. when the output is shared with other processes).
+        if chunks_per_write is None:
+            chunks_per_write = self.chunks_per_write
+        if chunks_per_write != 1 and self._is_pipe(self.out_command):
+            chunks_per_write = 1
+
+        # Within a frame the bulk data of a direct transmission would be copied into
+        # the frame, and the chunks couldn't be written with `writev`, so write out the
+        # frame and send the transmission to the underlying stream.
+        out_command = self.out_command
+        if self._frame is not None and self._is_bulk_transmission(command):
+            self.flush()
+            out_command = self._frame_streams[0]
+
         template = self.get_graphics_command_template()
         # Send the command.
         command.send(
-            self.out_command,
+            out_command,
             template=template,
             max_size=self.max_command_size,
             callback=callback,
+            chunks_per_write=chunks_per_write,
         )
 
         # Print a placeholder if needed.
@@ -466,6 +765,36 @@ class GraphicsTerminal:
             if isinstance(command, PutCommand):
                 self.print_placeholder_for_put(command)
 
+    @staticmethod
+    def _is_bulk_transmission(command: GraphicsCommand) -> bool:
+        """Whether the command is a direct transmission of a file or of more data than
+        a frame buffers."""
+        if (
+            not isinstance(command, TransmitCommand)
+            or command.medium != TransmissionMedium.DIRECT
+        ):
+            return False
+        return (
+            not isinstance(command.data, bytes)
+            or len(command.data) > MAX_FRAME_BUFFER_SIZE
+        )
+
+    @staticmethod
+    def _is_pipe(stream: BinaryIO) -> bool:
+        try:
+            return stat.S_ISFIFO(
+                os.fstat(GraphicsTerminal._unwrap(stream).fileno()).st_mode
+            )
+        except (AttributeError, OSError, ValueError):
+            return False
+
+    @staticmethod
+    def _unwrap(stream: BinaryIO) -> BinaryIO:
+        """Returns the stream underlying the frame buffer."""
+        while isinstance(stream, FrameStream):
+            stream = stream.out
+        return stream
+
     def set_immediate_input_noecho(self, tty: BinaryIO):
         if tty is None:
             raise ValueError("Cannot set immediate input on a write-only terminal")
@@ -476,29 +805,18 @@ class GraphicsTerminal:
     def receive_response(self, timeout: float = 10) -> GraphicsResponse:
         #  if self.in_response is None:
         #      raise ValueError("Cannot receive response on a write-only terminal")
-        with self.guard_tty_settings(self.in_response):
-            self.set_immediate_input_noecho(self.in_response)
-            buffer = b""
-            is_graphics_response = False
-            end_time = time.time() + timeout
-            while True:
-                ready, _, _ = select.select([self.in_response], [], [], timeout)
-                if ready:
-                    buffer += self.in_response.read(1)
-                    if is_graphics_response:
-                        if buffer.endswith(b"\033\\"):
-                            break
-                    else:
-                        if buffer.endswith(b"\033_G"):
-                            is_graphics_response = True
-                timeout = end_time - time.time()
-                if timeout < 0:
-                    return GraphicsResponse(is_valid=False, non_response=buffer)
+        # The command we are waiting a response for may be still buffered.
+        self.flush()
+        with self.immediate_input():
+            non_response, response = self.response_reader.read_graphics_response(
+                timeout
+            )
+            if response is None:
+                return GraphicsResponse(is_valid=False, non_response=non_response)
             # Now parse the response
             res = GraphicsResponse(is_valid=True)
-            non_response, response = buffer.split(b"\033_G", 1)
             res.non_response = non_response
-            resp_and_message = response[:-2].split(b";", 1)
+            resp_and_message = response.split(b";", 1)
             if len(resp_and_message) > 1:
                 res.message = resp_and_message[1].decode("utf-8")
                 res.is_ok = resp_and_message[1] == b"OK"
@@ -533,40 +851,20 @@ class GraphicsTerminal:
         return res
 
     def get_cursor_position(self, timeout: float = 2.0) -> Tuple[int, int]:
-        self.out_display.flush()
-        with self.guard_tty_settings(self.in_response):
-            self.set_immediate_input_noecho(self.in_response)
+        self.flush()
+        with self.immediate_input():
             # Don't use self._write here since we don't want to record this in
             # the generated shell script.
             self.out_command.write(b"\033[6n")
-            self.out_command.flush()
-            buffer = b""
-            end_time = time.time() + timeout
-            is_response = False
-            while True:
-                ready, _, _ = select.select([self.in_response], [], [], timeout)
-                if ready:
-                    buffer += self.in_response.read(1)
-                    if is_response:
-                        if buffer.endswith(b"R"):
-                            break
-                    else:
-                        if buffer.endswith(b"\033["):
-                            is_response = True
-                            buffer = b""
-                timeout = end_time - time.time()
-                if timeout < 0:
-                    raise TimeoutError(
-                        "No response to cursor position request: %r" % buffer
-                    )
-            # Now parse the response
-            parts = buffer[:-1].split(b";")
-            if len(parts) != 2:
-                raise ValueError(
-                    "Invalid response to cursor position request: %r" % buffer
+            self.flush()
+            position = self.response_reader.read_cursor_position_response(timeout)
+            if position is None:
+                raise TimeoutError(
+                    "No response to cursor position request: %r"
+                    % self.response_reader.get_buffered()
                 )
-            y, x = parts
-            self.tracked_cursor_position = (int(x) - 1, int(y) - 1)
+            y, x = position
+            self.tracked_cursor_position = (x - 1, y - 1)
         return self.tracked_cursor_position
 
     def get_cursor_position_tracked(self, timeout: float = 2.0) -> Tuple[int, int]:
@@ -577,10 +875,45 @@ class GraphicsTerminal:
     def guard_tty_settings(self, tty: BinaryIO) -> TtySettingsGuard:
         return TtySettingsGuard(tty)
 
+    @contextlib.contextmanager
+    def immediate_input(self):
+        """Switches `in_response` to non-canonical mode without echo (see
+        `set_immediate_input_noecho`) and restores its settings on exit. Does nothing
+        if it's already in this mode."""
+        if self._immediate_input:
+            yield
+            return
+        with self.guard_tty_settings(self.in_response):
+            self.set_immediate_input_noecho(self.in_response)
+            self._immediate_input = True
+            try:
+                yield
+            finally:
+                self._immediate_input = False
+
+    def keep_immediate_input(self):
+        """Keeps `in_response` in immediate input mode until the end of the current
+        frame, so that responses arriving asynchronously are not echoed, and
+        `has_response_data` sees them even though they don't end with a newline.
+        Does nothing outside frames."""
+        if self._frame is not None and not self._immediate_input:
+            self._frame_exit_stack.enter_context(self.immediate_input())
+
+    def has_response_data(self) -> bool:
+        """Whether there are response bytes that can be read without waiting. Doesn't
+        touch the terminal settings, so outside immediate input mode the bytes of an
+        incomplete line are not visible."""
+        return self.response_reader.has_data()
+
     def wait_for_keypress(self) -> bytes:
-        self.out_display.flush()
+        self.flush()
         with self.guard_tty_settings(self.in_userinput):
             self.set_immediate_input_noecho(self.in_userinput)
+            if self.in_userinput is self.in_response:
+                # The input may have been read along with responses.
+                result = self.response_reader.read_buffered()
+                if result:
+                    return result
             result = b""
             while len(result) < 256:
                 result += self.in_userinput.read(1)
@@ -636,9 +969,9 @@ class GraphicsTerminal:
 
     def _get_all_filenos(self):
         return [
-            self.out_display.fileno(),
+            self._unwrap(self.out_display).fileno(),
             self.in_userinput.fileno(),
-            self.out_command.fileno(),
+            self._unwrap(self.out_command).fileno(),
             self.in_response.fileno(),
         ]
 
@@ -1,12 +1,27 @@
+import fcntl
 import heapq
+import json
 import os
 import secrets
 import sqlite3
+import threading
+import zlib
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Iterable, Iterator, List, Optional, Tuple, Callable, Literal
+from typing import (
+    AbstractSet,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+)
 from contextlib import closing
 from enum import Enum
+from itertools import islice
 import warnings
 import time
 import random
@@ -339,11 +354,30 @@ class IDSpace:
                 yield IDSpace(color_bits, use_3rd_diacritic)
 
 
+# Timestamps are stored in the database as integer numbers of microseconds since
+# 1970-01-01 in local time (the same naive local time that `datetime.now()` returns).
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _datetime_to_us(dt: datetime) -> int:
+    return (dt - _EPOCH) // _MICROSECOND
+
+
+def _us_to_datetime(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+
 @dataclass
 class ImageInfo:
     description: str
     id: int
-    atime: datetime
+    # The access time as stored in the database. Use `atime` to get a datetime.
+    atime_us: int
+
+    @property
+    def atime(self) -> datetime:
+        return _us_to_datetime(self.atime_us)
 
 
 UploadingStatus = Literal["dirty", "in_progress", "uploaded"]
@@ -387,63 +421,353 @@ class RetryAssignIdError(Exception):
     """Exception raised when the ID has the wrong description."""
 
 
+# The version of the database schema, stored in `PRAGMA user_version`.
+SCHEMA_VERSION = 9
+
+# The path of the image extracted from the description of an ID. Descriptions are
+# usually json objects, but this is not enforced, hence the validity check. Queries
+# must use exactly this expression to make use of the index on it.
+_DESCRIPTION_PATH = (
+    "(CASE WHEN json_valid(description) THEN json_extract(description, '$.path') END)"
+)
+
+
+# The size of the prepared statement cache of each connection. The set of statements
+# we run is fixed: a few dozen templates, most of which are instantiated for each of
+# the namespaces. Statements must not embed variable-length lists, so that they stay
+# in this set.
+_STATEMENT_CACHE_SIZE = 256
+
+# Connections shared by all IDManager instances of the process, keyed by the absolute
+# path of the database file, the pid (connections must not be used after `fork`) and
+# the thread (connections can't be shared between threads). The values are pairs of
+# the connection and the number of IDManager instances using it.
+_connection_pool: Dict[Tuple[str, int, int], Tuple[sqlite3.Connection, int]] = {}
+_connection_pool_lock = threading.Lock()
+
+
+# Uploads in progress are signalled to other processes by holding a lock on one of
+# this many lock files (see `IDManager._upload_lock_path`).
+_UPLOAD_LOCK_SLOTS = 256
+# How often processes waiting for a concurrent upload check whether it has finished.
+_UPLOAD_LOCK_POLL_INTERVAL = 0.005
+
+
+def _pool_key(database_file: str) -> Optional[Tuple[str, int, int]]:
+    if database_file in ("", ":memory:") or database_file.startswith("file:"):
+        # Each in-memory connection is a separate database, don't share them.
+        return None
+    return (os.path.abspath(database_file), os.getpid(), threading.get_ident())
+
+
 class IDManager:
-    def __init__(self, database_file: str, *, max_ids_per_subspace: int = 1024):
+    def __init__(
+        self,
+        database_file: str,
+        *,
+        max_ids_per_subspace: int = 1024,
+        atime_update_interval: timedelta = timedelta(0),
+    ):
         self.database_file = database_file
         directory = os.path.dirname(database_file)
         if directory:
             os.makedirs(directory, exist_ok=True)
-        self.conn = sqlite3.connect(database_file, isolation_level=None)
         self.max_ids_per_subspace: int = max_ids_per_subspace
-
-        with closing(self.conn.cursor()) as cursor:
+        # The atime of an existing ID is not updated by `get_id` if it's more recent
+        # than this. Reduces the number of writes when the same images are displayed
+        # over and over again.
+        self.atime_update_interval: timedelta = atime_update_interval
+
+        # File descriptors of the upload locks we hold, by (id, terminal).
+        self._upload_locks: Dict[Tuple[int, str], int] = {}
+
+        self._pool_key = _pool_key(database_file)
+        with _connection_pool_lock:
+            if self._pool_key in _connection_pool:
+                # The connection is already set up and its schema is up to date.
+                conn, refcount = _connection_pool[self._pool_key]
+                _connection_pool[self._pool_key] = (conn, refcount + 1)
+                self.conn = conn
+                return
+            self.conn = self._connect(database_file)
+            if self._pool_key is not None:
+                _connection_pool[self._pool_key] = (self.conn, 1)
+
+    @classmethod
+    def _connect(cls, database_file: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            database_file,
+            isolation_level=None,
+            cached_statements=_STATEMENT_CACHE_SIZE,
+        )
+        with closing(conn.cursor()) as cursor:
             # Set some options.
             cursor.execute("PRAGMA journal_mode=WAL")
             cursor.execute("PRAGMA busy_timeout = 30000")
-            # Make sure we have tables for all ID namespaces.
-            for id_space in IDSpace.all_values():
-                namespace = id_space.namespace_name()
-                cursor.execute(
-                    f"""
-                        CREATE TABLE IF NOT EXISTS {namespace} (
-                            id INTEGER PRIMARY KEY,
-                            description TEXT NOT NULL,
-                            atime TIMESTAMP NOT NULL
-                        )
-                    """
-                )
-                cursor.execute(
-                    f"""CREATE INDEX IF NOT EXISTS idx_{namespace}_path_parameters
-                        ON {namespace} (description)
-                    """
-                )
-                cursor.execute(
-                    f"""CREATE INDEX IF NOT EXISTS idx_{namespace}_atime
-                        ON {namespace} (atime)
-                    """
-                )
-            # Make sure we have a table for recent uploads.
+            # Create or upgrade the schema if needed.
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] < SCHEMA_VERSION:
+                with conn:
+                    cursor.execute("BEGIN IMMEDIATE")
+                    cls._migrate(cursor)
+        return conn
+
+    @classmethod
+    def _migrate(cls, cursor):
+        """Bring the schema up to `SCHEMA_VERSION`. Must be called within a write
+        transaction."""
+        # Migration `i` upgrades the schema from version `i` to version `i + 1`.
+        migrations = [
+            cls._create_initial_schema,
+            cls._add_subspace_column,
+            cls._add_free_id_tables,
+            cls._add_upload_counters,
+            cls._use_integer_timestamps,
+            cls._add_path_index,
+            cls._add_upload_chunked_column,
+            cls._add_terminal_property_table,
+            cls._add_upload_locked_column,
+        ]
+        assert len(migrations) == SCHEMA_VERSION
+        # Re-read the version: another process might have migrated the database
+        # before we acquired the lock.
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+        for migration in migrations[version:]:
+            migration(cursor)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    @staticmethod
+    def _create_initial_schema(cursor):
+        # Databases created before schema versioning have version 0 but already have
+        # these tables, so everything here must be idempotent.
+        # Make sure we have tables for all ID namespaces.
+        for id_space in IDSpace.all_values():
+            namespace = id_space.namespace_name()
             cursor.execute(
                 f"""
-                    CREATE TABLE IF NOT EXISTS upload (
-                        id INTEGER NOT NULL,
+                    CREATE TABLE IF NOT EXISTS {namespace} (
+                        id INTEGER PRIMARY KEY,
                         description TEXT NOT NULL,
-                        size INTEGER NOT NULL,
-                        terminal TEXT NOT NULL,
-                        upload_time TIMESTAMP NOT NULL,
-                        status TEXT NOT NULL,
-                        upload_id INTEGER NOT NULL,
-                        PRIMARY KEY (id, terminal)
+                        atime TIMESTAMP NOT NULL
                     )
                 """
             )
             cursor.execute(
-                f"""CREATE INDEX IF NOT EXISTS idx_upload_upload_time
-                    ON upload (upload_time)
+                f"""CREATE INDEX IF NOT EXISTS idx_{namespace}_path_parameters
+                    ON {namespace} (description)
+                """
+            )
+            cursor.execute(
+                f"""CREATE INDEX IF NOT EXISTS idx_{namespace}_atime
+                    ON {namespace} (atime)
+                """
+            )
+        # Make sure we have a table for recent uploads.
+        cursor.execute(
+            f"""
+                CREATE TABLE IF NOT EXISTS upload (
+                    id INTEGER NOT NULL,
+                    description TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    terminal TEXT NOT NULL,
+                    upload_time TIMESTAMP NOT NULL,
+                    status TEXT NOT NULL,
+                    upload_id INTEGER NOT NULL,
+                    PRIMARY KEY (id, terminal)
+                )
+            """
+        )
+        cursor.execute(
+            f"""CREATE INDEX IF NOT EXISTS idx_upload_upload_time
+                ON upload (upload_time)
+            """
+        )
+
+    @staticmethod
+    def _add_subspace_column(cursor):
+        # Materialize the subspace byte, so that queries restricted to a subspace can
+        # use index range scans instead of computing `id & mask` for every row.
+        for id_space in IDSpace.all_values():
+            namespace = id_space.namespace_name()
+            offset = id_space.subspace_byte_offset()
+            cursor.execute(
+                f"""ALTER TABLE {namespace} ADD COLUMN subspace INTEGER
+                    GENERATED ALWAYS AS ((id >> {offset}) & 255) VIRTUAL
+                """
+            )
+            cursor.execute(
+                f"""CREATE INDEX IF NOT EXISTS idx_{namespace}_subspace_description
+                    ON {namespace} (subspace, description)
+                """
+            )
+            cursor.execute(
+                f"""CREATE INDEX IF NOT EXISTS idx_{namespace}_subspace_atime
+                    ON {namespace} (subspace, atime)
+                """
+            )
+
+    @staticmethod
+    def _add_free_id_tables(cursor):
+        # For small subspaces we keep the set of unused IDs in the database, so that
+        # allocating an ID doesn't require reading the whole subspace. The free list
+        # of a subspace byte is populated lazily on the first allocation from it (see
+        # `_init_free_ids`), and from then on it's maintained by triggers.
+        for id_space in IDSpace.all_values():
+            namespace = id_space.namespace_name()
+            offset = id_space.subspace_byte_offset()
+            cursor.execute(
+                f"""CREATE TABLE IF NOT EXISTS {namespace}_free (
+                        id INTEGER PRIMARY KEY
+                    )"""
+            )
+            cursor.execute(
+                f"""CREATE TABLE IF NOT EXISTS {namespace}_free_init (
+                        byte INTEGER PRIMARY KEY
+                    )"""
+            )
+            cursor.execute(
+                f"""CREATE TRIGGER IF NOT EXISTS {namespace}_free_on_insert
+                    AFTER INSERT ON {namespace}
+                    BEGIN
+                        DELETE FROM {namespace}_free WHERE id = NEW.id;
+                    END"""
+            )
+            cursor.execute(
+                f"""CREATE TRIGGER IF NOT EXISTS {namespace}_free_on_delete
+                    AFTER DELETE ON {namespace}
+                    WHEN EXISTS (
+                        SELECT 1 FROM {namespace}_free_init
+                        WHERE byte = (OLD.id >> {offset}) & 255
+                    )
+                    BEGIN
+                        INSERT OR IGNORE INTO {namespace}_free (id) VALUES (OLD.id);
+                    END"""
+            )
+
+    @staticmethod
+    def _add_upload_counters(cursor):
+        # Each terminal has a counter of uploads and uploaded bytes, and each upload
+        # row remembers the values of the counters right after it was started, so
+        # `uploads_ago` and `bytes_ago` can be computed without scanning the uploads.
+        cursor.execute("ALTER TABLE upload ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+        cursor.execute(
+            "ALTER TABLE upload ADD COLUMN cum_bytes INTEGER NOT NULL DEFAULT 0"
+        )
+        cursor.execute(
+            """
+                CREATE TABLE IF NOT EXISTS upload_counter (
+                    terminal TEXT PRIMARY KEY,
+                    seq INTEGER NOT NULL,
+                    total_bytes INTEGER NOT NULL
+                )
+            """
+        )
+        # Number the existing uploads in the order of their upload times.
+        cursor.execute(
+            """
+                UPDATE upload SET seq = numbered.seq, cum_bytes = numbered.cum_bytes
+                FROM (
+                    SELECT id, terminal,
+                        ROW_NUMBER() OVER w AS seq,
+                        SUM(COALESCE(size, 0)) OVER w AS cum_bytes
+                    FROM upload
+                    WINDOW w AS (
+                        PARTITION BY terminal ORDER BY upload_time, id
+                        ROWS UNBOUNDED PRECEDING
+                    )
+                ) AS numbered
+                WHERE upload.id = numbered.id AND upload.terminal = numbered.terminal
+            """
+        )
+        cursor.execute(
+            """
+                INSERT OR REPLACE INTO upload_counter (terminal, seq, total_bytes)
+                SELECT terminal, MAX(seq), MAX(cum_bytes) FROM upload
+                GROUP BY terminal
+            """
+        )
+
+    @staticmethod
+    def _use_integer_timestamps(cursor):
+        # Convert the ISO timestamps to microseconds (see `_datetime_to_us`). The
+        # columns are updated in place: sqlite doesn't enforce column types, and the
+        # declared type `TIMESTAMP` doesn't affect how integers are stored.
+        tables = [(s.namespace_name(), "atime") for s in IDSpace.all_values()]
+        tables.append(("upload", "upload_time"))
+        for table, column in tables:
+            cursor.execute(
+                f"SELECT rowid, {column} FROM {table} WHERE typeof({column}) = 'text'"
+            )
+            updates = [
+                (_datetime_to_us(datetime.fromisoformat(value)), rowid)
+                for rowid, value in cursor.fetchall()
+            ]
+            cursor.executemany(
+                f"UPDATE {table} SET {column} = ? WHERE rowid = ?", updates
+            )
+
+    @staticmethod
+    def _add_path_index(cursor):
+        for id_space in IDSpace.all_values():
+            namespace = id_space.namespace_name()
+            cursor.execute(
+                f"""CREATE INDEX IF NOT EXISTS idx_{namespace}_path
+                    ON {namespace} {_DESCRIPTION_PATH}
                 """
             )
 
+    @staticmethod
+    def _add_upload_chunked_column(cursor):
+        # Whether the upload is transmitted as a stream of chunks that must not be
+        # interleaved with other transmissions to the same terminal. Uploads recorded
+        # before this column existed are conservatively assumed to be chunked.
+        cursor.execute(
+            "ALTER TABLE upload ADD COLUMN chunked INTEGER NOT NULL DEFAULT 1"
+        )
+        cursor.execute(
+            f"""CREATE INDEX IF NOT EXISTS idx_upload_chunked_in_progress
+                ON upload (terminal, upload_time)
+                WHERE status = '{UPLOADING_STATUS_IN_PROGRESS}' AND chunked = 1
+            """
+        )
+
+    @staticmethod
+    def _add_terminal_property_table(cursor):
+        # Properties of terminals that are expensive to detect, e.g. the results of
+        # queries that may time out, so that each process doesn't have to detect them.
+        cursor.execute(
+            """
+                CREATE TABLE IF NOT EXISTS terminal_property (
+                    terminal TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (terminal, name)
+                )
+            """
+        )
+
+    @staticmethod
+    def _add_upload_locked_column(cursor):
+        # Whether the uploader holds its upload lock. If it doesn't (the lock file was
+        # busy), a free lock says nothing about whether the uploader is alive.
+        cursor.execute(
+            "ALTER TABLE upload ADD COLUMN locked INTEGER NOT NULL DEFAULT 0"
+        )
+
     def close(self):
+        """Releases the connection. Pooled connections are closed when the last
+        IDManager using them is closed."""
+        for id, terminal in list(self._upload_locks):
+            self._release_upload_lock(id, terminal)
+        with _connection_pool_lock:
+            entry = _connection_pool.get(self._pool_key)
+            if entry is not None and entry[0] is self.conn:
+                conn, refcount = entry
+                if refcount > 1:
+                    _connection_pool[self._pool_key] = (conn, refcount - 1)
+                    return
+                del _connection_pool[self._pool_key]
         self.conn.close()
 
     def get_info(self, id: int) -> Optional[ImageInfo]:
@@ -459,11 +783,11 @@ class IDManager:
             row = cursor.fetchone()
         if not row:
             return None
-        description, atime = row
+        description, atime_us = row
         return ImageInfo(
             id=id,
             description=description,
-            atime=datetime.fromisoformat(atime),
+            atime_us=atime_us,
         )
 
     def get_all(
@@ -473,30 +797,90 @@ class IDManager:
     ) -> List[ImageInfo]:
         if id_space is None:
             spaces = [self.get_all(s, subspace) for s in IDSpace.all_values()]
-            return list(heapq.merge(*spaces, key=lambda x: x.atime, reverse=True))
+            return list(heapq.merge(*spaces, key=lambda x: x.atime_us, reverse=True))
 
         namespace = id_space.namespace_name()
-        begin, end = id_space.subspace_masked_range(subspace)
         with closing(self.conn.cursor()) as cursor:
             cursor.execute(
                 f"""SELECT id, description, atime FROM {namespace}
-                    WHERE (id & ?) BETWEEN ? AND ? ORDER BY atime DESC
+                    WHERE subspace BETWEEN ? AND ? ORDER BY atime DESC
                 """,
-                (
-                    id_space.subspace_byte_mask(),
-                    begin,
-                    end - 1,
-                ),
+                (subspace.begin, subspace.end - 1),
             )
             return [
                 ImageInfo(
                     id=row[0],
                     description=row[1],
-                    atime=datetime.fromisoformat(row[2]),
+                    atime_us=row[2],
                 )
                 for row in cursor.fetchall()
             ]
 
+    def query(
+        self,
+        *,
+        ids: Optional[Iterable[int]] = None,
+        paths: Optional[Iterable[str]] = None,
+        older: Optional[datetime] = None,
+        newer: Optional[datetime] = None,
+        last: Optional[int] = None,
+        except_last: Optional[int] = None,
+    ) -> Iterator[ImageInfo]:
+        """Returns the infos of the IDs matching all the given conditions, most
+        recently used first. The rows are fetched lazily, so e.g. `last=5` reads only
+        a few rows from each namespace.
+
+        Args:
+            ids, paths: If any of them is specified, return only the IDs from `ids`
+            and the IDs whose description contains a path from `paths`.
+
+            older, newer: Return only the IDs with the atime strictly older (newer)
+            than the given time.
+
+            last, except_last: Of the IDs matching the other conditions, return only
+            the `last` most recently used ones, excluding the `except_last` most
+            recently used ones.
+        """
+        conditions = []
+        params: list = []
+        if ids is not None or paths is not None:
+            # Pass the lists as json arrays to avoid the limit on sql variables.
+            conditions.append(
+                f"""(id IN (SELECT value FROM json_each(?))
+                     OR {_DESCRIPTION_PATH} IN (SELECT value FROM json_each(?)))"""
+            )
+            params.append(json.dumps(list(ids) if ids is not None else []))
+            params.append(json.dumps(list(paths) if paths is not None else []))
+        if older is not None:
+            conditions.append("atime < ?")
+            params.append(_datetime_to_us(older))
+        if newer is not None:
+            conditions.append("atime > ?")
+            params.append(_datetime_to_us(newer))
+        where = " AND ".join(conditions) if conditions else "1"
+        limit = ""
+        if last is not None:
+            # No namespace contributes more than `last` IDs to the result.
+            limit = f"LIMIT {int(last)}"
+
+        def query_namespace(namespace: str) -> Iterator[ImageInfo]:
+            with closing(self.conn.cursor()) as cursor:
+                cursor.execute(
+                    f"""SELECT id, description, atime FROM {namespace}
+                        WHERE {where} ORDER BY atime DESC {limit}
+                    """,
+                    params,
+                )
+                for row in cursor:
+                    yield ImageInfo(id=row[0], description=row[1], atime_us=row[2])
+
+        merged = heapq.merge(
+            *(query_namespace(s.namespace_name()) for s in IDSpace.all_values()),
+            key=lambda x: x.atime_us,
+            reverse=True,
+        )
+        return islice(merged, except_last or 0, last)
+
     def count(
         self,
         id_space: Optional[IDSpace] = None,
@@ -506,17 +890,12 @@ class IDManager:
             return sum(self.count(s, subspace) for s in IDSpace.all_values())
 
         namespace = id_space.namespace_name()
-        begin, end = id_space.subspace_masked_range(subspace)
         with closing(self.conn.cursor()) as cursor:
             cursor.execute(
                 f"""SELECT COUNT(*) FROM {namespace}
-                    WHERE (id & ?) BETWEEN ? AND ?
+                    WHERE subspace BETWEEN ? AND ?
                 """,
-                (
-                    id_space.subspace_byte_mask(),
-                    begin,
-                    end - 1,
-                ),
+                (subspace.begin, subspace.end - 1),
             )
             return cursor.fetchone()[0]
 
@@ -540,27 +919,51 @@ class IDManager:
                         description=excluded.description,
                         atime=excluded.atime
                 """,
-                (id, description, atime.isoformat()),
+                (id, description, _datetime_to_us(atime)),
             )
 
     def del_id(self, id: int):
-        id_space = IDSpace.from_id(id)
-        namespace = id_space.namespace_name()
+        self.del_ids([id])
+
+    def del_ids(self, ids: Iterable[int]):
+        """Delete the given IDs in a single transaction."""
         with self.conn:
             with closing(self.conn.cursor()) as cursor:
-                self.conn.execute("BEGIN IMMEDIATE")
-                cursor.execute(f"DELETE FROM {namespace} WHERE id=?", (id,))
+                cursor.execute("BEGIN IMMEDIATE")
+                for namespace, namespace_ids in self._group_by_namespace(ids).items():
+                    cursor.execute(
+                        f"""DELETE FROM {namespace}
+                            WHERE id IN (SELECT value FROM json_each(?))
+                        """,
+                        (json.dumps(namespace_ids),),
+                    )
 
     def touch_id(self, id: int, atime: Optional[datetime] = None):
         """Update the `atime` of the given ID if it exists."""
+        self.touch_ids([id], atime)
+
+    def touch_ids(self, ids: Iterable[int], atime: Optional[datetime] = None):
+        """Update the `atime` of the given IDs that exist in a single transaction."""
         if atime is None:
             atime = datetime.now()
-        namespace = IDSpace.from_id(id)
-        with closing(self.conn.cursor()) as cursor:
-            cursor.execute(
-                f"UPDATE {namespace} SET atime=? WHERE id=?",
-                (atime.isoformat(), id),
-            )
+        with self.conn:
+            with closing(self.conn.cursor()) as cursor:
+                cursor.execute("BEGIN IMMEDIATE")
+                for namespace, namespace_ids in self._group_by_namespace(ids).items():
+                    cursor.execute(
+                        f"""UPDATE {namespace} SET atime=?
+                            WHERE id IN (SELECT value FROM json_each(?))
+                        """,
+                        (_datetime_to_us(atime), json.dumps(namespace_ids)),
+                    )
+
+    @staticmethod
+    def _group_by_namespace(ids: Iterable[int]) -> Dict[str, List[int]]:
+        ids_by_namespace: Dict[str, List[int]] = {}
+        for id in set(ids):
+            namespace = IDSpace.from_id(id).namespace_name()
+            ids_by_namespace.setdefault(namespace, []).append(id)
+        return ids_by_namespace
 
     def get_id(
         self,
@@ -569,127 +972,169 @@ class IDManager:
         *,
         subspace: IDSubspace = IDSubspace(),
         update_atime: bool = True,
+        keep: AbstractSet[int] = frozenset(),
     ) -> int:
-        namespace = id_space.namespace_name()
-        begin, end = id_space.subspace_masked_range(subspace)
-        subspace_size = id_space.subspace_size(subspace)
-
+        return self.get_ids(
+            [description],
+            id_space,
+            subspace=subspace,
+            update_atime=update_atime,
+            keep=keep,
+        )[0]
+
+    def get_max_batch_size(self, id_space: IDSpace, subspace: IDSubspace) -> int:
+        """Returns the maximum number of distinct descriptions that `get_ids` can
+        assign IDs to in a single call."""
+        return min(id_space.subspace_size(subspace), self.max_ids_per_subspace)
+
+    def get_ids(
+        self,
+        descriptions: List[str],
+        id_space: IDSpace,
+        *,
+        subspace: IDSubspace = IDSubspace(),
+        update_atime: bool = True,
+        keep: AbstractSet[int] = frozenset(),
+    ) -> List[int]:
+        """Find or assign IDs for all the given descriptions within a single
+        transaction. Equal descriptions get equal IDs. The IDs returned by a call are
+        never reassigned by the same call, so the number of distinct descriptions must
+        not exceed `get_max_batch_size`. The IDs in `keep` (e.g. the ones returned by
+        an earlier call that are still in use) are not reassigned either."""
+        max_batch_size = self.get_max_batch_size(id_space, subspace)
+        if len(set(descriptions)) > max_batch_size:
+            raise ValueError(
+                f"Cannot assign IDs to {len(set(descriptions))} descriptions at once,"
+                f" the subspace {subspace} of {id_space} holds only {max_batch_size}"
+            )
         atime = datetime.now()
 
-        # A helper to find an ID with the given description in the given subspace.
-        def _find_id_helper(cursor):
-            # Find the row with the given `description` and id subspace.
-            cursor.execute(
-                f"""SELECT id FROM {namespace}
-                    WHERE description=? AND (id & ?) BETWEEN ? AND ?
-                """,
-                (
-                    description,
-                    id_space.subspace_byte_mask(),
-                    begin,
-                    end - 1,
-                ),
+        # Most of the time the IDs already exist, so we look them up first without
+        # taking the write lock.
+        found_ids = self._lookup_ids(
+            descriptions,
+            id_space,
+            subspace,
+            atime=atime,
+            update_atime=update_atime,
+        )
+        missing = [d for d, id in zip(descriptions, found_ids) if id is None]
+        if not missing:
+            return found_ids  # type: ignore
+        assigned_ids = iter(
+            self._assign_ids(
+                missing,
+                id_space,
+                subspace,
+                atime=atime,
+                update_atime=update_atime,
+                keep=set(keep) | {id for id in found_ids if id is not None},
             )
-            row = cursor.fetchone()
+        )
+        return [id if id is not None else next(assigned_ids) for id in found_ids]
 
-            # If there is such a row, update the `atime` and return the `id`.
-            if row:
-                id = row[0]
-                if update_atime:
-                    cursor.execute(
-                        f"UPDATE {namespace} SET atime=? WHERE id=?",
-                        (atime.isoformat(), id),
-                    )
-                return id
+    def _lookup_ids(
+        self,
+        descriptions: List[str],
+        id_space: IDSpace,
+        subspace: IDSubspace,
+        *,
+        atime: datetime,
+        update_atime: bool,
+    ) -> List[Optional[int]]:
+        """Find existing IDs for the given descriptions without starting a write
+        transaction. Returns None for the descriptions that don't have IDs (or whose
+        IDs were reassigned while we were updating the atime)."""
+        namespace = id_space.namespace_name()
+        atime_us = _datetime_to_us(atime)
+        atime_update_interval_us = self.atime_update_interval // _MICROSECOND
+        ids: List[Optional[int]] = []
+        # The indices of the IDs whose atime needs to be updated.
+        to_touch: List[int] = []
+        with closing(self.conn.cursor()) as cursor:
+            for description in descriptions:
+                cursor.execute(
+                    f"""SELECT id, atime FROM {namespace}
+                        WHERE description=? AND subspace BETWEEN ? AND ?
+                    """,
+                    (description, subspace.begin, subspace.end - 1),
+                )
+                found = cursor.fetchone()
+                if found is None:
+                    ids.append(None)
+                    continue
+                ids.append(found[0])
+                if (
+                    update_atime
+                    and atime_us - found[1] >= atime_update_interval_us
+                ):
+                    to_touch.append(len(ids) - 1)
 
-            return None
+            if not to_touch:
+                return ids
 
-        # If the subspace is small enough, we will select all the rows and
-        # identify unused IDs.
-        if subspace_size <= min(1024, self.max_ids_per_subspace):
-            with self.conn:
-                with closing(self.conn.cursor()) as cursor:
+            # Update the atime only if the ID still has the same description. If it
+            # doesn't, it was reassigned concurrently and we need to get a new one.
+            def _touch(i: int):
+                cursor.execute(
+                    f"UPDATE {namespace} SET atime=? WHERE id=? AND description=?",
+                    (atime_us, ids[i], descriptions[i]),
+                )
+                if cursor.rowcount == 0:
+                    ids[i] = None
+
+            if len(to_touch) == 1:
+                # A single statement is atomic, no need for an explicit transaction.
+                _touch(to_touch[0])
+            else:
+                with self.conn:
                     cursor.execute("BEGIN IMMEDIATE")
-                    # First, try to find an existing ID with the given description.
-                    id = _find_id_helper(cursor)
-                    if id is not None:
-                        return id
-
-                    # First check the count of rows in the subspace. If the subspace
-                    # is full, select the oldest row and update it.
-                    if self.count(id_space, subspace) >= subspace_size:
-                        cursor.execute(
-                            f"""SELECT id FROM {namespace} WHERE (id & ?) BETWEEN ? AND ?
-                                ORDER BY atime ASC LIMIT 1
-                            """,
-                            (
-                                id_space.subspace_byte_mask(),
-                                begin,
-                                end - 1,
-                            ),
-                        )
-                        id = cursor.fetchone()[0]
-                        self.set_id(
-                            id,
-                            description=description,
-                            atime=atime,
-                        )
-                        return id
-                    cursor.execute(
-                        f"SELECT id, atime FROM {namespace} WHERE (id & ?) BETWEEN ? AND ?",
-                        (
-                            id_space.subspace_byte_mask(),
-                            begin,
-                            end - 1,
-                        ),
-                    )
-                    available_ids = set(id_space.all_ids(subspace))
-                    oldest_atime_id: Optional[Tuple[int, datetime]] = None
-                    for row in cursor.fetchall():
-                        row_id = row[0]
-                        row_atime = datetime.fromisoformat(row[1])
-                        available_ids.remove(row_id)
-                        if oldest_atime_id is None or row_atime < oldest_atime_id[1]:
-                            oldest_atime_id = (row_id, row_atime)
-                    if available_ids:
-                        id = secrets.choice(list(available_ids))
-                    else:
-                        assert oldest_atime_id is not None
-                        id = oldest_atime_id[0]
-                    self.set_id(
-                        id,
-                        description=description,
-                        atime=atime,
-                    )
-                    return id
+                    for i in to_touch:
+                        _touch(i)
+        return ids
+
+    def _assign_ids(
+        self,
+        descriptions: List[str],
+        id_space: IDSpace,
+        subspace: IDSubspace,
+        *,
+        atime: datetime,
+        update_atime: bool,
+        keep: AbstractSet[int] = frozenset(),
+    ) -> List[int]:
+        """Find or assign IDs for the given descriptions in a write transaction. The
+        IDs in `keep` and the IDs assigned earlier in the same call are never
+        reassigned."""
+        subspace_size = id_space.subspace_size(subspace)
 
-        # If the subspace is too large, try rejection sampling. We will try to
-        # do it several times, and if we fail, we will do a cleanup and try
-        # again. Cleanups are progressively more aggressive.
+        # We will try to assign all IDs several times, and if we fail, we will do a
+        # cleanup and try again. Cleanups are progressively more aggressive. Failures
+        # are possible only for large subspaces where we use rejection sampling.
         for frac in [0.75, 0.6, 0.5, 0]:
+            ids: List[Optional[int]] = []
+            kept = set(keep)
             with self.conn:
                 with closing(self.conn.cursor()) as cursor:
-                    self.conn.execute("BEGIN IMMEDIATE")
-                    # First, try to find an existing ID with the given description. It
-                    # might have been inserted by another process.
-                    id = _find_id_helper(cursor)
-                    if id is not None:
-                        return id
-                    # Run rejection sampling.
-                    for j in range(8):
-                        id = id_space.gen_random_id(subspace)
-                        cursor.execute(f"SELECT id FROM {namespace} WHERE id=?", (id,))
-                        if not cursor.fetchone():
-                            break
-                        id = None
-                    # If it succeeded, insert the row and return the id.
-                    if id is not None:
-                        self.set_id(
-                            id,
-                            description=description,
+                    cursor.execute("BEGIN IMMEDIATE")
+                    # Note that we reassign all IDs on each attempt: the ones found
+                    # during the previous attempt might have been removed by the
+                    # cleanup.
+                    for description in descriptions:
+                        id = self._get_id_in_transaction(
+                            cursor,
+                            description,
+                            id_space,
+                            subspace,
                             atime=atime,
+                            update_atime=update_atime,
+                            keep=kept,
                         )
-                        return id
+                        ids.append(id)
+                        if id is not None:
+                            kept.add(id)
+            if all(id is not None for id in ids):
+                return ids  # type: ignore
             if frac == 0:
                 break
             # If it failed, try to do a cleanup.
@@ -697,6 +1142,7 @@ class IDManager:
                 id_space,
                 subspace,
                 max_ids=min(int(subspace_size * frac), self.max_ids_per_subspace),
+                keep=keep,
             )
 
         raise RuntimeError(
@@ -705,91 +1151,228 @@ class IDManager:
             f" {subspace_size}"
         )
 
+    @staticmethod
+    def _init_free_ids(cursor, id_space: IDSpace, subspace: IDSubspace):
+        """Populate the free lists of the subspace bytes of `subspace` that haven't
+        been populated yet. Must be called within a write transaction."""
+        namespace = id_space.namespace_name()
+        cursor.execute(
+            f"SELECT byte FROM {namespace}_free_init WHERE byte BETWEEN ? AND ?",
+            (subspace.begin, subspace.end - 1),
+        )
+        initialized = {row[0] for row in cursor.fetchall()}
+        if len(initialized) == subspace.end - subspace.begin:
+            return
+        offset = id_space.subspace_byte_offset()
+        cursor.executemany(
+            f"INSERT OR IGNORE INTO {namespace}_free (id) VALUES (?)",
+            (
+                (id,)
+                for id in id_space.all_ids(subspace)
+                if (id >> offset) & 255 not in initialized
+            ),
+        )
+        # Used IDs of already initialized bytes are not in the free list anyway.
+        cursor.execute(
+            f"""DELETE FROM {namespace}_free WHERE id IN (
+                    SELECT id FROM {namespace} WHERE subspace BETWEEN ? AND ?
+                )""",
+            (subspace.begin, subspace.end - 1),
+        )
+        cursor.executemany(
+            f"INSERT INTO {namespace}_free_init (byte) VALUES (?)",
+            (
+                (byte,)
+                for byte in range(subspace.begin, subspace.end)
+                if byte not in initialized
+            ),
+        )
+
+    @staticmethod
+    def _find_free_id(
+        cursor, id_space: IDSpace, subspace: IDSubspace
+    ) -> Optional[int]:
+        """Returns a random-ish unused ID from the subspace using its free list, or
+        None if the subspace is full."""
+        namespace = id_space.namespace_name()
+        # The subspace byte is the most significant byte of the id, so the ids of
+        # a subspace form a contiguous range. Seek to a random point of this range
+        # and take the next free id, wrapping around if needed.
+        offset = id_space.subspace_byte_offset()
+        low = subspace.begin << offset
+        high = subspace.end << offset
+        start = low + secrets.randbelow(high - low)
+        for begin in (start, low):
+            cursor.execute(
+                f"""SELECT id FROM {namespace}_free WHERE id >= ? AND id < ?
+                    ORDER BY id LIMIT 1
+                """,
+                (begin, high),
+            )
+            row = cursor.fetchone()
+            if row:
+                return row[0]
+        return None
+
+    def _get_id_in_transaction(
+        self,
+        cursor,
+        description: str,
+        id_space: IDSpace,
+        subspace: IDSubspace,
+        *,
+        atime: datetime,
+        update_atime: bool,
+        keep: AbstractSet[int] = frozenset(),
+    ) -> Optional[int]:
+        """Find or assign an ID for the description. Must be called within a
+        transaction. The IDs in `keep` are not reassigned. Returns None if we failed to
+        find an unused ID and a cleanup is needed."""
+        namespace = id_space.namespace_name()
+        subspace_size = id_space.subspace_size(subspace)
+
+        # First, try to find an existing ID with the given description. It might have
+        # been inserted by another process.
+        cursor.execute(
+            f"""SELECT id FROM {namespace}
+                WHERE description=? AND subspace BETWEEN ? AND ?
+            """,
+            (description, subspace.begin, subspace.end - 1),
+        )
+        row = cursor.fetchone()
+
+        # If there is such a row, update the `atime` and return the `id`.
+        if row:
+            id = row[0]
+            if update_atime:
+                cursor.execute(
+                    f"UPDATE {namespace} SET atime=? WHERE id=?",
+                    (_datetime_to_us(atime), id),
+                )
+            return id
+
+        # If the subspace is small enough, we maintain the list of unused IDs in the
+        # database and pick one of them.
+        if subspace_size <= min(1024, self.max_ids_per_subspace):
+            self._init_free_ids(cursor, id_space, subspace)
+            id = self._find_free_id(cursor, id_space, subspace)
+            if id is None:
+                # The subspace is full, select the oldest row and update it.
+                cursor.execute(
+                    f"""SELECT id FROM {namespace} WHERE subspace BETWEEN ? AND ?
+                        AND id NOT IN (SELECT value FROM json_each(?))
+                        ORDER BY atime ASC LIMIT 1
+                    """,
+                    (subspace.begin, subspace.end - 1, json.dumps(list(keep))),
+                )
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                id = row[0]
+            # Inserting the row removes the id from the free list (via a trigger).
+            self.set_id(
+                id,
+                description=description,
+                atime=atime,
+            )
+            return id
+
+        # If the subspace is too large, try rejection sampling.
+        for j in range(8):
+            id = id_space.gen_random_id(subspace)
+            cursor.execute(f"SELECT id FROM {namespace} WHERE id=?", (id,))
+            if not cursor.fetchone():
+                break
+            id = None
+        # If it succeeded, insert the row and return the id.
+        if id is not None:
+            self.set_id(
+                id,
+                description=description,
+                atime=atime,
+            )
+        return id
+
     def cleanup(
         self,
         id_space: IDSpace,
         subspace: IDSubspace = IDSubspace(),
         max_ids: Optional[int] = None,
+        keep: Iterable[int] = (),
     ):
+        """Removes the least recently used IDs of the subspace until at most `max_ids`
+        remain, except for the IDs in `keep`."""
         if max_ids is None:
             max_ids = self.max_ids_per_subspace
         namespace = id_space.namespace_name()
-        begin, end = id_space.subspace_masked_range(subspace)
         with closing(self.conn.cursor()) as cursor:
             cursor.execute(
                 f"""DELETE FROM {namespace}
                     WHERE id IN (
                         SELECT id FROM {namespace}
-                        WHERE (id & ?) BETWEEN ? AND ?
+                        WHERE subspace BETWEEN ? AND ?
+                        AND id NOT IN (SELECT value FROM json_each(?))
                         ORDER BY atime ASC
                         LIMIT (
                             SELECT MAX(COUNT(*) - ?, 0) FROM {namespace}
-                            WHERE (id & ?) BETWEEN ? AND ?
+                            WHERE subspace BETWEEN ? AND ?
                         )
                     )
                 """,
                 (
-                    id_space.subspace_byte_mask(),
-                    begin,
-                    end - 1,
+                    subspace.begin,
+                    subspace.end - 1,
+                    json.dumps(list(keep)),
                     max_ids,
-                    id_space.subspace_byte_mask(),
-                    begin,
-                    end - 1,
+                    subspace.begin,
+                    subspace.end - 1,
                 ),
             )
 
+    # Selects the columns expected by `_make_upload_info` from `upload` joined with
+    # the counters of its terminal.
+    _UPLOAD_INFO_QUERY = """
+        SELECT upload.id, upload.description, upload.upload_time,
+            COALESCE(upload.size, 0), upload.terminal, upload.status,
+            upload.upload_id, upload_counter.seq - upload.seq + 1,
+            upload_counter.total_bytes - upload.cum_bytes + COALESCE(upload.size, 0)
+        FROM upload JOIN upload_counter ON upload_counter.terminal = upload.terminal
+    """
+
+    @staticmethod
+    def _make_upload_info(row) -> UploadInfo:
+        return UploadInfo(
+            id=row[0],
+            description=row[1],
+            upload_time=_us_to_datetime(row[2]),
+            size=row[3],
+            terminal=row[4],
+            status=row[5],
+            upload_id=row[6],
+            uploads_ago=row[7],
+            bytes_ago=row[8],
+        )
+
     def get_upload_info(self, id: int, terminal: str) -> Optional[UploadInfo]:
         with closing(self.conn.cursor()) as cursor:
             cursor.execute(
-                """
-                SELECT description, upload_time, size, status, upload_id FROM upload
-                WHERE id=? AND terminal=?
+                f"""{self._UPLOAD_INFO_QUERY}
+                    WHERE upload.id=? AND upload.terminal=?
                 """,
                 (id, terminal),
             )
             row = cursor.fetchone()
             if not row:
                 return None
-            description, upload_time_str, size, status, upload_id = row
-            if size is None:
-                size = 0
-            cursor.execute(
-                """
-                SELECT COUNT(*), SUM(size) FROM upload
-                WHERE terminal = ? AND upload_time > ?
-                """,
-                (terminal, upload_time_str),
-            )
-            uploads_ago, bytes_ago = cursor.fetchone()
-        return UploadInfo(
-            id=id,
-            description=description,
-            upload_time=datetime.fromisoformat(upload_time_str),
-            terminal=terminal,
-            size=size,
-            bytes_ago=size + (bytes_ago if bytes_ago else 0),
-            uploads_ago=1 + (uploads_ago if uploads_ago else 0),
-            status=status,
-            upload_id=upload_id,
-        )
+            return self._make_upload_info(row)
 
     def get_upload_infos(self, id: int) -> List[UploadInfo]:
         with closing(self.conn.cursor()) as cursor:
             cursor.execute(
-                """
-                SELECT terminal FROM upload
-                WHERE id=?
-                """,
+                f"{self._UPLOAD_INFO_QUERY} WHERE upload.id=?",
                 (id,),
             )
-            res = []
-            for row in cursor.fetchall():
-                terminal = row[0]
-                upload_info = self.get_upload_info(id, terminal)
-                if upload_info:
-                    res.append(upload_info)
-            return res
+            return [self._make_upload_info(row) for row in cursor.fetchall()]
 
     def needs_uploading(
         self,
@@ -803,12 +1386,53 @@ class IDManager:
         info = self.get_info(id)
         if info is None:
             return False
-        upload_info = self.get_upload_info(id, terminal)
+        return self._needs_uploading(
+            info.description,
+            self.get_upload_info(id, terminal),
+            max_uploads_ago=max_uploads_ago,
+            max_bytes_ago=max_bytes_ago,
+            max_time_ago=max_time_ago,
+        )
+
+    def needs_uploading_many(
+        self,
+        ids: List[int],
+        terminal: str,
+        *,
+        max_uploads_ago: int = 1024,
+        max_bytes_ago: int = 20 * (2**20),
+        max_time_ago: timedelta = timedelta(hours=1),
+    ) -> List[bool]:
+        """Same as `needs_uploading`, but for multiple IDs at once. The upload history
+        of the terminal is queried only once."""
+        descriptions = self._get_descriptions(ids)
+        upload_infos = self._get_terminal_upload_infos(terminal, ids)
+        return [
+            id in descriptions
+            and self._needs_uploading(
+                descriptions[id],
+                upload_infos.get(id),
+                max_uploads_ago=max_uploads_ago,
+                max_bytes_ago=max_bytes_ago,
+                max_time_ago=max_time_ago,
+            )
+            for id in ids
+        ]
+
+    @staticmethod
+    def _needs_uploading(
+        description: str,
+        upload_info: Optional[UploadInfo],
+        *,
+        max_uploads_ago: int,
+        max_bytes_ago: int,
+        max_time_ago: timedelta,
+    ) -> bool:
         if upload_info is None:
             return True
         return (
             upload_info.status != UPLOADING_STATUS_UPLOADED
-            or upload_info.description != info.description
+            or upload_info.description != description
             or upload_info._needs_uploading(
                 max_uploads_ago=max_uploads_ago,
                 max_bytes_ago=max_bytes_ago,
@@ -816,6 +1440,37 @@ class IDManager:
             )
         )
 
+    def _get_descriptions(self, ids: Iterable[int]) -> Dict[int, str]:
+        """Returns the descriptions of the given IDs that are assigned."""
+        res = {}
+        with closing(self.conn.cursor()) as cursor:
+            for namespace, namespace_ids in self._group_by_namespace(ids).items():
+                cursor.execute(
+                    f"""SELECT id, description FROM {namespace}
+                        WHERE id IN (SELECT value FROM json_each(?))
+                    """,
+                    (json.dumps(namespace_ids),),
+                )
+                res.update(cursor.fetchall())
+        return res
+
+    def _get_terminal_upload_infos(
+        self, terminal: str, ids: Iterable[int]
+    ) -> Dict[int, UploadInfo]:
+        """Returns the upload infos of the given IDs for the given terminal."""
+        res = {}
+        with closing(self.conn.cursor()) as cursor:
+            cursor.execute(
+                f"""{self._UPLOAD_INFO_QUERY}
+                    WHERE upload.terminal=?
+                        AND upload.id IN (SELECT value FROM json_each(?))
+                """,
+                (terminal, json.dumps(list(set(ids)))),
+            )
+            for row in cursor:
+                res[row[0]] = self._make_upload_info(row)
+        return res
+
     def _create_new_upload_entry(
         self,
         cursor,
@@ -826,28 +1481,51 @@ class IDManager:
         size: int,
         upload_time: datetime,
         upload_id: int,
+        chunked: bool,
+        locked: bool,
     ) -> UploadInfo:
         """Create a new upload entry in the database and return the corresponding UploadInfo."""
+        # Count the upload in the counters of the terminal.
+        cursor.execute(
+            """
+            INSERT INTO upload_counter (terminal, seq, total_bytes) VALUES (?, 1, ?)
+            ON CONFLICT(terminal) DO UPDATE SET
+                seq=seq + 1,
+                total_bytes=total_bytes + excluded.total_bytes
+            RETURNING seq, total_bytes
+            """,
+            (terminal, size),
+        )
+        seq, cum_bytes = cursor.fetchone()
         cursor.execute(
             """
             INSERT INTO upload
-            (id, description, size, terminal, upload_time, status, upload_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            (id, description, size, terminal, upload_time, status, upload_id, seq,
+             cum_bytes, chunked, locked)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ON CONFLICT(id, terminal) DO UPDATE SET
                 description=excluded.description,
                 size=excluded.size,
                 upload_time=excluded.upload_time,
                 status=excluded.status,
-                upload_id=excluded.upload_id
+                upload_id=excluded.upload_id,
+                seq=excluded.seq,
+                cum_bytes=excluded.cum_bytes,
+                chunked=excluded.chunked,
+                locked=excluded.locked
             """,
             (
                 id,
                 description,
                 size,
                 terminal,
-                upload_time.isoformat(),
+                _datetime_to_us(upload_time),
                 UPLOADING_STATUS_IN_PROGRESS,
                 upload_id,
+                seq,
+                cum_bytes,
+                int(chunked),
+                int(locked),
             ),
         )
         return UploadInfo(
@@ -873,13 +1551,17 @@ class IDManager:
         stall_timeout: float = 1.0,
         force_upload: bool = False,
         allow_concurrent_uploads: bool = False,
+        chunked: bool = True,
     ) -> UploadInfo:
         """Marks an upload as 'in_progress' and sets its size and time. Returns the
         upload info.
 
         This function check if another upload of the same id is already in progress. If
         it is in progress, it tries to check whether it's alive by waiting for
-        `stall_timeout` seconds. This check is repeated until either:
+        `stall_timeout` seconds, or until the uploader releases its upload lock. If the
+        uploader took the lock but doesn't hold it anymore, it's considered dead unless
+        the upload has changed in the meantime. Uploaders that couldn't take the lock
+        are checked only by waiting. This check is repeated until either:
         - The concurrent upload finishes successfully. Then there is nothing to do and
           we return the finished upload info of the concurrent upload.
         - The concurrent upload finishes unsuccessfully or doesn't seem to be alive.
@@ -893,6 +1575,13 @@ class IDManager:
             allow_concurrent_uploads: If `True`, active uploads with a different ID
             don't interfere with the current upload. If `False`, wait for the active
             upload to finish before starting the new one.
+
+            chunked: Whether the upload is a stream of chunks that can't be
+            interleaved with other transmissions (i.e. a direct transmission). When
+            `allow_concurrent_uploads` is `False`, every upload waits while a chunked
+            upload to the terminal is in progress, since even a single command would
+            break its stream. Uploads that are sent as a single command (e.g.
+            file-based ones) don't make other uploads wait.
         """
         if upload_time is None:
             upload_time = datetime.now()
@@ -903,37 +1592,39 @@ class IDManager:
         # The upload time seen in the previous iteration.
         existing_upload_time = None
 
-        first_iteration = True
+        # The upload we are waiting for: (id, terminal, whether the uploader took its
+        # lock), or None in the first iteration.
+        waiting_for: Optional[Tuple[int, str, bool]] = None
+        # Whether the last wait ended because the concurrent upload finished. In this
+        # case an unchanged upload time doesn't mean that the upload is stalled.
+        woken_up = False
 
         # TODO: Maybe add a total timeout in case the other process is faking image
         #       upload.
         while True:
-            if not first_iteration:
-                time.sleep(stall_timeout)
-            first_iteration = False
+            if waiting_for is not None:
+                wait_id, wait_terminal, locked = waiting_for
+                woken_up = self._wait_for_upload(
+                    wait_id, wait_terminal, locked=locked, timeout=stall_timeout
+                )
             with self.conn:
                 with closing(self.conn.cursor()) as cursor:
                     cursor.execute("BEGIN IMMEDIATE")
 
-                    # If terminal-wide locking is enabled, check for any active uploads
-                    # to this terminal.
+                    # If terminal-wide locking is enabled, check for any active chunked
+                    # uploads to this terminal. Nothing may be sent while a chunk stream
+                    # is open, not even a single command.
                     if not allow_concurrent_uploads:
-                        cursor.execute(
-                            """
-                            SELECT id, upload_time FROM upload
-                            WHERE terminal=? AND status=?
-                            ORDER BY upload_time DESC LIMIT 1
-                            """,
-                            (terminal, UPLOADING_STATUS_IN_PROGRESS),
-                        )
-                        row = cursor.fetchone()
+                        row = self._get_chunked_upload_in_progress(cursor, terminal)
 
                         if row:
                             # There's an active upload.
-                            active_id = row[0]
-                            active_upload_time = datetime.fromisoformat(row[1])
+                            active_id, active_upload_time, active_locked = row
                             # Check if the upload is stalled
-                            if existing_upload_time == active_upload_time:
+                            if (
+                                existing_upload_time == active_upload_time
+                                and not woken_up
+                            ):
                                 # The upload appears stalled, mark it as dirty
                                 cursor.execute(
                                     """UPDATE upload SET status=?
@@ -943,16 +1634,18 @@ class IDManager:
                             else:
                                 # Try again.
                                 existing_upload_time = active_upload_time
+                                waiting_for = (active_id, terminal, active_locked)
                                 continue
 
                     # Check if there's an existing upload entry for this specific ID
                     cursor.execute(
-                        """SELECT description, upload_time, size, status, upload_id
+                        """SELECT description, upload_time, size, status, upload_id,
+                                  locked
                            FROM upload WHERE id=? AND terminal=?""",
                         (id, terminal),
                     )
                     row = cursor.fetchone()
-                    active_upload_time = datetime.fromisoformat(row[1]) if row else None
+                    active_upload_time = _us_to_datetime(row[1]) if row else None
 
                     # Create a new upload entry if:
                     # - there is no existing entry, or
@@ -968,9 +1661,11 @@ class IDManager:
                             row[3] == UPLOADING_STATUS_UPLOADED
                             and row[0] != description
                         )
-                        or existing_upload_time == active_upload_time
+                        or (existing_upload_time == active_upload_time and not woken_up)
                         or (force_upload and row[3] != UPLOADING_STATUS_IN_PROGRESS)
                     ):
+                        # Let other processes know when the upload finishes.
+                        locked = self._acquire_upload_lock(id, terminal)
                         return self._create_new_upload_entry(
                             cursor,
                             id,
@@ -979,10 +1674,12 @@ class IDManager:
                             size=size,
                             upload_time=upload_time,
                             upload_id=new_upload_id,
+                            chunked=chunked,
+                            locked=locked,
                         )
 
                     # Parse existing row data
-                    existing_description, _, existing_size, status, upload_id = row
+                    existing_description, _, existing_size, status, upload_id, _ = row
                     assert active_upload_time is not None
                     existing_upload_time = active_upload_time
 
@@ -1009,8 +1706,140 @@ class IDManager:
                             upload_id=upload_id,
                         )
 
-            # Otherwise the upload is in progress. Exit the transaction and try again
-            # after a short delay.
+                    waiting_for = (id, terminal, bool(row[5]))
+
+            # Otherwise the upload is in progress. Exit the transaction, wait for the
+            # upload to finish or to stall, and try again.
+
+    @staticmethod
+    def _get_chunked_upload_in_progress(
+        cursor, terminal: str
+    ) -> Optional[Tuple[int, datetime, bool]]:
+        """Returns the ID, the upload time and whether the uploader took its lock for
+        the most recent chunked upload to `terminal` that is in progress, if any."""
+        cursor.execute(
+            f"""
+            SELECT id, upload_time, locked FROM upload
+            WHERE terminal=?
+                AND status='{UPLOADING_STATUS_IN_PROGRESS}'
+                AND chunked=1
+            ORDER BY upload_time DESC LIMIT 1
+            """,
+            (terminal,),
+        )
+        row = cursor.fetchone()
+        return (row[0], _us_to_datetime(row[1]), bool(row[2])) if row else None
+
+    def wait_for_chunked_uploads(self, terminal: str, *, stall_timeout: float = 1.0):
+        """Waits until no chunked upload to `terminal` is in progress, so that a
+        command can be sent without breaking a chunk stream. Uploads that seem to be
+        stalled are marked dirty, the same way as in `start_upload`."""
+        existing_upload_time = None
+        woken_up = False
+        while True:
+            with self.conn:
+                with closing(self.conn.cursor()) as cursor:
+                    cursor.execute("BEGIN IMMEDIATE")
+                    row = self._get_chunked_upload_in_progress(cursor, terminal)
+                    if row is None:
+                        return
+                    active_id, active_upload_time, active_locked = row
+                    if existing_upload_time == active_upload_time and not woken_up:
+                        cursor.execute(
+                            """UPDATE upload SET status=?
+                               WHERE terminal=? AND id=?""",
+                            (UPLOADING_STATUS_DIRTY, terminal, active_id),
+                        )
+                        existing_upload_time = None
+                        continue
+                    existing_upload_time = active_upload_time
+            woken_up = self._wait_for_upload(
+                active_id, terminal, locked=active_locked, timeout=stall_timeout
+            )
+
+    def _upload_lock_path(self, id: int, terminal: str) -> Optional[str]:
+        """Returns the path of the lock file that is locked while `id` is being
+        uploaded to `terminal`, or None if the database is not a file. Uploads are
+        hashed into a fixed number of lock files, so unrelated uploads may share one."""
+        if self._pool_key is None:
+            return None
+        slot = zlib.crc32(f"{id}:{terminal}".encode("utf-8")) % _UPLOAD_LOCK_SLOTS
+        return os.path.join(f"{self.database_file}.locks", f"{slot}.lock")
+
+    def _open_upload_lock(self, id: int, terminal: str) -> Optional[int]:
+        path = self._upload_lock_path(id, terminal)
+        if path is None:
+            return None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return None
+
+    def _acquire_upload_lock(self, id: int, terminal: str) -> bool:
+        """Locks the upload lock of `id` and `terminal` until `_release_upload_lock`
+        is called or the process dies. Returns whether the lock was taken. Never
+        blocks: if the lock is busy (e.g. another upload hashes to the same lock file),
+        we just proceed without it, and waiters fall back to detecting that the upload
+        has finished by polling."""
+        if (id, terminal) in self._upload_locks:
+            return True
+        fd = self._open_upload_lock(id, terminal)
+        if fd is None:
+            return False
+        # Waiters take a shared lock for a moment to check whether the lock is held,
+        # so retry a couple of times before giving up.
+        for attempt in range(3):
+            if attempt:
+                time.sleep(_UPLOAD_LOCK_POLL_INTERVAL)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            except OSError:
+                break
+            self._upload_locks[(id, terminal)] = fd
+            return True
+        os.close(fd)
+        return False
+
+    def _release_upload_lock(self, id: int, terminal: str):
+        fd = self._upload_locks.pop((id, terminal), None)
+        if fd is not None:
+            # Closing the file releases the lock.
+            os.close(fd)
+
+    def _wait_for_upload(
+        self, id: int, terminal: str, *, locked: bool, timeout: float
+    ) -> bool:
+        """Waits until the upload of `id` to `terminal` is finished by the process
+        holding its upload lock, or for `timeout` seconds. `locked` tells whether the
+        uploader took the lock. Returns True if the lock was released before the
+        timeout, and False on timeout or if the uploader took the lock but doesn't hold
+        it anymore (in which case it returns immediately)."""
+        fd = self._open_upload_lock(id, terminal) if locked else None
+        if fd is None:
+            time.sleep(timeout)
+            return False
+        try:
+            deadline = time.monotonic() + timeout
+            first_attempt = True
+            while True:
+                try:
+                    # A shared lock, so that waiters don't block each other.
+                    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        return False
+                    first_attempt = False
+                    time.sleep(_UPLOAD_LOCK_POLL_INTERVAL)
+                    continue
+                # If nobody held the lock in the first place, the uploader has either
+                # finished or died since we looked at the upload. There is nothing to
+                # wait for: the caller will see whether the upload has changed.
+                return not first_attempt
+        finally:
+            os.close(fd)
 
     def report_upload(
         self,
@@ -1090,13 +1919,15 @@ class IDManager:
                     WHERE id=? AND terminal=? AND upload_id=?
                     """,
                     (
-                        upload_time.isoformat(),
+                        _datetime_to_us(upload_time),
                         set_status,
                         upload.id,
                         upload.terminal,
                         upload.upload_id,
                     ),
                 )
+        if set_status != UPLOADING_STATUS_IN_PROGRESS:
+            self._release_upload_lock(upload.id, upload.terminal)
 
     def retry_uploading_until_success(
         self,
@@ -1111,6 +1942,7 @@ class IDManager:
         force_upload: bool = False,
         allow_concurrent_uploads: bool = False,
         mark_uploaded: bool = True,
+        chunked: bool = True,
     ):
         """Retries uploading the given id by calling `fn` until it succeeds or the
         maximum number of retries is reached or the error is unrecoverable.
@@ -1128,6 +1960,8 @@ class IDManager:
             allow_concurrent_uploads: If `True`, active uploads with a different ID
             don't interfere with the current upload. If `False`, wait for the active
             upload to finish before starting the new one.
+
+            chunked: Whether the upload is a stream of chunks, see `start_upload`.
         """
         set_status = (
             UPLOADING_STATUS_UPLOADED if mark_uploaded else UPLOADING_STATUS_DIRTY
@@ -1141,6 +1975,7 @@ class IDManager:
                 stall_timeout=stall_timeout,
                 force_upload=force_upload,
                 allow_concurrent_uploads=allow_concurrent_uploads,
+                chunked=chunked,
             )
             if upload.status == UPLOADING_STATUS_UPLOADED:
                 # The upload was done by another process, do nothing.
@@ -1156,13 +1991,16 @@ class IDManager:
                 return
             except RetryUploadError:
                 pass
+            finally:
+                self._release_upload_lock(id, terminal)
             # If the upload failed, wait a bit and retry.
             self._wait_random_time()
         raise RuntimeError(f"Could not upload the image with id {id} to {terminal}.")
 
     def _wait_random_time(self):
-        """Waits for a random time between 0 and 0.5 seconds."""
-        time.sleep(random.uniform(0, 0.5))
+        """Waits for a random time between 0 and 0.05 seconds. Concurrent uploads are
+        waited for in `start_upload`, this is only to desynchronize retries."""
+        time.sleep(random.uniform(0, 0.05))
 
     def mark_uploaded_for_testing(
         self,
@@ -1188,20 +2026,52 @@ class IDManager:
 
     def mark_dirty(self, id: int, terminal: Optional[str] = None):
         """Marks id dirty (not uploaded) in the given terminal or all terminals."""
+        self.mark_dirty_many([id], terminal)
+
+    def mark_dirty_many(self, ids: Iterable[int], terminal: Optional[str] = None):
+        """Marks the given IDs dirty in the given terminal or all terminals with a
+        single statement."""
         with closing(self.conn.cursor()) as cursor:
             # Note that we don't delete rows, because we need them to figure out whether
             # earlier uploads are too old.
+            ids_json = json.dumps(list(set(ids)))
             if terminal is None:
                 cursor.execute(
-                    "UPDATE upload SET status = ? WHERE id = ?",
-                    (UPLOADING_STATUS_DIRTY, id),
+                    """UPDATE upload SET status = ?
+                       WHERE id IN (SELECT value FROM json_each(?))
+                    """,
+                    (UPLOADING_STATUS_DIRTY, ids_json),
                 )
             else:
                 cursor.execute(
-                    "UPDATE upload SET status = ? WHERE id = ? and terminal = ?",
-                    (UPLOADING_STATUS_DIRTY, id, terminal),
+                    """UPDATE upload SET status = ?
+                       WHERE id IN (SELECT value FROM json_each(?)) and terminal = ?
+                    """,
+                    (UPLOADING_STATUS_DIRTY, ids_json, terminal),
                 )
 
+    def get_terminal_property(self, terminal: str, name: str) -> Optional[str]:
+        """Returns the value of the property `name` of the terminal, or None if it
+        wasn't set."""
+        with closing(self.conn.cursor()) as cursor:
+            cursor.execute(
+                "SELECT value FROM terminal_property WHERE terminal=? AND name=?",
+                (terminal, name),
+            )
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def set_terminal_property(self, terminal: str, name: str, value: str):
+        """Sets the property `name` of the terminal, see `get_terminal_property`."""
+        with closing(self.conn.cursor()) as cursor:
+            cursor.execute(
+                """INSERT INTO terminal_property (terminal, name, value)
+                   VALUES (?, ?, ?)
+                   ON CONFLICT(terminal, name) DO UPDATE SET value=excluded.value
+                """,
+                (terminal, name, value),
+            )
+
     def cleanup_uploads(
         self,
         max_uploads: int = 1024,
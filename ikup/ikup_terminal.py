@@ -1,5 +1,7 @@
+import concurrent.futures
 import dataclasses
 import datetime
+import functools
 import hashlib
 import io
 import json
@@ -7,19 +9,25 @@ import math
 import os
 import re
 import select
+import shutil
+import struct
 import subprocess
 import tempfile
 import typing
 import time
 import random
+import zlib
 from dataclasses import dataclass, field
 from typing import (
     Any,
     BinaryIO,
     Callable,
+    Dict,
+    Iterator,
     List,
     Literal,
     Optional,
+    Set,
     Tuple,
     Union,
     TYPE_CHECKING,
@@ -32,6 +40,8 @@ import ikup
 from ikup.id_manager import ImageInfo, UploadInfo, RetryAssignIdError
 import ikup.utils
 from ikup.terminal_detection import detect_terminal_info
+from ikup.image_header import probe_image
+from ikup.transcode_cache import TranscodeCache
 from ikup import (
     GraphicsCommand,
     GraphicsResponse,
@@ -52,6 +62,7 @@ if TYPE_CHECKING:
     from PIL import Image
 
 BackgroundLike = Union[ikup.AdditionalFormatting, str, int, None]
+UploadEncoding = Literal["png", "raw", "zlib"]
 FinalCursorPos = Literal["top-left", "top-right", "bottom-left", "bottom-right"]
 
 
@@ -66,6 +77,7 @@ class IkupConfig:
     id_subspace: IDSubspace = IDSubspace()
     max_ids_per_subspace: int = 1024
     id_database_dir: str = platformdirs.user_state_dir("ikup")
+    id_atime_update_interval: float = 0.0
 
     # Image geometry options.
     cell_size: Union[Tuple[int, int], Literal["auto"]] = "auto"
@@ -92,6 +104,9 @@ class IkupConfig:
     redetect_terminal: bool = True
     stream_max_size: int = 2 * 1024 * 1024
     file_max_size: int = 10 * 1024 * 1024
+    transcode_cache_max_bytes: int = 256 * 1024 * 1024
+    upload_encoding: Union[UploadEncoding, Literal["auto"]] = "auto"
+    upload_zlib_level: Union[int, Literal["auto"]] = "auto"
 
     # Image display options.
     fewer_diacritics: bool = False
@@ -116,6 +131,9 @@ class IkupConfig:
     upload_stall_timeout: float = 2.0
     allow_concurrent_uploads: Union[bool, Literal["auto"]] = "auto"
     upload_command_delay: float = 0.0
+    upload_chunks_per_write: Union[int, Literal["adaptive"]] = 1
+    max_prepare_workers: Union[int, Literal["auto"]] = "auto"
+    prepare_pool_type: Literal["process", "thread"] = "process"
 
     def __post_init__(self):
         self._provenance = {}
@@ -237,9 +255,17 @@ class IkupConfig:
 
         provenance = f"({provenance})" if provenance else "(set in code)"
 
+        # Literal string values (like "auto") are kept as is.
+        literal_values = [
+            arg
+            for t in types_in_union
+            if typing.get_origin(t) is Literal
+            for arg in typing.get_args(t)
+        ]
+
         # Normalize values specified as strings.
         try:
-            if isinstance(value, str) and value != "auto":
+            if isinstance(value, str) and value not in literal_values + ["auto"]:
                 if IDSubspace in types_in_union:
                     value = IDSubspace.from_string(value)
                 if IDSpace in types_in_union:
@@ -293,6 +319,10 @@ class IkupConfig:
                     "{name} must be positive and not greater than 256:"
                     f" '{value}' {provenance}"
                 )
+            if name == "upload_zlib_level" and not (0 <= value <= 9):
+                raise ValidationError(
+                    f"{name} must be between 0 and 9: '{value}' {provenance}"
+                )
 
         return value
 
@@ -340,6 +370,9 @@ class ImageInstance:
     rows: int
     id: int
     image: Optional["Image.Image"] = None
+    # The box (left, top, right, bottom) in pixels of the source image if the instance
+    # is a tile of a larger image.
+    crop: Optional[Tuple[int, int, int, int]] = None
 
     def clone_with(self, **kwargs):
         return dataclasses.replace(self, **kwargs)
@@ -348,6 +381,7 @@ class ImageInstance:
     def from_info(info: ImageInfo) -> Optional["ImageInstance"]:
         try:
             params = json.loads(info.description)
+            crop = params.get("crop")
             return ImageInstance(
                 path=params.get("path"),
                 mtime=datetime.datetime.fromtimestamp(float(params.get("mtime"))),
@@ -355,21 +389,36 @@ class ImageInstance:
                 rows=int(params.get("rows")),
                 id=info.id,
                 id_atime=info.atime,
+                crop=tuple(int(x) for x in crop) if crop is not None else None,
             )
         except (json.JSONDecodeError, KeyError, ValueError, TypeError):
             return None
 
     @staticmethod
     def build_descr_string(
-        path: str, mtime: datetime.datetime, cols: int, rows: int
+        path: str,
+        mtime: datetime.datetime,
+        cols: int,
+        rows: int,
+        crop: Optional[Tuple[int, int, int, int]] = None,
     ) -> str:
-        return json.dumps(
-            {"path": path, "mtime": mtime.timestamp(), "cols": cols, "rows": rows}
-        )
+        params: dict = {
+            "path": path,
+            "mtime": mtime.timestamp(),
+            "cols": cols,
+            "rows": rows,
+        }
+        if crop is not None:
+            params["crop"] = list(crop)
+        return json.dumps(params)
 
     def get_description(self):
         return self.build_descr_string(
-            path=self.path, mtime=self.mtime, cols=self.cols, rows=self.rows
+            path=self.path,
+            mtime=self.mtime,
+            cols=self.cols,
+            rows=self.rows,
+            crop=self.crop,
         )
 
     def is_file_available(self) -> bool:
@@ -390,6 +439,467 @@ class ImageInstance:
 ImageOrFilename = Union["PIL.Image.Image", str]
 
 
+@dataclass
+class PreparedUpload:
+    """The payload of an upload, as produced by `prepare_upload`."""
+
+    # The name of the file to transmit or the encoded image.
+    data: Union[str, bytes]
+    size: int
+    medium: TransmissionMedium
+    pix_width: Optional[int] = None
+    pix_height: Optional[int] = None
+    format: ikup.Format = ikup.Format.PNG
+    compression: Optional[ikup.Compression] = None
+
+
+@dataclass
+class FailedUpload:
+    """An upload sent with response checking that the terminal didn't accept."""
+
+    inst: ImageInstance
+    # The error response, or None if the terminal didn't respond in time.
+    response: Optional[GraphicsResponse] = None
+
+    @property
+    def message(self) -> str:
+        if self.response is None:
+            return "No response from the terminal"
+        return self.response.message
+
+
+# The number of uploads awaiting responses after which we wait for the responses
+# instead of sending more uploads.
+MAX_IN_FLIGHT_UPLOADS = 256
+
+# The directory where POSIX shared memory objects live on Linux.
+SHARED_MEMORY_DIR = "/dev/shm"
+
+# The terminal property (see `IDManager.get_terminal_property`) storing whether the
+# terminal supports shared memory transmissions, "1" or "0".
+SHARED_MEMORY_PROPERTY = "supports_shared_memory"
+
+# The terminal property storing the observed throughput of direct uploads, in payload
+# bytes per second.
+DIRECT_UPLOAD_THROUGHPUT_PROPERTY = "direct_upload_throughput"
+# Direct uploads smaller than this are dominated by latency, so they are not used to
+# estimate the throughput.
+MIN_THROUGHPUT_SAMPLE_SIZE = 256 * 1024
+
+# The number and the size of the slices of raw pixels compressed by
+# `choose_raw_encoding` to estimate the cost of compression.
+ZLIB_SAMPLE_SLICES = 16
+ZLIB_SAMPLE_SLICE_SIZE = 4096
+
+# Raw pixel payloads don't carry their dimensions, so in the transcode cache they are
+# prefixed with a header: a magic, the width and the height of the image, the pixel
+# format and whether the pixels are compressed with zlib.
+_RAW_PAYLOAD_MAGIC = b"ikup"
+_RAW_PAYLOAD_HEADER = struct.Struct("<4sIIBB")
+
+
+def create_shared_memory(data: bytes) -> str:
+    """Creates a POSIX shared memory object containing `data` and returns its name.
+    The terminal unlinks the object after reading it."""
+    name = f"/ikup-{os.getpid()}-{random.getrandbits(64):016x}"
+    fd = os.open(
+        os.path.join(SHARED_MEMORY_DIR, name[1:]),
+        os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+        0o600,
+    )
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return name
+
+
+def link_shared_memory(name: str) -> str:
+    """Creates a new name for the shared memory object `name` without copying it and
+    returns it. The terminal unlinks the name it receives, so each transmission of
+    the same object needs a name of its own."""
+    new_name = f"/ikup-{os.getpid()}-{random.getrandbits(64):016x}"
+    os.link(
+        os.path.join(SHARED_MEMORY_DIR, name.lstrip("/")),
+        os.path.join(SHARED_MEMORY_DIR, new_name[1:]),
+    )
+    return new_name
+
+
+def unlink_shared_memory(name: str):
+    """Removes the shared memory object if the terminal hasn't done it yet."""
+    try:
+        os.unlink(os.path.join(SHARED_MEMORY_DIR, name.lstrip("/")))
+    except FileNotFoundError:
+        pass
+
+
+def choose_raw_encoding(
+    data: bytes, zlib_level: int, link_throughput: float
+) -> UploadEncoding:
+    """Chooses whether to send the raw pixels `data` as is or compressed with zlib over
+    a link with the given throughput (in bytes per second). Compresses a sample of the
+    data to measure the cost and the ratio of compression on this machine and picks
+    the encoding that takes less time to compress and send."""
+    if len(data) <= ZLIB_SAMPLE_SLICES * ZLIB_SAMPLE_SLICE_SIZE:
+        sample = data
+    else:
+        # Take the slices from all over the image, its parts may differ a lot.
+        step = len(data) // ZLIB_SAMPLE_SLICES
+        sample = b"".join(
+            data[i * step : i * step + ZLIB_SAMPLE_SLICE_SIZE]
+            for i in range(ZLIB_SAMPLE_SLICES)
+        )
+    start = time.perf_counter()
+    compressed_size = len(zlib.compress(sample, zlib_level))
+    compression_time = time.perf_counter() - start
+    zlib_time = compression_time + compressed_size / link_throughput
+    if zlib_time < len(sample) / link_throughput:
+        return "zlib"
+    return "raw"
+
+
+def _raw_cache_encoding(
+    encoding: Union[UploadEncoding, Literal["auto"]], zlib_level: int
+) -> Optional[str]:
+    """Returns the encoding part of the transcode cache key, None for PNG payloads."""
+    if encoding == "png":
+        return None
+    if encoding == "raw":
+        return encoding
+    return f"{encoding}:{zlib_level}"
+
+
+def _pack_raw_payload(prepared: PreparedUpload) -> bytes:
+    assert isinstance(prepared.data, bytes)
+    header = _RAW_PAYLOAD_HEADER.pack(
+        _RAW_PAYLOAD_MAGIC,
+        prepared.pix_width,
+        prepared.pix_height,
+        prepared.format.value,
+        prepared.compression is not None,
+    )
+    return header + prepared.data
+
+
+def _read_raw_payload(
+    path: str, medium: TransmissionMedium
+) -> Optional[PreparedUpload]:
+    """Reads a raw pixel payload stored by `_pack_raw_payload`. Returns None if the
+    file is not such a payload."""
+    with open(path, "rb") as f:
+        header = f.read(_RAW_PAYLOAD_HEADER.size)
+        if len(header) < _RAW_PAYLOAD_HEADER.size:
+            return None
+        magic, width, height, format, compressed = _RAW_PAYLOAD_HEADER.unpack(header)
+        if magic != _RAW_PAYLOAD_MAGIC:
+            return None
+        data = f.read()
+    return PreparedUpload(
+        data=data,
+        size=len(data),
+        medium=medium,
+        pix_width=width,
+        pix_height=height,
+        format=ikup.Format(format),
+        compression=ikup.Compression.ZLIB if compressed else None,
+    )
+
+
+def _convert_to_raw_mode(
+    image_object: "Image.Image",
+) -> Tuple["Image.Image", ikup.Format]:
+    """Converts the image to RGB or RGBA (if it has transparency), the pixel formats
+    supported by the protocol."""
+    if "A" in image_object.getbands() or "transparency" in image_object.info:
+        mode, format = "RGBA", ikup.Format.RGBA
+    else:
+        mode, format = "RGB", ikup.Format.RGB
+    if image_object.mode != mode:
+        image_object = image_object.convert(mode)
+    return image_object, format
+
+
+def _prepare_shared_memory_upload(
+    image: ImageOrFilename,
+    max_upload_size: int,
+    crop: Optional[Tuple[int, int, int, int]] = None,
+) -> PreparedUpload:
+    """Decodes the image to raw pixels and puts them into a shared memory object. The
+    object is consumed by the terminal, so we never cache it."""
+    from PIL import Image
+
+    image_object = Image.open(image) if isinstance(image, str) else image
+    if crop is not None:
+        image_object = image_object.crop(crop)
+    image_object, format = _convert_to_raw_mode(image_object)
+    width, height = image_object.size
+    image_bytes = width * height * (format.value / 8)
+    if image_bytes > max_upload_size:
+        ratio = math.sqrt(max_upload_size / image_bytes)
+        width = max(1, math.floor(width * ratio))
+        height = max(1, math.floor(height * ratio))
+        image_object = image_object.resize((width, height))
+    data = image_object.tobytes()
+    return PreparedUpload(
+        data=create_shared_memory(data),
+        size=len(data),
+        medium=TransmissionMedium.SHARED_MEMORY,
+        pix_width=width,
+        pix_height=height,
+        format=format,
+    )
+
+
+def prepare_upload_without_decoding(
+    image: ImageOrFilename,
+    upload_method: TransmissionMedium,
+    max_upload_size: int,
+    supported_formats: List[str],
+    cache: Optional[TranscodeCache] = None,
+    crop: Optional[Tuple[int, int, int, int]] = None,
+    encoding: Union[UploadEncoding, Literal["auto"]] = "png",
+    zlib_level: int = 6,
+) -> Optional[PreparedUpload]:
+    """Returns the prepared upload if it's cheap to prepare, i.e. the image is a file
+    that can be sent as is or its re-encoded version is in `cache`. Returns None if
+    the image has to be decoded, which is done by `prepare_upload`."""
+    if not isinstance(image, str) or upload_method == TransmissionMedium.SHARED_MEMORY:
+        return None
+
+    # Raw pixels are cached only for direct uploads, the terminal deletes the
+    # temporary files they are sent in otherwise.
+    if encoding != "png" and upload_method != TransmissionMedium.DIRECT:
+        cache = None
+
+    if cache is not None:
+        cache_key = cache.make_key(
+            image,
+            upload_method,
+            max_upload_size,
+            supported_formats,
+            crop,
+            _raw_cache_encoding(encoding, zlib_level),
+        )
+        cached_path = cache.get(cache_key) if cache_key is not None else None
+        if cached_path is not None and encoding != "png":
+            prepared = _read_raw_payload(cached_path, upload_method)
+            if prepared is not None:
+                return prepared
+        elif cached_path is not None:
+            size = os.path.getsize(cached_path)
+            if upload_method == TransmissionMedium.FILE:
+                return PreparedUpload(data=cached_path, size=size, medium=upload_method)
+            header = probe_image(cached_path)
+            return PreparedUpload(
+                data=cached_path,
+                size=size,
+                medium=upload_method,
+                pix_width=header.width if header else None,
+                pix_height=header.height if header else None,
+            )
+
+    # If the file can be sent as is, we don't need PIL at all.
+    if crop is None:
+        header = probe_image(image)
+        if header is not None and header.format.lower() in supported_formats:
+            size = os.path.getsize(image)
+            if size <= max_upload_size:
+                return PreparedUpload(data=image, size=size, medium=upload_method)
+    return None
+
+
+def discard_upload_data(data: Union[str, bytes], medium: TransmissionMedium):
+    """Removes the temporary file or the shared memory object of a prepared upload
+    that will never be transmitted. The terminal removes them only when it receives
+    the command."""
+    if medium == TransmissionMedium.TEMP_FILE:
+        assert isinstance(data, str)
+        try:
+            os.remove(data)
+        except FileNotFoundError:
+            pass
+    elif medium == TransmissionMedium.SHARED_MEMORY:
+        assert isinstance(data, str)
+        unlink_shared_memory(data)
+
+
+def prepare_upload(
+    image: ImageOrFilename,
+    upload_method: TransmissionMedium,
+    max_upload_size: int,
+    supported_formats: List[str],
+    cache: Optional[TranscodeCache] = None,
+    encoding: Union[UploadEncoding, Literal["auto"]] = "png",
+    zlib_level: int = 6,
+    crop: Optional[Tuple[int, int, int, int]] = None,
+    link_throughput: Optional[float] = None,
+) -> PreparedUpload:
+    """Opens, resizes and re-encodes the image if needed to upload it with the given
+    method. Doesn't touch the terminal or the database, so it can be run in a worker
+    process. If `cache` is specified, re-encoded images are looked up in and stored to
+    the cache.
+
+    `encoding` determines how re-encoded images are sent: as PNG, as raw pixels, or as
+    raw pixels compressed with zlib at `zlib_level`. "auto" chooses between the last
+    two for each image based on `link_throughput`, see `choose_raw_encoding`. Raw
+    pixels are cached only for direct uploads, keyed by `encoding`, so with "auto"
+    the choice made when the entry was stored is reused.
+
+    If `crop` is specified, only this box (in pixels) of the image is uploaded."""
+
+    def _is_format_supported(format: Optional[str]) -> bool:
+        return format is not None and format.lower() in supported_formats
+
+    if upload_method == TransmissionMedium.SHARED_MEMORY:
+        return _prepare_shared_memory_upload(image, max_upload_size, crop)
+
+    if encoding != "png" and upload_method != TransmissionMedium.DIRECT:
+        cache = None
+
+    prepared = prepare_upload_without_decoding(
+        image,
+        upload_method,
+        max_upload_size,
+        supported_formats,
+        cache,
+        crop,
+        encoding,
+        zlib_level,
+    )
+    if prepared is not None:
+        return prepared
+
+    cache_key = None
+    if isinstance(image, str) and cache is not None:
+        cache_key = cache.make_key(
+            image,
+            upload_method,
+            max_upload_size,
+            supported_formats,
+            crop,
+            _raw_cache_encoding(encoding, zlib_level),
+        )
+
+    from PIL import Image
+
+    if isinstance(image, str):
+        image_object = Image.open(image)
+        if crop is None and _is_format_supported(image_object.format):
+            size = os.path.getsize(image)
+            if size <= max_upload_size:
+                image_object.close()
+                return PreparedUpload(data=image, size=size, medium=upload_method)
+    else:
+        image_object = image
+    if crop is not None:
+        image_object = image_object.crop(crop)
+
+    bits = 24 if image_object.mode == "RGB" else 32
+    width, height = image_object.size
+    image_bytes = width * height * (bits / 8)
+    if image_bytes > max_upload_size:
+        ratio = math.sqrt(max_upload_size / image_bytes)
+        width = max(1, math.floor(width * ratio))
+        height = max(1, math.floor(height * ratio))
+        image_object = image_object.resize((width, height))
+
+    if encoding != "png":
+        image_object, format = _convert_to_raw_mode(image_object)
+        data = image_object.tobytes()
+        compression = None
+        if encoding == "auto":
+            assert link_throughput is not None
+            encoding = choose_raw_encoding(data, zlib_level, link_throughput)
+        if encoding == "zlib":
+            data = zlib.compress(data, zlib_level)
+            compression = ikup.Compression.ZLIB
+        size = len(data)
+        medium = upload_method
+        if upload_method == TransmissionMedium.FILE:
+            with tempfile.NamedTemporaryFile(
+                "wb", delete=False, prefix="tty-graphics-protocol-"
+            ) as f:
+                f.write(data)
+            data = f.name
+            medium = TransmissionMedium.TEMP_FILE
+        elif upload_method != TransmissionMedium.DIRECT:
+            raise NotImplementedError(f"Unsupported upload method: {upload_method}")
+        prepared = PreparedUpload(
+            data=data,
+            size=size,
+            medium=medium,
+            pix_width=image_object.width,
+            pix_height=image_object.height,
+            format=format,
+            compression=compression,
+        )
+        if cache_key is not None:
+            assert cache is not None
+            cache.put(cache_key, _pack_raw_payload(prepared))
+        return prepared
+
+    if upload_method == TransmissionMedium.FILE and cache_key is not None:
+        assert cache is not None
+        # Cached files are not temporary, the terminal must not delete them.
+        bytesio = io.BytesIO()
+        image_object.save(
+            bytesio,
+            format=(
+                image_object.format
+                if _is_format_supported(image_object.format)
+                else "PNG"
+            ),
+        )
+        return PreparedUpload(
+            data=cache.put(cache_key, bytesio.getvalue()),
+            size=bytesio.tell(),
+            medium=TransmissionMedium.FILE,
+        )
+    elif upload_method == TransmissionMedium.FILE:
+        with tempfile.NamedTemporaryFile(
+            "wb", delete=False, prefix="tty-graphics-protocol-"
+        ) as f:
+            image_object.save(
+                f,
+                format=(
+                    image_object.format
+                    if _is_format_supported(image_object.format)
+                    else "PNG"
+                ),
+            )
+            f.flush()
+            size = f.tell()
+        return PreparedUpload(
+            data=f.name, size=size, medium=TransmissionMedium.TEMP_FILE
+        )
+    elif upload_method == TransmissionMedium.DIRECT:
+        bytesio = io.BytesIO()
+        image_object.save(bytesio, format="PNG")
+        if cache_key is not None:
+            assert cache is not None
+            cache.put(cache_key, bytesio.getvalue())
+        return PreparedUpload(
+            data=bytesio.getvalue(),
+            size=bytesio.tell(),
+            medium=upload_method,
+            pix_width=image_object.width,
+            pix_height=image_object.height,
+        )
+    raise NotImplementedError(f"Unsupported upload method: {upload_method}")
+
+
+def _in_frame(method):
+    """Makes the `IkupTerminal` method run within a frame of its terminal, so that its
+    output is written with as few writes as possible, see
+    `GraphicsTerminal.begin_frame`."""
+
+    @functools.wraps(method)
+    def wrapper(self: "IkupTerminal", *args, **kwargs):
+        with self.term.frame():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
 def _config_property(name: str):
     assert name in IkupConfig.__annotations__
 
@@ -458,6 +968,13 @@ class IkupTerminal:
         )
 
         self._config: IkupConfig = config
+        self._supports_shared_memory: Optional[bool] = None
+        # Uploads sent with response checking whose errors may still arrive, by ID.
+        self._in_flight_uploads: Dict[int, ImageInstance] = {}
+        # Uploads rejected by the terminal that weren't reported yet.
+        self._failed_uploads: List[FailedUpload] = []
+        # IDs of queries that timed out, whose responses may still arrive.
+        self._pending_query_ids: Set[int] = set()
 
         self.detect_terminal()
 
@@ -477,6 +994,9 @@ class IkupTerminal:
         self.id_manager = IDManager(
             database_file=id_database,
             max_ids_per_subspace=config.max_ids_per_subspace,
+            atime_update_interval=datetime.timedelta(
+                seconds=config.id_atime_update_interval
+            ),
         )
 
     max_cols = _config_property("max_cols")
@@ -495,6 +1015,9 @@ class IkupTerminal:
     supported_formats = _config_property("supported_formats")
     stream_max_size = _config_property("stream_max_size")
     file_max_size = _config_property("file_max_size")
+    transcode_cache_max_bytes = _config_property("transcode_cache_max_bytes")
+    upload_encoding = _config_property("upload_encoding")
+    upload_zlib_level = _config_property("upload_zlib_level")
     num_tmux_layers = _config_property("num_tmux_layers")
     max_db_age_days = _config_property("max_db_age_days")
     max_num_ids = _config_property("max_num_ids")
@@ -505,6 +1028,9 @@ class IkupTerminal:
     upload_stall_timeout = _config_property("upload_stall_timeout")
     allow_concurrent_uploads = _config_property("allow_concurrent_uploads")
     upload_command_delay = _config_property("upload_command_delay")
+    upload_chunks_per_write = _config_property("upload_chunks_per_write")
+    max_prepare_workers = _config_property("max_prepare_workers")
+    prepare_pool_type = _config_property("prepare_pool_type")
     mark_uploaded = _config_property("mark_uploaded")
 
     def detect_terminal(self):
@@ -626,14 +1152,7 @@ class IkupTerminal:
     ) -> ImageInstance:
         path, mtime = self._get_image_path_and_mtime(image)
         if cols is None or rows is None:
-            if isinstance(image, str):
-                from PIL import Image
-
-                open_image = Image.open(image)
-                width, height = open_image.size
-                open_image.close()
-            else:
-                width, height = image.size
+            width, height = self._get_image_size(image)
             cols, rows = self.get_optimal_cols_and_rows(
                 width,
                 height,
@@ -659,6 +1178,18 @@ class IkupTerminal:
             image=image_obj,
         )
 
+    def _get_image_size(self, image: ImageOrFilename) -> Tuple[int, int]:
+        if isinstance(image, str):
+            # Try to get the size from the header first, PIL is slow to import.
+            header = probe_image(image)
+            if header is not None:
+                return header.size
+            from PIL import Image
+
+            with Image.open(image) as open_image:
+                return open_image.size
+        return image.size
+
     def _get_image_path_and_mtime(
         self, image: ImageOrFilename
     ) -> Tuple[str, datetime.datetime]:
@@ -834,13 +1365,11 @@ class IkupTerminal:
             formats = self._config.supported_formats
         return [f.lower() for f in formats]
 
-    def _is_format_supported(self, format: Optional[str]) -> bool:
-        return format is not None and format.lower() in self.get_supported_formats()
-
     def get_max_upload_size(self, upload_method: TransmissionMedium) -> int:
         if upload_method in [
             TransmissionMedium.FILE,
             TransmissionMedium.TEMP_FILE,
+            TransmissionMedium.SHARED_MEMORY,
         ]:
             return self._config.file_max_size
         elif upload_method == TransmissionMedium.DIRECT:
@@ -848,17 +1377,234 @@ class IkupTerminal:
         else:
             raise NotImplementedError(f"Unsupported upload method: {upload_method}")
 
-    def get_upload_method(self) -> TransmissionMedium:
-        upload_method = self._config.upload_method
-        if upload_method == "auto" or upload_method is None:
+    def get_upload_method(
+        self, upload_method: Union[TransmissionMedium, str, None] = None
+    ) -> TransmissionMedium:
+        if upload_method is None:
+            upload_method = self._config.upload_method
+        if upload_method == "auto":
             if self.inside_ssh:
                 upload_method = TransmissionMedium.DIRECT
             else:
                 upload_method = TransmissionMedium.FILE
         if isinstance(upload_method, str):
             upload_method = TransmissionMedium.from_string(upload_method)
+        if (
+            upload_method == TransmissionMedium.SHARED_MEMORY
+            and not self.supports_shared_memory()
+        ):
+            upload_method = TransmissionMedium.FILE
         return upload_method
 
+    def supports_shared_memory(self) -> bool:
+        """Checks whether the terminal accepts shared memory transmissions by sending
+        a query command with a tiny image. The response is stored in the database, so
+        that the terminal is probed only once, not by every process."""
+        if self._supports_shared_memory is not None:
+            return self._supports_shared_memory
+        self._supports_shared_memory = False
+        # The terminal must run on the same machine to see our shared memory.
+        if self.inside_ssh or not os.path.isdir(SHARED_MEMORY_DIR):
+            return False
+        if self._terminal_id is not None:
+            stored = self.id_manager.get_terminal_property(
+                self._terminal_id, SHARED_MEMORY_PROPERTY
+            )
+            if stored is not None:
+                self._supports_shared_memory = stored == "1"
+                return self._supports_shared_memory
+        try:
+            name = create_shared_memory(b"\0\0\0")
+        except OSError:
+            return False
+        probe_id = self._gen_query_id()
+        try:
+            self._send_query(
+                TransmitCommand(
+                    image_id=probe_id,
+                    medium=TransmissionMedium.SHARED_MEMORY,
+                    format=ikup.Format.RGB,
+                    pix_width=1,
+                    pix_height=1,
+                    query=True,
+                ).set_filename(name)
+            )
+            response = self._receive_response_for(
+                probe_id, self._config.check_response_timeout
+            )
+            if response is None:
+                # The response may still arrive, don't mistake it for anything else.
+                self._pending_query_ids.add(probe_id)
+            self._supports_shared_memory = response is not None and response.is_ok
+        finally:
+            unlink_shared_memory(name)
+        # A timeout may be caused by a slow connection rather than by the lack of
+        # support, so it's not stored: only this process won't use shared memory.
+        if self._terminal_id is not None and response is not None:
+            self.id_manager.set_terminal_property(
+                self._terminal_id,
+                SHARED_MEMORY_PROPERTY,
+                "1" if self._supports_shared_memory else "0",
+            )
+        return self._supports_shared_memory
+
+    def _send_query(self, command: TransmitCommand):
+        """Sends a query command. Unless concurrent uploads are allowed, waits until
+        other processes finish their chunked uploads, because a command sent in the
+        middle of a chunk stream would break it."""
+        if not self.get_allow_concurrent_uploads() and self._terminal_id is not None:
+            self.id_manager.wait_for_chunked_uploads(
+                self._terminal_id, stall_timeout=self._config.upload_stall_timeout
+            )
+        self.term.send_command(command)
+
+    def _gen_query_id(self) -> int:
+        """Returns a random ID for a query command that doesn't clash with the uploads
+        awaiting responses. Query commands don't store images, so any ID will do."""
+        while True:
+            id = random.randint(1, 2**24 - 1)
+            if id not in self._in_flight_uploads and id not in self._pending_query_ids:
+                return id
+
+    def _handle_upload_response(self, response: GraphicsResponse):
+        """Handles a response to an upload sent with response checking. Only errors
+        are reported (`q=1`), so the upload is marked dirty to be reuploaded next
+        time. Responses to uploads of other processes and late responses to queries
+        are ignored."""
+        if response.image_id in self._pending_query_ids:
+            self._pending_query_ids.discard(response.image_id)
+            return
+        if response.is_ok or response.image_id is None:
+            return
+        inst = self._in_flight_uploads.pop(response.image_id, None)
+        if inst is None:
+            return
+        if self._terminal_id is not None:
+            self.id_manager.mark_dirty(response.image_id, self._terminal_id)
+        self._failed_uploads.append(FailedUpload(inst, response))
+
+    def _receive_response_for(
+        self, id: int, timeout: float
+    ) -> Optional[GraphicsResponse]:
+        """Waits for the response to the command with the image ID `id`, handling the
+        responses to uploads that arrive before it. Returns None on timeout."""
+        end_time = time.time() + timeout
+        while True:
+            response = self.term.receive_response(
+                timeout=max(end_time - time.time(), 0)
+            )
+            if not response.is_valid:
+                return None
+            if response.image_id == id:
+                return response
+            self._handle_upload_response(response)
+
+    def _drain_upload_responses(self):
+        """Handles the responses to uploads that have already arrived, without
+        waiting."""
+        if not self._in_flight_uploads and not self._pending_query_ids:
+            return
+        # Most of the time nothing has arrived, don't touch the tty then.
+        if not self.term.has_response_data():
+            return
+        while True:
+            response = self.term.receive_response(timeout=0)
+            if not response.is_valid:
+                return
+            self._handle_upload_response(response)
+
+    def wait_for_upload_responses(
+        self, timeout: Optional[float] = None
+    ) -> List[FailedUpload]:
+        """Waits until the terminal has processed all the uploads sent with response
+        checking and returns the ones that failed since the last call. Failed uploads
+        are marked dirty.
+
+        Uploads are pipelined: they are sent with `q=1`, so the terminal responds
+        only to errors, which are collected without blocking. Here we send a query
+        command and wait for its response. The terminal processes commands in order,
+        so all the uploads sent before it are done by then. If the terminal doesn't
+        respond within `timeout` (`check_response_timeout` by default), the remaining
+        uploads are considered failed."""
+        self._sync_upload_responses(timeout)
+        failed = self._failed_uploads
+        self._failed_uploads = []
+        return failed
+
+    def _sync_upload_responses(self, timeout: Optional[float] = None):
+        if timeout is None:
+            timeout = self._config.check_response_timeout
+        # Late responses to queries would end up in the shell after we exit, so wait
+        # for them too.
+        if self._in_flight_uploads or self._pending_query_ids:
+            sync_id = self._gen_query_id()
+            self._send_query(
+                TransmitCommand(
+                    image_id=sync_id,
+                    medium=TransmissionMedium.DIRECT,
+                    format=ikup.Format.RGB,
+                    pix_width=1,
+                    pix_height=1,
+                    query=True,
+                ).set_data(b"\0\0\0")
+            )
+            if self._receive_response_for(sync_id, timeout) is None:
+                if self._terminal_id is not None:
+                    self.id_manager.mark_dirty_many(
+                        self._in_flight_uploads.keys(), self._terminal_id
+                    )
+                self._failed_uploads.extend(
+                    FailedUpload(inst) for inst in self._in_flight_uploads.values()
+                )
+            self._in_flight_uploads.clear()
+            self._pending_query_ids.clear()
+
+    def get_upload_encoding(
+        self, upload_method: TransmissionMedium
+    ) -> Union[UploadEncoding, Literal["auto"]]:
+        """Returns the encoding of re-encoded images for the given upload method.
+        "auto" means that it's chosen for each image by `choose_raw_encoding`."""
+        if self._config.upload_encoding != "auto":
+            return self._config.upload_encoding
+        if upload_method != TransmissionMedium.DIRECT:
+            # Files are written and read locally, which we assume to be cheaper than
+            # compressing them. Files re-encoded to PNG are cached though, so if the
+            # cache is enabled, displaying the same image again costs nothing.
+            return "png" if self.get_transcode_cache() is not None else "raw"
+        if self.get_direct_upload_throughput() is None:
+            # Until we have measured the link, assume that it's the bottleneck.
+            return "zlib"
+        return "auto"
+
+    def get_direct_upload_throughput(self) -> Optional[float]:
+        """Returns the observed throughput of direct uploads to the terminal in
+        payload bytes per second, or None if it hasn't been measured yet."""
+        if self._terminal_id is None:
+            return None
+        value = self.id_manager.get_terminal_property(
+            self._terminal_id, DIRECT_UPLOAD_THROUGHPUT_PROPERTY
+        )
+        return float(value) if value is not None else None
+
+    def _record_direct_upload_throughput(self, size: int, seconds: float):
+        """Updates the throughput of direct uploads with a new measurement."""
+        if size < MIN_THROUGHPUT_SAMPLE_SIZE or seconds <= 0 or not self._terminal_id:
+            return
+        throughput = size / seconds
+        previous = self.get_direct_upload_throughput()
+        if previous is not None:
+            # Smooth out the noise, but adapt quickly if the link changes.
+            throughput = (previous + throughput) / 2
+        self.id_manager.set_terminal_property(
+            self._terminal_id, DIRECT_UPLOAD_THROUGHPUT_PROPERTY, str(throughput)
+        )
+
+    def get_upload_zlib_level(self) -> int:
+        if self._config.upload_zlib_level == "auto":
+            # Over ssh each byte costs much more, so compress harder.
+            return 6 if self.inside_ssh else 1
+        return self._config.upload_zlib_level
+
     def _abort_transmission(self, id: int):
         """Send a final direct transmission command (`m=0`) to abort any existing
         transmission for this ID."""
@@ -870,6 +1616,161 @@ class IkupTerminal:
             )
         )
 
+    def get_max_prepare_workers(self) -> int:
+        if self._config.max_prepare_workers == "auto":
+            return min(8, os.cpu_count() or 1)
+        return max(1, self._config.max_prepare_workers)
+
+    def get_transcode_cache(self) -> Optional[TranscodeCache]:
+        if self._config.transcode_cache_max_bytes <= 0:
+            return None
+        return TranscodeCache(
+            os.path.join(self._config.id_database_dir, "transcode-cache"),
+            self._config.transcode_cache_max_bytes,
+        )
+
+    def _prepare_upload(
+        self, inst: ImageInstance, upload_method: TransmissionMedium
+    ) -> PreparedUpload:
+        if inst.image is None and not inst.is_file_available():
+            raise FileNotFoundError(
+                f"Image file {inst.path} with mtime {inst.mtime} does not"
+                " exist or was overwritten"
+            )
+        encoding = self.get_upload_encoding(upload_method)
+        return prepare_upload(
+            inst.image if inst.image is not None else inst.path,
+            upload_method,
+            self.get_max_upload_size(upload_method),
+            self.get_supported_formats(),
+            self.get_transcode_cache(),
+            encoding,
+            self.get_upload_zlib_level(),
+            inst.crop,
+            self.get_direct_upload_throughput() if encoding == "auto" else None,
+        )
+
+    def _prepare_uploads_in_parallel(
+        self,
+        instances: List[ImageInstance],
+        upload_method: Union[TransmissionMedium, str, None] = None,
+    ) -> Iterator[Union[PreparedUpload, OSError]]:
+        """Prepare uploads for the given instances using a pool of workers. Yields the
+        prepared uploads (or errors) in the order of `instances` as soon as they are
+        ready, so the caller may transmit them while the rest are being prepared."""
+        upload_method = self.get_upload_method(upload_method)
+        if upload_method not in [
+            TransmissionMedium.FILE,
+            TransmissionMedium.DIRECT,
+            TransmissionMedium.SHARED_MEMORY,
+        ]:
+            raise NotImplementedError(f"Unsupported upload method: {upload_method}")
+        max_upload_size = self.get_max_upload_size(upload_method)
+        supported_formats = self.get_supported_formats()
+        cache = self.get_transcode_cache()
+        encoding = self.get_upload_encoding(upload_method)
+        zlib_level = self.get_upload_zlib_level()
+        link_throughput = (
+            self.get_direct_upload_throughput() if encoding == "auto" else None
+        )
+        # Files that can be sent as is and cache hits don't need workers.
+        cheap: List[Optional[PreparedUpload]] = []
+        for inst in instances:
+            try:
+                cheap.append(
+                    prepare_upload_without_decoding(
+                        inst.path,
+                        upload_method,
+                        max_upload_size,
+                        supported_formats,
+                        cache,
+                        inst.crop,
+                        encoding,
+                        zlib_level,
+                    )
+                    if inst.image is None and inst.is_file_available()
+                    else None
+                )
+            except OSError:
+                # Let `prepare_upload` report it.
+                cheap.append(None)
+        num_workers = min(
+            self.get_max_prepare_workers(),
+            sum(
+                prepared is None and inst.image is None
+                for inst, prepared in zip(instances, cheap)
+            ),
+        )
+        if num_workers <= 1:
+            for inst, prepared in zip(instances, cheap):
+                try:
+                    if prepared is None:
+                        prepared = self._prepare_upload(inst, upload_method)
+                    yield prepared
+                except OSError as e:
+                    yield e
+            return
+
+        if self._config.prepare_pool_type == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(num_workers)
+        with executor:
+            futures: List[Optional[concurrent.futures.Future]] = []
+            for inst, prepared in zip(instances, cheap):
+                # In-memory images are prepared in the main thread, we don't want to
+                # pickle them.
+                if (
+                    prepared is not None
+                    or inst.image is not None
+                    or not inst.is_file_available()
+                ):
+                    futures.append(None)
+                    continue
+                futures.append(
+                    executor.submit(
+                        prepare_upload,
+                        inst.path,
+                        upload_method,
+                        max_upload_size,
+                        supported_formats,
+                        cache,
+                        encoding,
+                        zlib_level,
+                        inst.crop,
+                        link_throughput,
+                    )
+                )
+            num_consumed = 0
+            try:
+                for inst, prepared, future in zip(instances, cheap, futures):
+                    num_consumed += 1
+                    try:
+                        if prepared is not None:
+                            yield prepared
+                        elif future is None:
+                            yield self._prepare_upload(inst, upload_method)
+                        else:
+                            yield future.result()
+                    except OSError as e:
+                        yield e
+            finally:
+                # If the caller stops early, remove the temporary files and shared
+                # memory objects prepared for nothing, including the ones that are
+                # being prepared right now.
+                unconsumed = [f for f in futures[num_consumed:] if f is not None]
+                for future in unconsumed:
+                    future.cancel()
+                executor.shutdown(wait=True)
+                for future in unconsumed:
+                    if (
+                        future.done()
+                        and not future.cancelled()
+                        and future.exception() is None
+                    ):
+                        prepared = future.result()
+                        discard_upload_data(prepared.data, prepared.medium)
+
     def _upload(
         self,
         inst: ImageInstance,
@@ -878,102 +1779,43 @@ class IkupTerminal:
         upload_method: Union[TransmissionMedium, str, None] = None,
         force_upload: bool = False,
         mark_uploaded: Optional[bool] = None,
+        prepared: Optional[PreparedUpload] = None,
     ):
         if check_response is None:
             check_response = self._config.check_response
-        if upload_method is None:
-            upload_method = self._config.upload_method
-        if upload_method == "auto":
-            if self.inside_ssh:
-                upload_method = TransmissionMedium.DIRECT
-            else:
-                upload_method = TransmissionMedium.FILE
-        if isinstance(upload_method, str):
-            upload_method = TransmissionMedium.from_string(upload_method)
+        upload_method = self.get_upload_method(upload_method)
         if upload_method not in [
             TransmissionMedium.FILE,
             TransmissionMedium.DIRECT,
+            TransmissionMedium.SHARED_MEMORY,
         ]:
             raise NotImplementedError(f"Unsupported upload method: {upload_method}")
 
-        if check_response:
-            raise NotImplementedError("Checking the response is not yet implemented")
-
-        max_upload_size = self.get_max_upload_size(upload_method)
-
-        if inst.image is None:
-            if not inst.is_file_available():
-                raise FileNotFoundError(
-                    f"Image file {inst.path} with mtime {inst.mtime} does not"
-                    " exist or was overwritten"
-                )
-            from PIL import Image
-
-            image_object = Image.open(inst.path)
-            if self._is_format_supported(image_object.format):
-                size = os.path.getsize(inst.path)
-                if size <= max_upload_size:
-                    image_object.close()
-                    self._transmit_file_or_bytes(
-                        inst.path,
-                        inst,
-                        size,
-                        upload_method,
-                        force_upload=force_upload,
-                        mark_uploaded=mark_uploaded,
-                    )
-                    return
-        else:
-            image_object = inst.image
-
-        bits = 24 if image_object.mode == "RGB" else 32
-        width, height = image_object.size
-        image_bytes = width * height * (bits / 8)
-        if image_bytes > max_upload_size:
-            ratio = math.sqrt(max_upload_size / image_bytes)
-            width = max(1, math.floor(width * ratio))
-            height = max(1, math.floor(height * ratio))
-            image_object = image_object.resize((width, height))
+        if prepared is None:
+            prepared = self._prepare_upload(inst, upload_method)
 
-        if upload_method == TransmissionMedium.FILE:
-            with tempfile.NamedTemporaryFile(
-                "wb", delete=False, prefix="tty-graphics-protocol-"
-            ) as f:
-                image_object.save(
-                    f,
-                    format=(
-                        image_object.format
-                        if self._is_format_supported(image_object.format)
-                        else "PNG"
-                    ),
-                )
-                f.flush()
-                size = f.tell()
-                f.close()
-                self._transmit_file_or_bytes(
-                    f.name,
-                    inst,
-                    size,
-                    TransmissionMedium.TEMP_FILE,
-                    force_upload=force_upload,
-                    mark_uploaded=mark_uploaded,
-                )
-                return
-        elif upload_method == TransmissionMedium.DIRECT:
-            bytesio = io.BytesIO()
-            image_object.save(bytesio, format="PNG")
-            size = bytesio.tell()
-            self._transmit_file_or_bytes(
-                bytesio,
-                inst,
-                size,
-                upload_method,
-                pix_width=image_object.width,
-                pix_height=image_object.height,
-                force_upload=force_upload,
-                mark_uploaded=mark_uploaded,
-            )
-            return
+        if check_response:
+            # Error responses may arrive at any moment. Keep the tty in non-canonical
+            # mode so that they are not echoed and `_drain_upload_responses` can see
+            # them (they don't end with a newline).
+            self.term.keep_immediate_input()
+        self._transmit_file_or_bytes(
+            prepared.data,
+            inst,
+            prepared.size,
+            prepared.medium,
+            pix_width=prepared.pix_width,
+            pix_height=prepared.pix_height,
+            format=prepared.format,
+            compression=prepared.compression,
+            force_upload=force_upload,
+            mark_uploaded=mark_uploaded,
+            check_response=check_response,
+        )
+        if check_response:
+            self._drain_upload_responses()
+            if len(self._in_flight_uploads) >= MAX_IN_FLIGHT_UPLOADS:
+                self._sync_upload_responses()
 
     def get_allow_concurrent_uploads(self) -> bool:
         if self._config.allow_concurrent_uploads == "auto":
@@ -983,9 +1825,16 @@ class IkupTerminal:
         else:
             return self._config.allow_concurrent_uploads
 
+    def get_upload_chunks_per_write(self) -> Union[int, Literal["adaptive"]]:
+        # Coalesced writes are not atomic, so they are unsafe if other processes may
+        # upload to the same terminal at the same time.
+        if self.get_allow_concurrent_uploads():
+            return 1
+        return self._config.upload_chunks_per_write
+
     def _transmit_file_or_bytes(
         self,
-        filename_or_object: Union[str, io.BytesIO],
+        filename_or_object: Union[str, bytes, io.BytesIO],
         inst: ImageInstance,
         size: int,
         upload_method: TransmissionMedium,
@@ -993,11 +1842,27 @@ class IkupTerminal:
         mark_uploaded: Optional[bool],
         pix_width: Optional[int] = None,
         pix_height: Optional[int] = None,
+        format: ikup.Format = ikup.Format.PNG,
+        compression: Optional[ikup.Compression] = None,
+        check_response: bool = False,
     ):
         if mark_uploaded is None:
             mark_uploaded = self._config.mark_uploaded
+        transmitted = False
+        # With response checking the terminal reports only errors, see
+        # `wait_for_upload_responses`.
+        quiet = (
+            ikup.Quietness.QUIET_UNLESS_ERROR
+            if check_response
+            else ikup.Quietness.QUIET_ALWAYS
+        )
 
         def upload_fn(info: UploadInfo):
+            nonlocal transmitted
+            transmitted = True
+            # Chunks are written only for direct transmissions, including file-based
+            # ones converted by the terminal.
+            chunks_per_write = self.get_upload_chunks_per_write()
             if (
                 upload_method == TransmissionMedium.FILE
                 or upload_method == TransmissionMedium.TEMP_FILE
@@ -1007,13 +1872,36 @@ class IkupTerminal:
                     TransmitCommand(
                         image_id=inst.id,
                         medium=upload_method,
-                        quiet=ikup.Quietness.QUIET_ALWAYS,
-                        format=ikup.Format.PNG,
+                        quiet=quiet,
+                        format=format,
+                        compression=compression,
+                        pix_width=pix_width,
+                        pix_height=pix_height,
+                    )
+                    .set_placement(virtual=True, rows=inst.rows, cols=inst.cols)
+                    .set_filename(filename_or_object),
+                    chunks_per_write=chunks_per_write,
+                )
+            elif upload_method == TransmissionMedium.SHARED_MEMORY:
+                assert isinstance(filename_or_object, str)
+                # The upload may be retried, so keep the prepared object and send a
+                # new name for it each time.
+                shm_name = link_shared_memory(filename_or_object)
+                self.term.send_command(
+                    TransmitCommand(
+                        image_id=inst.id,
+                        medium=upload_method,
+                        quiet=quiet,
+                        format=format,
+                        size=size,
+                        pix_width=pix_width,
+                        pix_height=pix_height,
                     )
                     .set_placement(virtual=True, rows=inst.rows, cols=inst.cols)
-                    .set_filename(filename_or_object)
+                    .set_filename(shm_name)
                 )
             elif upload_method == TransmissionMedium.DIRECT:
+                start = time.perf_counter()
                 self._abort_transmission(inst.id)
                 if isinstance(filename_or_object, str):
                     with open(filename_or_object, "rb") as f:
@@ -1021,12 +1909,16 @@ class IkupTerminal:
                             TransmitCommand(
                                 image_id=inst.id,
                                 medium=TransmissionMedium.DIRECT,
-                                quiet=ikup.Quietness.QUIET_ALWAYS,
-                                format=ikup.Format.PNG,
+                                quiet=quiet,
+                                format=format,
+                                compression=compression,
+                                pix_width=pix_width,
+                                pix_height=pix_height,
                             )
                             .set_placement(virtual=True, rows=inst.rows, cols=inst.cols)
                             .set_data(f),
                             callback=lambda cmd: self._report_progress(cmd, info),
+                            chunks_per_write=chunks_per_write,
                         )
                 else:
                     assert pix_width is not None
@@ -1035,29 +1927,56 @@ class IkupTerminal:
                         TransmitCommand(
                             image_id=inst.id,
                             medium=TransmissionMedium.DIRECT,
-                            quiet=ikup.Quietness.QUIET_ALWAYS,
-                            format=ikup.Format.PNG,
+                            quiet=quiet,
+                            format=format,
+                            compression=compression,
                             pix_width=pix_width,
                             pix_height=pix_height,
                         )
                         .set_placement(virtual=True, rows=inst.rows, cols=inst.cols)
                         .set_data(filename_or_object),
                         callback=lambda cmd: self._report_progress(cmd, info),
+                        chunks_per_write=chunks_per_write,
                     )
+            # Within a frame the commands may be still buffered, but the data must
+            # reach the terminal before the upload is reported as finished.
+            self.term.flush()
+            if upload_method == TransmissionMedium.DIRECT:
+                self._record_direct_upload_throughput(
+                    size, time.perf_counter() - start
+                )
+            if check_response:
+                self._in_flight_uploads[inst.id] = inst
+
+        # File-based uploads are single commands, so other uploads don't have to wait
+        # for them, unless the terminal converts them to direct ones. They still wait
+        # for chunked uploads in progress, since they would break the chunk stream.
+        chunked = upload_method == TransmissionMedium.DIRECT or bool(
+            self.term.force_direct_transmission
+        )
 
         # Now call the uploading function wrapped in a retry loop that will make sure we
         # don't interfere with uploads that are already in progress.
-        self.id_manager.retry_uploading_until_success(
-            inst.id,
-            self._terminal_id,
-            fn=upload_fn,
-            size=size,
-            description=inst.get_description(),
-            stall_timeout=self._config.upload_stall_timeout,
-            force_upload=force_upload,
-            allow_concurrent_uploads=self.get_allow_concurrent_uploads(),
-            mark_uploaded=mark_uploaded,
-        )
+        try:
+            self.id_manager.retry_uploading_until_success(
+                inst.id,
+                self._terminal_id,
+                fn=upload_fn,
+                size=size,
+                description=inst.get_description(),
+                stall_timeout=self._config.upload_stall_timeout,
+                force_upload=force_upload,
+                allow_concurrent_uploads=self.get_allow_concurrent_uploads(),
+                mark_uploaded=mark_uploaded,
+                chunked=chunked,
+            )
+        finally:
+            # Don't leak temporary data if the image was uploaded by someone else. The
+            # prepared shared memory object is never sent itself, only its links.
+            if (
+                not transmitted or upload_method == TransmissionMedium.SHARED_MEMORY
+            ) and isinstance(filename_or_object, (str, bytes)):
+                discard_upload_data(filename_or_object, upload_method)
 
     def _report_progress(self, cmd: GraphicsCommand, info: UploadInfo):
         # Apply delay after each chunk if configured
@@ -1071,6 +1990,7 @@ class IkupTerminal:
             info.upload_time = now
             self.id_manager.report_upload(info, upload_time=now)
 
+    @_in_frame
     def upload_and_display(
         self,
         image: Union[ImageOrFilename, ImageInstance],
@@ -1117,6 +2037,411 @@ class IkupTerminal:
             use_line_feeds=use_line_feeds,
         )
 
+    @_in_frame
+    def upload_and_display_many(
+        self,
+        images: List[Union[ImageOrFilename, ImageInstance]],
+        *,
+        cols: Optional[int] = None,
+        rows: Optional[int] = None,
+        max_cols: Optional[int] = None,
+        max_rows: Optional[int] = None,
+        scale: Optional[float] = None,
+        id_space: Union[IDSpace, str, int, None] = None,
+        id_subspace: Union[IDSubspace, str, None] = None,
+        force_upload: Optional[bool] = None,
+        check_response: Optional[bool] = None,
+        upload_method: Union[TransmissionMedium, str, None] = None,
+        fewer_diacritics: Optional[bool] = None,
+        background: Optional[BackgroundLike] = None,
+        final_cursor_pos: Optional[FinalCursorPos] = None,
+        use_line_feeds: bool = False,
+        mark_uploaded: Optional[bool] = None,
+        on_error: Optional[
+            Callable[[Union[ImageOrFilename, ImageInstance], Exception], None]
+        ] = None,
+    ) -> List[Optional[ImagePlaceholder]]:
+        """Upload and display multiple images, one after another. This is equivalent
+        to calling `upload_and_display` for each image, but IDs are assigned in a
+        single transaction, the upload history is queried once, images are decoded and
+        re-encoded by a pool of `max_prepare_workers` workers, and the placeholders
+        are written with a single write.
+
+        If `on_error` is specified, `OSError`s (e.g. missing or broken files) are
+        passed to it together with the image, in display order, and the corresponding
+        element of the result is None. Otherwise the first error is propagated.
+
+        The IDs of a batch must not evict each other, so if there are more images than
+        the ID subspace holds, they are displayed in several consecutive batches.
+        """
+        max_batch_size = self.id_manager.get_max_batch_size(
+            self.get_id_space(id_space), self.get_subspace(id_subspace)
+        )
+        if len(images) > max_batch_size:
+            result: List[Optional[ImagePlaceholder]] = []
+            for start in range(0, len(images), max_batch_size):
+                result += self.upload_and_display_many(
+                    images[start : start + max_batch_size],
+                    cols=cols,
+                    rows=rows,
+                    max_cols=max_cols,
+                    max_rows=max_rows,
+                    scale=scale,
+                    id_space=id_space,
+                    id_subspace=id_subspace,
+                    force_upload=force_upload,
+                    check_response=check_response,
+                    upload_method=upload_method,
+                    fewer_diacritics=fewer_diacritics,
+                    background=background,
+                    final_cursor_pos=final_cursor_pos,
+                    use_line_feeds=use_line_feeds,
+                    mark_uploaded=mark_uploaded,
+                    on_error=on_error,
+                )
+            return result
+        if random.random() < self._config.cleanup_probability:
+            self.cleanup_old_databases()
+            self.cleanup_current_database()
+        if force_upload is None:
+            force_upload = self._config.force_upload
+        errors: List[Optional[OSError]] = [None] * len(images)
+
+        def _handle_error(index: int, e: OSError):
+            if on_error is None:
+                raise e
+            errors[index] = e
+
+        # Build image instances and assign IDs.
+        instances: List[Optional[ImageInstance]] = [None] * len(images)
+        new_instances = []
+        for i, image in enumerate(images):
+            if isinstance(image, ImageInstance):
+                if cols is not None or rows is not None:
+                    raise ValueError(
+                        "Cannot specify cols or rows when uploading an"
+                        " ImageInstance"
+                    )
+                if image.id is None:
+                    raise ValueError("Cannot upload an ImageInstance without an ID")
+                instances[i] = image
+                continue
+            try:
+                inst = self.build_image_instance(
+                    image,
+                    id=0,
+                    cols=cols,
+                    rows=rows,
+                    max_cols=max_cols,
+                    max_rows=max_rows,
+                    scale=scale,
+                )
+            except OSError as e:
+                _handle_error(i, e)
+                continue
+            instances[i] = inst
+            new_instances.append(inst)
+        ids = self.id_manager.get_ids(
+            [inst.get_description() for inst in new_instances],
+            self.get_id_space(id_space),
+            subspace=self.get_subspace(id_subspace),
+        )
+        for inst, id in zip(new_instances, ids):
+            inst.id = id
+
+        # Upload the images that need uploading.
+        if self._config.redetect_terminal:
+            self.detect_terminal()
+        valid = [i for i, inst in enumerate(instances) if inst is not None]
+        if force_upload or self._terminal_id is None:
+            needs_uploading = [True] * len(valid)
+        else:
+            needs_uploading = self.id_manager.needs_uploading_many(
+                [instances[i].id for i in valid],  # type: ignore
+                self._terminal_id,
+                max_uploads_ago=self._config.reupload_max_uploads_ago,
+                max_bytes_ago=self._config.reupload_max_bytes_ago,
+                max_time_ago=datetime.timedelta(
+                    seconds=self._config.reupload_max_seconds_ago
+                ),
+            )
+        to_upload = [i for i, needs in zip(valid, needs_uploading) if needs]
+        # Images are decoded and re-encoded by a pool of workers while we transmit
+        # the ones that are ready.
+        prepared_uploads = self._prepare_uploads_in_parallel(
+            [instances[i] for i in to_upload],  # type: ignore
+            upload_method,
+        )
+        try:
+            for i, prepared in zip(to_upload, prepared_uploads):
+                inst = instances[i]
+                assert inst is not None
+                try:
+                    if isinstance(prepared, OSError):
+                        raise prepared
+                    try:
+                        self._upload(
+                            inst,
+                            check_response=check_response,
+                            upload_method=upload_method,
+                            force_upload=force_upload,
+                            mark_uploaded=mark_uploaded,
+                            prepared=prepared,
+                        )
+                    except RetryAssignIdError:
+                        # The ID was reassigned by someone else, fall back to the
+                        # one-by-one path which will reassign it and retry.
+                        instances[i] = self.upload(
+                            images[i],
+                            cols=cols,
+                            rows=rows,
+                            max_cols=max_cols,
+                            max_rows=max_rows,
+                            scale=scale,
+                            id_space=id_space,
+                            id_subspace=id_subspace,
+                            force_upload=force_upload,
+                            check_response=check_response,
+                            upload_method=upload_method,
+                            mark_uploaded=mark_uploaded,
+                        )
+                except OSError as e:
+                    _handle_error(i, e)
+                    instances[i] = None
+        finally:
+            prepared_uploads.close()
+
+        # Display the placeholders. Errors are reported in display order, so we
+        # flush the placeholders printed so far before reporting them.
+        placeholders: List[Optional[ImagePlaceholder]] = []
+        for image, inst, error in zip(images, instances, errors):
+            if inst is None:
+                assert error is not None and on_error is not None
+                self.term.flush()
+                on_error(image, error)
+                placeholders.append(None)
+                continue
+            placeholders.append(
+                self.display_only(
+                    inst,
+                    fewer_diacritics=fewer_diacritics,
+                    background=background,
+                    final_cursor_pos=final_cursor_pos,
+                    use_line_feeds=use_line_feeds,
+                )
+            )
+        return placeholders
+
+    def get_tile_size(
+        self,
+        width: int,
+        height: int,
+        cols: int,
+        rows: int,
+        upload_method: TransmissionMedium,
+        *,
+        tile_cols: Optional[int] = None,
+        tile_rows: Optional[int] = None,
+    ) -> Tuple[int, int]:
+        """Returns the size of tiles in cells for an image of `width`x`height` pixels
+        displayed in `cols`x`rows` cells. Unless specified, tiles are as large as
+        possible while still uploaded without downscaling."""
+        if tile_cols is not None and tile_cols <= 0:
+            raise ValueError(f"tile_cols must be positive: {tile_cols}")
+        if tile_rows is not None and tile_rows <= 0:
+            raise ValueError(f"tile_rows must be positive: {tile_rows}")
+        # Assume 4 bytes per pixel, like when re-encoding.
+        bytes_per_cell = 4 * (width / cols) * (height / rows)
+        max_bytes = self.get_max_upload_size(upload_method)
+        max_cells = max(1, int(max_bytes / bytes_per_cell))
+        if tile_cols is None and tile_rows is None:
+            tile_cols = tile_rows = max(1, math.isqrt(max_cells))
+        elif tile_cols is None:
+            assert tile_rows is not None
+            tile_cols = max(1, max_cells // tile_rows)
+        elif tile_rows is None:
+            tile_rows = max(1, max_cells // tile_cols)
+        return min(tile_cols, cols), min(tile_rows, rows)
+
+    @_in_frame
+    def upload_and_display_tiled(
+        self,
+        image: ImageOrFilename,
+        *,
+        tile_cols: Optional[int] = None,
+        tile_rows: Optional[int] = None,
+        cols: Optional[int] = None,
+        rows: Optional[int] = None,
+        max_cols: Optional[int] = None,
+        max_rows: Optional[int] = None,
+        scale: Optional[float] = None,
+        id_space: Union[IDSpace, str, int, None] = None,
+        id_subspace: Union[IDSubspace, str, None] = None,
+        force_upload: Optional[bool] = None,
+        check_response: Optional[bool] = None,
+        upload_method: Union[TransmissionMedium, str, None] = None,
+        fewer_diacritics: Optional[bool] = None,
+        background: Optional[BackgroundLike] = None,
+        abs_pos: Optional[Tuple[int, int]] = None,
+        final_cursor_pos: Optional[FinalCursorPos] = None,
+        use_line_feeds: bool = False,
+        mark_uploaded: Optional[bool] = None,
+    ) -> List[List[ImagePlaceholder]]:
+        """Upload and display a large image split into tiles of `tile_cols`x`tile_rows`
+        cells (see `get_tile_size` for the defaults). Each tile is a separate image
+        with its own ID, so the image is not downscaled to fit into a single upload,
+        and uploads of other images are not blocked by one huge transmission.
+
+        Tiles are prepared by a pool of workers and uploaded row by row, starting from
+        the top-left one. The placeholders of each row of tiles are printed as soon as
+        the row is uploaded. Returns the placeholders of the tiles, row by row.
+        """
+        if random.random() < self._config.cleanup_probability:
+            self.cleanup_old_databases()
+            self.cleanup_current_database()
+        if force_upload is None:
+            force_upload = self._config.force_upload
+        full = self.build_image_instance(
+            image,
+            id=0,
+            cols=cols,
+            rows=rows,
+            max_cols=max_cols,
+            max_rows=max_rows,
+            scale=scale,
+        )
+        width, height = self._get_image_size(image)
+        tile_cols, tile_rows = self.get_tile_size(
+            width,
+            height,
+            full.cols,
+            full.rows,
+            self.get_upload_method(upload_method),
+            tile_cols=tile_cols,
+            tile_rows=tile_rows,
+        )
+
+        # Split the image into tiles. Tile boundaries in pixels are rounded down,
+        # the terminal stretches each tile to fit its cells.
+        def _to_pixels(cell: int, num_cells: int, size: int) -> int:
+            return cell * size // num_cells
+
+        grid: List[List[ImageInstance]] = []
+        for row in range(0, full.rows, tile_rows):
+            grid.append([])
+            end_row = min(row + tile_rows, full.rows)
+            top = _to_pixels(row, full.rows, height)
+            bottom = max(top + 1, _to_pixels(end_row, full.rows, height))
+            for col in range(0, full.cols, tile_cols):
+                end_col = min(col + tile_cols, full.cols)
+                left = _to_pixels(col, full.cols, width)
+                right = max(left + 1, _to_pixels(end_col, full.cols, width))
+                grid[-1].append(
+                    full.clone_with(
+                        cols=end_col - col,
+                        rows=end_row - row,
+                        crop=(left, top, right, bottom),
+                    )
+                )
+        tiles = [tile for tile_row in grid for tile in tile_row]
+        id_space = self.get_id_space(id_space)
+        id_subspace = self.get_subspace(id_subspace)
+        # All the tiles are visible at once, so they can't share IDs.
+        max_tiles = self.id_manager.get_max_batch_size(id_space, id_subspace)
+        if len(tiles) > max_tiles:
+            raise ValueError(
+                f"The image is split into {len(tiles)} tiles, but the ID subspace"
+                f" holds only {max_tiles} IDs, use larger tiles"
+            )
+        ids = self.id_manager.get_ids(
+            [tile.get_description() for tile in tiles],
+            id_space,
+            subspace=id_subspace,
+        )
+        for tile, id in zip(tiles, ids):
+            tile.id = id
+
+        if self._config.redetect_terminal:
+            self.detect_terminal()
+        if force_upload or self._terminal_id is None:
+            needs_uploading = [True] * len(tiles)
+        else:
+            needs_uploading = self.id_manager.needs_uploading_many(
+                ids,
+                self._terminal_id,
+                max_uploads_ago=self._config.reupload_max_uploads_ago,
+                max_bytes_ago=self._config.reupload_max_bytes_ago,
+                max_time_ago=datetime.timedelta(
+                    seconds=self._config.reupload_max_seconds_ago
+                ),
+            )
+        to_upload = {
+            tile.id for tile, needs in zip(tiles, needs_uploading) if needs
+        }
+        prepared_uploads = self._prepare_uploads_in_parallel(
+            [tile for tile in tiles if tile.id in to_upload], upload_method
+        )
+
+        mode = self.get_image_placeholder_mode(
+            full, fewer_diacritics=fewer_diacritics
+        )
+        formatting = self.get_formatting(background)
+        placeholders: List[List[ImagePlaceholder]] = []
+        try:
+            for row, tile_row in zip(range(0, full.rows, tile_rows), grid):
+                for tile in tile_row:
+                    if tile.id not in to_upload:
+                        continue
+                    prepared = next(prepared_uploads)
+                    if isinstance(prepared, OSError):
+                        raise prepared
+                    try:
+                        self._upload(
+                            tile,
+                            check_response=check_response,
+                            upload_method=upload_method,
+                            force_upload=force_upload,
+                            mark_uploaded=mark_uploaded,
+                            prepared=prepared,
+                        )
+                    except RetryAssignIdError:
+                        # The ID was reassigned by someone else. The placeholders of
+                        # this row are not printed yet, so we can use a new one, but
+                        # it must not be taken from the other tiles.
+                        tile.id = self.id_manager.get_id(
+                            tile.get_description(),
+                            id_space,
+                            subspace=id_subspace,
+                            keep={other.id for other in tiles if other is not tile},
+                        )
+                        self.upload(
+                            tile,
+                            force_upload=True,
+                            check_response=check_response,
+                            upload_method=upload_method,
+                            mark_uploaded=mark_uploaded,
+                        )
+                if placeholders and abs_pos is None:
+                    # Go to the first column of the next row.
+                    self._move_cursor_to_final_position(
+                        full.cols, 1, "bottom-left", use_line_feeds=use_line_feeds
+                    )
+                placeholders.append([tile.get_placeholder() for tile in tile_row])
+                self.term.print_placeholders_side_by_side(
+                    placeholders[-1],
+                    pos=None if abs_pos is None else (abs_pos[0], abs_pos[1] + row),
+                    mode=mode,
+                    formatting=formatting,
+                    use_line_feeds=use_line_feeds,
+                )
+                self.term.flush()
+        finally:
+            prepared_uploads.close()
+        self._move_cursor_to_final_position(
+            full.cols, full.rows, final_cursor_pos, use_line_feeds=use_line_feeds
+        )
+        return placeholders
+
     def get_image_placeholder_mode(
         self,
         id: Union[int, ImageInstance, ImagePlaceholder],
@@ -1159,6 +2484,7 @@ class IkupTerminal:
             return b"\033[48;5;%dm" % background
         return background
 
+    @_in_frame
     def display_only(
         self,
         id: Union[int, ImageInstance, ImagePlaceholder],
@@ -1207,7 +2533,9 @@ class IkupTerminal:
                     "Use ImageInstance returned by get_image_instance instead."
                 )
 
-        mode = self.get_image_placeholder_mode(id, fewer_diacritics=fewer_diacritics)
+        mode = self.get_image_placeholder_mode(
+            id, fewer_diacritics=fewer_diacritics
+        )
 
         formatting = self.get_formatting(background)
 
@@ -1296,6 +2624,8 @@ class IkupTerminal:
                     removed.append(path)
                 except Exception:
                     pass
+                # Also remove the upload lock files of the database.
+                shutil.rmtree(f"{path}.locks", ignore_errors=True)
         return removed
 
     def cleanup_current_database(self, max_num_ids: Optional[int] = None) -> None:
@@ -0,0 +1,164 @@
+"""
+Reading image dimensions from file headers without PIL.
+
+Importing PIL is the most expensive part of starting ikup, and often we need only the
+dimensions and the format of an image (e.g. to compute the number of rows and columns
+or to check that the file can be sent to the terminal as is). This module parses the
+headers of the most common formats, reading only a few bytes. If the format is not
+recognized, the functions return None, and the caller should fall back to PIL.
+"""
+
+import struct
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# JPEG start-of-frame markers containing the dimensions (all SOFn except DHT, JPG and
+# DAC which share the range).
+_JPEG_SOF_MARKERS = {
+    0xC0,
+    0xC1,
+    0xC2,
+    0xC3,
+    0xC5,
+    0xC6,
+    0xC7,
+    0xC9,
+    0xCA,
+    0xCB,
+    0xCD,
+    0xCE,
+    0xCF,
+}
+
+
+@dataclass
+class ImageHeader:
+    # The format name as reported by PIL (`Image.format`), e.g. "PNG" or "JPEG".
+    format: str
+    width: int
+    height: int
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+
+def probe_image(path: str) -> Optional[ImageHeader]:
+    """Returns the format and dimensions of the image at `path` or None if the format
+    is not supported or the header is malformed. Raises `OSError` if the file can't be
+    read."""
+    with open(path, "rb") as f:
+        return probe_image_file(f)
+
+
+def probe_image_file(f: BinaryIO) -> Optional[ImageHeader]:
+    """Same as `probe_image`, but reads from a file object positioned at the start of
+    the image."""
+    start = f.tell()
+    header = f.read(32)
+    try:
+        if header.startswith(_PNG_SIGNATURE):
+            return _probe_png(header)
+        if header[:6] in (b"GIF87a", b"GIF89a"):
+            return _probe_gif(header)
+        if header[:2] == b"BM":
+            return _probe_bmp(header)
+        if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+            return _probe_webp(header)
+        if header[:3] == b"\xff\xd8\xff":
+            f.seek(start + 2)
+            return _probe_jpeg(f)
+    except (struct.error, IndexError):
+        return None
+    return None
+
+
+def _make_header(format: str, width: int, height: int) -> Optional[ImageHeader]:
+    if width <= 0 or height <= 0:
+        return None
+    return ImageHeader(format=format, width=width, height=height)
+
+
+def _probe_png(header: bytes) -> Optional[ImageHeader]:
+    if header[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", header[16:24])
+    return _make_header("PNG", width, height)
+
+
+def _probe_gif(header: bytes) -> Optional[ImageHeader]:
+    width, height = struct.unpack("<HH", header[6:10])
+    return _make_header("GIF", width, height)
+
+
+def _probe_bmp(header: bytes) -> Optional[ImageHeader]:
+    (dib_header_size,) = struct.unpack("<I", header[14:18])
+    if dib_header_size == 12:
+        # The OS/2 BITMAPCOREHEADER with 16-bit dimensions.
+        width, height = struct.unpack("<HH", header[18:22])
+    elif dib_header_size >= 40:
+        width, height = struct.unpack("<ii", header[18:26])
+    else:
+        return None
+    # The height is negative for top-down bitmaps.
+    return _make_header("BMP", width, abs(height))
+
+
+def _probe_webp(header: bytes) -> Optional[ImageHeader]:
+    # All the variants keep the dimensions within the first 30 bytes.
+    if len(header) < 30:
+        return None
+    chunk = header[12:16]
+    if chunk == b"VP8 ":
+        # Lossy: the frame tag is followed by a start code and 14-bit dimensions.
+        if header[23:26] != b"\x9d\x01\x2a":
+            return None
+        width, height = struct.unpack("<HH", header[26:30])
+        return _make_header("WEBP", width & 0x3FFF, height & 0x3FFF)
+    if chunk == b"VP8L":
+        # Lossless: a signature byte followed by two 14-bit dimensions minus one.
+        if header[20] != 0x2F:
+            return None
+        (bits,) = struct.unpack("<I", header[21:25])
+        return _make_header(
+            "WEBP", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        )
+    if chunk == b"VP8X":
+        # Extended: 24-bit canvas dimensions minus one.
+        width = int.from_bytes(header[24:27], "little") + 1
+        height = int.from_bytes(header[27:30], "little") + 1
+        return _make_header("WEBP", width, height)
+    return None
+
+
+def _probe_jpeg(f: BinaryIO) -> Optional[ImageHeader]:
+    # Walk the segments until we find a start-of-frame one. We skip the contents of
+    # other segments, which may be quite large (e.g. exif thumbnails).
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            return None
+        marker = f.read(1)
+        # Skip fill bytes.
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker_code = marker[0]
+        # Standalone markers have no length.
+        if marker_code == 0x01 or 0xD0 <= marker_code <= 0xD7:
+            continue
+        if marker_code in (0xD9, 0xDA):
+            # End of image or start of scan before any frame header.
+            return None
+        (length,) = struct.unpack(">H", f.read(2))
+        if length < 2:
+            return None
+        if marker_code in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">xHH", f.read(5))
+            return _make_header("JPEG", width, height)
+        f.seek(length - 2, 1)
@@ -1,4 +1,5 @@
 import dataclasses
+import functools
 from dataclasses import dataclass
 from enum import Enum
 from typing import BinaryIO, Callable, List, Optional, Tuple, Union
@@ -430,6 +431,29 @@ class ImagePlaceholder:
         no_escape: bool = False,
     ) -> List[bytes]:
         self.validate()
+        # Lines with formatting functions can't be cached.
+        if formatting is None or isinstance(formatting, bytes):
+            return list(
+                _render_lines_cached(
+                    self.image_id,
+                    self.placement_id,
+                    self.start_col,
+                    self.start_row,
+                    self.end_col,
+                    self.end_row,
+                    mode,
+                    formatting,
+                    no_escape,
+                )
+            )
+        return self._render_lines(mode, formatting, no_escape)
+
+    def _render_lines(
+        self,
+        mode: ImagePlaceholderMode,
+        formatting: AdditionalFormatting,
+        no_escape: bool,
+    ) -> List[bytes]:
         placeholder_bytes = mode.placeholder_char.encode("utf-8")
 
         # Custom formatting.
@@ -498,6 +522,18 @@ class ImagePlaceholder:
             ):
                 othercol_diacritic_count = 2
 
+        # Without cell formatting all rows are the same up to the row diacritic.
+        row_template = None
+        if cell_formatting is None:
+            row_template = _get_row_template(
+                placeholder_bytes,
+                self.start_col,
+                self.end_col,
+                firstcol_diacritic_count,
+                othercol_diacritic_count,
+                image_id_4thbyte,
+            )
+
         result = []
         # Print the placeholder.
         for row in range(self.start_row, self.end_row):
@@ -519,6 +555,12 @@ class ImagePlaceholder:
                 continue
             # Insert fg and underline colors encoding IDs.
             line += line_id_colors
+            if row_template is not None:
+                line += ROWCOLUMN_DIACRITICS_UTF8[row].join(row_template)
+                if not no_escape:
+                    line += b"\033[0m"
+                result.append(line)
+                continue
             # Custom cell formatting.
             if cell_formatting is not None:
                 line += cell_formatting(self.start_col, row)
@@ -559,9 +601,7 @@ class ImagePlaceholder:
         no_escape: bool = False,
     ):
         lines = self.to_lines(mode, formatting, no_escape=no_escape)
-        for line in lines:
-            stream.write(line)
-            stream.write(b"\n")
+        stream.write(b"".join(line + b"\n" for line in lines))
 
     def to_stream_abs_position(
         self,
@@ -571,9 +611,7 @@ class ImagePlaceholder:
         formatting: AdditionalFormatting = None,
     ):
         lines = self.to_lines(mode, formatting)
-        for idx, line in enumerate(lines):
-            stream.write(b"\033[%d;%dH" % (pos[1] + idx + 1, pos[0] + 1))
-            stream.write(line)
+        lines_to_stream_abs_position(stream, lines, pos)
 
     def to_stream_at_cursor(
         self,
@@ -584,40 +622,178 @@ class ImagePlaceholder:
         use_line_feeds: bool = False,
     ):
         lines = self.to_lines(mode, formatting)
-        for idx, line in enumerate(lines):
-            if not use_line_feeds and use_save_cursor and idx != len(lines) - 1:
-                # Save the cursor position at the beginning of the current row.
-                stream.write(b"\033[s")
-            stream.write(line)
-            if idx != len(lines) - 1:
-                if use_line_feeds:
-                    stream.write(b"\n")
-                    continue
-                if use_save_cursor:
-                    # Restore the cursor to go back to the beginning of the row.
-                    stream.write(b"\033[u")
-                else:
-                    # Go to the beginning of the row by moving the cursor
-                    # relatively. This is unreliable if we touch the right
-                    # margin.
-                    stream.write(b"\033[%dD" % (self.end_col - self.start_col))
-                # This sequence moves the cursor down, maybe creating a newline.
-                stream.write(b"\033D")
+        lines_to_stream_at_cursor(
+            stream,
+            lines,
+            self.end_col - self.start_col,
+            use_save_cursor=use_save_cursor,
+            use_line_feeds=use_line_feeds,
+        )
 
-    def to_stream(
+    def to_bytes(
         self,
-        stream: BinaryIO,
         pos: Optional[Tuple[int, int]] = None,
         mode: ImagePlaceholderMode = ImagePlaceholderMode.default(),
         formatting: AdditionalFormatting = None,
         use_save_cursor: bool = True,
         use_line_feeds: bool = False,
-    ):
+    ) -> bytes:
+        """Returns everything `to_stream` writes, including cursor movements."""
+        lines = self.to_lines(mode, formatting)
         if pos is not None:
             if use_line_feeds:
                 raise ValueError("use_line_feeds=True cannot be used with pos")
-            self.to_stream_abs_position(stream, pos, mode, formatting)
-        else:
-            self.to_stream_at_cursor(
-                stream, mode, formatting, use_save_cursor, use_line_feeds=use_line_feeds
-            )
+            return lines_to_bytes_abs_position(lines, pos)
+        return lines_to_bytes_at_cursor(
+            lines,
+            self.end_col - self.start_col,
+            use_save_cursor=use_save_cursor,
+            use_line_feeds=use_line_feeds,
+        )
+
+    def to_stream(
+        self,
+        stream: BinaryIO,
+        pos: Optional[Tuple[int, int]] = None,
+        mode: ImagePlaceholderMode = ImagePlaceholderMode.default(),
+        formatting: AdditionalFormatting = None,
+        use_save_cursor: bool = True,
+        use_line_feeds: bool = False,
+    ):
+        """Writes the placeholder with a single write, which is a single syscall for
+        unbuffered ttys."""
+        stream.write(
+            self.to_bytes(pos, mode, formatting, use_save_cursor, use_line_feeds)
+        )
+
+
+@functools.lru_cache(maxsize=64)
+def _render_lines_cached(
+    image_id: int,
+    placement_id: int,
+    start_col: int,
+    start_row: int,
+    end_col: int,
+    end_row: int,
+    mode: ImagePlaceholderMode,
+    formatting: Optional[bytes],
+    no_escape: bool,
+) -> Tuple[bytes, ...]:
+    """A cache of the lines of recently displayed placeholders."""
+    placeholder = ImagePlaceholder(
+        image_id=image_id,
+        placement_id=placement_id,
+        start_col=start_col,
+        start_row=start_row,
+        end_col=end_col,
+        end_row=end_row,
+    )
+    return tuple(placeholder._render_lines(mode, formatting, no_escape))
+
+
+@functools.lru_cache(maxsize=256)
+def _get_row_template(
+    placeholder_bytes: bytes,
+    start_col: int,
+    end_col: int,
+    firstcol_diacritic_count: int,
+    othercol_diacritic_count: int,
+    image_id_4thbyte: int,
+) -> Tuple[bytes, ...]:
+    """Returns the cells of a placeholder row split at the row diacritics, so that the
+    row is `row_diacritic.join(template)`."""
+    image_id_4thbyte_diacritic = ROWCOLUMN_DIACRITICS_UTF8[image_id_4thbyte]
+    segments = []
+    current = [placeholder_bytes]
+    if firstcol_diacritic_count >= 1:
+        segments.append(b"".join(current))
+        current = []
+        if firstcol_diacritic_count >= 2:
+            current.append(ROWCOLUMN_DIACRITICS_UTF8[start_col])
+            if firstcol_diacritic_count >= 3:
+                current.append(image_id_4thbyte_diacritic)
+    for col in range(start_col + 1, end_col):
+        current.append(placeholder_bytes)
+        if othercol_diacritic_count >= 1:
+            segments.append(b"".join(current))
+            current = []
+            if othercol_diacritic_count >= 2 and col < len(ROWCOLUMN_DIACRITICS_UTF8):
+                current.append(ROWCOLUMN_DIACRITICS_UTF8[col])
+                if othercol_diacritic_count >= 3:
+                    current.append(image_id_4thbyte_diacritic)
+    segments.append(b"".join(current))
+    return tuple(segments)
+
+
+def placeholders_side_by_side_to_lines(
+    placeholders: List[ImagePlaceholder],
+    mode: ImagePlaceholderMode = ImagePlaceholderMode.default(),
+    formatting: AdditionalFormatting = None,
+) -> List[bytes]:
+    """Returns the lines of several placeholders printed next to each other, e.g. a row
+    of tiles of a large image. All placeholders must have the same number of rows."""
+    num_rows = {p.end_row - p.start_row for p in placeholders}
+    if len(num_rows) != 1:
+        raise ValueError(
+            f"Placeholders must have the same number of rows: {placeholders}"
+        )
+    all_lines = [p.to_lines(mode, formatting) for p in placeholders]
+    return [b"".join(parts) for parts in zip(*all_lines)]
+
+
+def lines_to_bytes_abs_position(lines: List[bytes], pos: Tuple[int, int]) -> bytes:
+    parts = []
+    for idx, line in enumerate(lines):
+        parts.append(b"\033[%d;%dH" % (pos[1] + idx + 1, pos[0] + 1))
+        parts.append(line)
+    return b"".join(parts)
+
+
+def lines_to_bytes_at_cursor(
+    lines: List[bytes],
+    width: int,
+    use_save_cursor: bool = True,
+    use_line_feeds: bool = False,
+) -> bytes:
+    """Returns placeholder lines of `width` columns to be printed starting at the
+    cursor. The cursor is left at the end of the last line."""
+    if use_line_feeds:
+        return b"\n".join(lines)
+    if use_save_cursor:
+        # Save the cursor position at the beginning of each row, then restore it
+        # to go back to the beginning of the row.
+        prefix, suffix = b"\033[s", b"\033[u"
+    else:
+        # Go to the beginning of the row by moving the cursor relatively. This is
+        # unreliable if we touch the right margin.
+        prefix, suffix = b"", b"\033[%dD" % width
+    # This sequence moves the cursor down, maybe creating a newline.
+    suffix += b"\033D"
+    parts = []
+    for line in lines[:-1]:
+        parts.append(prefix)
+        parts.append(line)
+        parts.append(suffix)
+    parts.extend(lines[-1:])
+    return b"".join(parts)
+
+
+def lines_to_stream_abs_position(
+    stream: BinaryIO, lines: List[bytes], pos: Tuple[int, int]
+):
+    stream.write(lines_to_bytes_abs_position(lines, pos))
+
+
+def lines_to_stream_at_cursor(
+    stream: BinaryIO,
+    lines: List[bytes],
+    width: int,
+    use_save_cursor: bool = True,
+    use_line_feeds: bool = False,
+):
+    """Writes the result of `lines_to_bytes_at_cursor` with a single write."""
+    stream.write(
+        lines_to_bytes_at_cursor(
+            lines, width, use_save_cursor=use_save_cursor, use_line_feeds=use_line_feeds
+        )
+    )
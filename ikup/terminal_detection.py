@@ -12,6 +12,10 @@ from typing import Optional, Tuple
 
 import psutil
 
+# The process whose ancestors are searched for the terminal emulator. If None, the
+# current process is used. The ikup daemon sets it to the pid of the client it serves.
+CLIENT_PID: Optional[int] = None
+
 
 def get_terminal_executable_names():
     """Get a list of terminal emulator names used to search for the terminal PID."""
@@ -58,7 +62,7 @@ def get_terminal_and_shell_pid() -> Optional[Tuple[int, str, int]]:
     """
     try:
         terminals = get_terminal_executable_names()
-        process = psutil.Process()
+        process = psutil.Process(CLIENT_PID)
         while process is not None:
             child_process = process
             process = process.parent()
@@ -1,3 +1,4 @@
+import os
 import time
 
 from PIL import Image, ImageOps
@@ -114,6 +115,29 @@ def upload_and_display_unsupported_jpeg(ctx: TestingContext):
         )
 
 
+@screenshot_test
+def upload_check_response(ctx: TestingContext):
+    ikupterm = IkupTerminal(config="DEFAULT", force_upload=True, check_response=True)
+    ikupterm.final_cursor_pos = "top-right"
+    # The header is valid, so the file is sent as is, but the terminal can't decode it.
+    broken_png = os.path.join(ctx.output_dir, ctx.test_name, "broken.png")
+    with open(ctx.get_tux_png(), "rb") as f:
+        data = f.read()
+    with open(broken_png, "wb") as f:
+        f.write(data[: len(data) // 2])
+    for method in ["file", "direct"]:
+        ikupterm.upload_method = method
+        good = ikupterm.upload_and_display(ctx.get_tux_png(), rows=8)
+        broken = ikupterm.upload_and_display(broken_png, rows=8)
+        failed = ikupterm.wait_for_upload_responses()
+        ctx.assert_equal([f.inst.id for f in failed], [broken.image_id])
+        ctx.assert_true(failed[0].message.startswith("E"), failed[0].message)
+        ctx.assert_true(not ikupterm.needs_uploading(good.image_id))
+        ctx.assert_true(ikupterm.needs_uploading(broken.image_id))
+        ctx.assert_equal(ikupterm.wait_for_upload_responses(), [])
+    ctx.take_screenshot("Two tuxes, the broken images are not displayed")
+
+
 @screenshot_test
 def id_reclaiming(ctx: TestingContext):
     ikupterm = IkupTerminal(config="DEFAULT", force_upload=False)
@@ -0,0 +1,136 @@
+"""
+An on-disk cache of resized and re-encoded upload payloads.
+
+Images that are too large or are in formats unsupported by the terminal have to be
+resized and re-encoded before uploading. Images are reuploaded quite often (e.g. when
+the terminal is likely to have evicted them), so we keep the results in a directory
+and reuse them. Entries are keyed by the source file (path, mtime and size) and by
+everything that determines the result of re-encoding (the upload method, the size
+limit, the supported formats and the encoding), so an entry never has to be
+invalidated, it just becomes unused.
+
+The size of the cache is bounded by a byte budget. The mtime of an entry is bumped on
+each hit, and the least recently used entries are evicted when the budget is exceeded.
+Entries are sent to the terminal by path, and the terminal may read them a bit later,
+so entries used within the last `grace_period` seconds are never evicted (even by
+other processes), and the budget may be exceeded for a while.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+from typing import Iterable, Optional, Tuple
+
+# The time in seconds after the last use of an entry during which it's not evicted.
+EVICTION_GRACE_PERIOD = 60.0
+
+
+class TranscodeCache:
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        grace_period: float = EVICTION_GRACE_PERIOD,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.grace_period = grace_period
+
+    @staticmethod
+    def make_key(
+        path: str,
+        upload_method: str,
+        max_upload_size: int,
+        supported_formats: Iterable[str],
+        crop: Optional[Tuple[int, int, int, int]] = None,
+        encoding: Optional[str] = None,
+    ) -> Optional[str]:
+        """Returns the key of the payload for the image at `path` (or its `crop` box),
+        or None if the file can't be accessed. The target dimensions and format are
+        determined by the image, `max_upload_size` and `supported_formats`, so we don't
+        need to open the image to compute the key. `encoding` distinguishes payloads
+        that are not encoded as image files (e.g. raw pixels)."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key_data = "\0".join(
+            [
+                os.path.abspath(path),
+                str(stat.st_mtime_ns),
+                str(stat.st_size),
+                str(upload_method),
+                str(max_upload_size),
+                ",".join(sorted(f.lower() for f in supported_formats)),
+            ]
+            # Tiles of an image are cached separately.
+            + ([",".join(map(str, crop))] if crop is not None else [])
+            + ([f"encoding={encoding}"] if encoding is not None else [])
+        )
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the path to the cached payload or None if it's not cached."""
+        path = self.get_path(key)
+        try:
+            # Mark the entry as recently used.
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key: str, data: bytes) -> str:
+        """Stores the payload and returns the path to it. May evict other entries."""
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file first, so that concurrent readers never see a
+        # partially written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.get_path(key))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.evict(keep=key)
+        return self.get_path(key)
+
+    def evict(self, keep: Optional[str] = None):
+        """Removes the least recently used entries until the total size of the cache
+        is within the budget. The entry `keep` and the entries used within the grace
+        period are never removed."""
+        keep_after = time.time() - self.grace_period
+        entries = []
+        total_size = 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.startswith("."):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+            total_size += stat.st_size
+        entries.sort()
+        for mtime, name, size in entries:
+            if total_size <= self.max_bytes:
+                break
+            if name == keep or mtime > keep_after:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total_size -= size
+
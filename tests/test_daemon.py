@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import socket
+import time
+
+import pytest
+
+from ikup import daemon
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("IKUP_ID_DATABASE_DIR", str(tmp_path))
+    monkeypatch.delenv("IKUP_NO_DAEMON", raising=False)
+    return tmp_path
+
+
+def test_message_round_trip_with_fds():
+    left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    read_fd, write_fd = os.pipe()
+    with left, right:
+        message = {"command": "run", "argv": ["display", "x" * 100000]}
+        daemon._send_message(left, message, [write_fd])
+        os.close(write_fd)
+        received = daemon._recv_message(right)
+        assert received is not None
+        received_message, fds = received
+        assert received_message == message
+        assert len(fds) == 1
+        # The received descriptor refers to the same pipe.
+        os.write(fds[0], b"hello")
+        os.close(fds[0])
+        assert os.read(read_fd, 5) == b"hello"
+        os.close(read_fd)
+        # A closed connection is not a message.
+        left.close()
+        assert daemon._recv_message(right) is None
+
+
+def test_forward_without_daemon(state_dir):
+    socket_path = daemon.get_socket_path()
+    assert os.path.dirname(socket_path) == str(state_dir)
+    assert daemon.forward_to_daemon(["display", "image.png"]) is None
+    # A stale socket left by a dead daemon is the same as no daemon.
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    assert os.path.exists(socket_path)
+    assert daemon.forward_to_daemon(["display", "image.png"]) is None
+    assert daemon.send_control_command("ping") is None
+
+
+def test_should_forward(monkeypatch):
+    monkeypatch.delenv("IKUP_NO_DAEMON", raising=False)
+    assert daemon.should_forward(["ikup", "display", "image.png"])
+    assert not daemon.should_forward(["ikup", "daemon", "stop"])
+    monkeypatch.setenv("IKUP_NO_DAEMON", "1")
+    assert not daemon.should_forward(["ikup", "display", "image.png"])
+
+
+def test_serve_ping_and_stop(state_dir):
+    socket_path = daemon.get_socket_path()
+    process = multiprocessing.get_context("fork").Process(
+        target=daemon.serve, args=(socket_path,), kwargs={"idle_timeout": 60}
+    )
+    process.start()
+    try:
+        reply = None
+        deadline = time.time() + 30
+        while reply is None and time.time() < deadline:
+            reply = daemon.send_control_command("ping")
+            if reply is None:
+                time.sleep(0.05)
+        assert reply == {"pid": process.pid}
+        assert daemon.send_control_command("stop") == {"pid": process.pid}
+        process.join(10)
+        assert process.exitcode == 0
+        assert not os.path.exists(socket_path)
+    finally:
+        if process.is_alive():
+            process.kill()
+
+
+def test_start_in_background(state_dir):
+    socket_path = daemon.start_in_background(idle_timeout=60)
+    try:
+        # The daemon accepts connections as soon as it's started.
+        reply = daemon.send_control_command("ping")
+        assert reply is not None
+        assert daemon.start_in_background(idle_timeout=60) == socket_path
+        assert daemon.send_control_command("ping") == reply
+    finally:
+        daemon.send_control_command("stop")
+    deadline = time.time() + 10
+    while os.path.exists(socket_path) and time.time() < deadline:
+        time.sleep(0.05)
+    assert not os.path.exists(socket_path)
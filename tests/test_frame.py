@@ -0,0 +1,83 @@
+import io
+import os
+import random
+
+from ikup import Format, GraphicsTerminal, TransmissionMedium, TransmitCommand
+from ikup.graphics_terminal import MAX_FRAME_BUFFER_SIZE, Frame, FrameStream
+
+
+class WriteLog(io.BytesIO):
+    def __init__(self, name: str, log: list):
+        super().__init__()
+        self.name = name
+        self.log = log
+
+    def write(self, data) -> int:
+        self.log.append((self.name, bytes(data)))
+        return super().write(data)
+
+
+def test_frame_preserves_order_and_merges_writes():
+    log = []
+    command_out = WriteLog("command", log)
+    display_out = WriteLog("display", log)
+    frame = Frame()
+    command = FrameStream(frame, command_out)
+    display = FrameStream(frame, display_out)
+    command.write(b"a")
+    command.write(b"b")
+    command.flush()
+    display.write(b"c")
+    command.write(b"d")
+    # Nothing is written until the frame is written out.
+    assert log == []
+    assert frame.size == 4
+    frame.write_out()
+    assert log == [("command", b"ab"), ("display", b"c"), ("command", b"d")]
+    assert frame.size == 0
+    frame.write_out()
+    assert len(log) == 3
+
+
+def test_frame_stream_flush_writes_out_large_frames():
+    out = io.BytesIO()
+    frame = Frame(max_size=10)
+    stream = FrameStream(frame, out)
+    stream.write(b"x" * 9)
+    stream.flush()
+    assert out.getvalue() == b""
+    stream.write(b"y")
+    stream.flush()
+    assert out.getvalue() == b"x" * 9 + b"y"
+
+
+def test_bulk_transmission_bypasses_frame(tmp_path, monkeypatch):
+    """Within a frame, a large direct transmission is written straight to the file
+    descriptor with `writev`, after the data buffered before it."""
+    num_writes = 0
+    writev = os.writev
+
+    def counting_writev(fd, buffers):
+        nonlocal num_writes
+        num_writes += 1
+        return writev(fd, buffers)
+
+    monkeypatch.setattr(os, "writev", counting_writev)
+    data = random.Random(1).randbytes(MAX_FRAME_BUFFER_SIZE + 1)
+    cmd = TransmitCommand(
+        image_id=7, medium=TransmissionMedium.DIRECT, format=Format.PNG
+    ).set_data(data)
+    path = tmp_path / "out"
+    with open(path, "wb", buffering=0) as out, open(os.devnull, "rb") as devnull:
+        term = GraphicsTerminal(
+            out_command=out, out_display=out, in_response=devnull, in_userinput=devnull
+        )
+        expected = io.BytesIO()
+        cmd.send(expected, term.get_graphics_command_template())
+        with term.frame():
+            term.out_display.write(b"before")
+            term.send_command(cmd)
+            assert num_writes > 0
+            term.out_display.write(b"after")
+            assert path.read_bytes() == b"before" + expected.getvalue()
+    assert path.read_bytes() == b"before" + expected.getvalue() + b"after"
@@ -0,0 +1,136 @@
+import io
+import os
+import random
+import select
+
+import pytest
+
+from ikup.graphics_command import (
+    Format,
+    GraphicsCommand,
+    MoreDataCommand,
+    Quietness,
+    TransmissionMedium,
+    TransmitCommand,
+)
+
+TEMPLATES = [
+    GraphicsCommand.DEFAULT_TEMPLATE,
+    b"\033Ptmux;\033\033_G%b\033\033\\\033\\",
+]
+
+
+def reference_send(cmd: TransmitCommand, template: bytes, max_size: int) -> bytes:
+    """The straightforward implementation of `send` via `split`."""
+    max_base64_payload_size = max_size - len(template) - len(cmd.header_to_bytes()) - 4
+    max_payload_size = (max_base64_payload_size // 4) * 3
+    return b"".join(
+        template % c.content_to_bytes()
+        for c in cmd.split(max_payload_size=max_payload_size)
+    )
+
+
+class UnbufferedReader(io.RawIOBase):
+    """A reader returning at most 7 bytes per call, like a pipe would."""
+
+    def __init__(self, data: bytes):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos, whence=0):
+        return self.data.seek(pos, whence)
+
+    def readinto(self, buffer):
+        chunk = self.data.read(min(7, len(buffer)))
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, 100, 2997, 2998, 3000, 10000])
+@pytest.mark.parametrize("template", TEMPLATES)
+@pytest.mark.parametrize("more", [None, False, True])
+@pytest.mark.parametrize("source", ["bytes", "bytesio", "unbuffered"])
+def test_send_direct_matches_split(size, template, more, source):
+    data = random.Random(size).randbytes(size)
+    if source == "bytesio":
+        data_obj = io.BytesIO(data)
+    elif source == "unbuffered":
+        data_obj = UnbufferedReader(data)
+    else:
+        data_obj = data
+    cmd = TransmitCommand(
+        image_id=123456,
+        medium=TransmissionMedium.DIRECT,
+        quiet=Quietness.QUIET_ALWAYS,
+        format=Format.PNG,
+        pix_width=10,
+        pix_height=20,
+        more=more,
+    ).set_placement(virtual=True, rows=3, cols=4)
+    cmd.set_data(data_obj)
+    out = io.BytesIO()
+    sent = []
+    cmd.send(out, template, max_size=1024, callback=sent.append)
+    # Unlike `split`, `send` fills the chunks even if the reader returns less data
+    # than requested, so compare it to reading from a regular file.
+    expected = reference_send(
+        cmd.clone_with(data=io.BytesIO(data)), template, max_size=1024
+    )
+    assert out.getvalue() == expected
+    assert b"".join(template % c.content_to_bytes() for c in sent) == out.getvalue()
+    assert all(isinstance(c, MoreDataCommand) for c in sent[1:])
+
+
+def test_send_direct_to_file_descriptor(tmp_path):
+    data = random.Random(0).randbytes(100000)
+    cmd = TransmitCommand(
+        image_id=1, medium=TransmissionMedium.DIRECT, format=Format.PNG
+    ).set_data(data)
+    path = tmp_path / "out"
+    with open(path, "wb") as out:
+        out.write(b"before")
+        cmd.send(out, GraphicsCommand.DEFAULT_TEMPLATE)
+        out.write(b"after")
+    expected = reference_send(cmd, GraphicsCommand.DEFAULT_TEMPLATE, select.PIPE_BUF)
+    assert path.read_bytes() == b"before" + expected + b"after"
+
+
+@pytest.mark.parametrize("chunks_per_write", [1, 2, 5, "adaptive"])
+def test_send_direct_coalesced(chunks_per_write, tmp_path, monkeypatch):
+    num_writes = 0
+    writev = os.writev
+
+    def counting_writev(fd, buffers):
+        nonlocal num_writes
+        num_writes += 1
+        return writev(fd, buffers)
+
+    monkeypatch.setattr(os, "writev", counting_writev)
+    data = random.Random(1).randbytes(50000)
+    cmd = TransmitCommand(
+        image_id=7, medium=TransmissionMedium.DIRECT, format=Format.PNG
+    ).set_data(data)
+    template = GraphicsCommand.DEFAULT_TEMPLATE
+    sent = []
+    path = tmp_path / "out"
+    with open(path, "wb") as out:
+        cmd.send(
+            out,
+            template,
+            max_size=1024,
+            callback=sent.append,
+            chunks_per_write=chunks_per_write,
+        )
+    assert path.read_bytes() == reference_send(cmd, template, max_size=1024)
+    # The callback is still called for each chunk.
+    assert b"".join(template % c.content_to_bytes() for c in sent) == path.read_bytes()
+    if chunks_per_write == "adaptive":
+        # Writing to a file is fast, so the number of chunks per write grows.
+        assert num_writes < len(sent) // 4
+    else:
+        assert num_writes == -(-len(sent) // chunks_per_write)
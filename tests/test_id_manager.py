@@ -1,6 +1,11 @@
+import fcntl
+import json
+import os
 import random
+import threading
+import time
 from datetime import datetime, timedelta
-from itertools import islice
+from itertools import cycle, islice
 
 import pytest
 
@@ -435,3 +440,552 @@ def test_id_manager_uploads_example():
     assert idman.get_upload_info(id2, "term1") is None
     assert idman.get_upload_info(id2, "term1") is None
     assert idman.get_upload_info(id1, "term2") is None
+
+
+@pytest.mark.parametrize("id_space", IDSpace.all_values())
+@pytest.mark.parametrize("subspace", [IDSubspace(), IDSubspace(3, 50)])
+def test_id_manager_get_ids(id_space: IDSpace, subspace: IDSubspace):
+    """Test assigning IDs to a batch of descriptions."""
+    idman = IDManager(":memory:")
+    existing_id = idman.get_id("existing", id_space, subspace=subspace)
+    descriptions = ["a", "b", "existing", "a", "c"]
+    ids = idman.get_ids(descriptions, id_space, subspace=subspace)
+    assert len(ids) == len(descriptions)
+    for id, description in zip(ids, descriptions):
+        assert id_space.contains_and_in_subspace(id, subspace)
+        assert idman.get_info(id).description == description
+    assert ids[2] == existing_id
+    assert ids[0] == ids[3]
+    assert len(set(ids)) == 4
+    # The IDs must be the same as the ones returned by get_id.
+    for id, description in zip(ids, descriptions):
+        assert idman.get_id(description, id_space, subspace=subspace) == id
+
+
+@pytest.mark.parametrize("id_space", IDSpace.all_values())
+@pytest.mark.parametrize("subspace", [IDSubspace(), IDSubspace(10, 11)])
+def test_id_manager_get_ids_never_evicts_own_ids(
+    id_space: IDSpace, subspace: IDSubspace
+):
+    """A batch may evict old IDs, but never the ones it returns."""
+    idman = IDManager(":memory:", max_ids_per_subspace=300)
+    max_batch_size = idman.get_max_batch_size(id_space, subspace)
+    assert max_batch_size == min(id_space.subspace_size(subspace), 300)
+    with pytest.raises(ValueError):
+        idman.get_ids(
+            [f"image{i}" for i in range(max_batch_size + 1)],
+            id_space,
+            subspace=subspace,
+        )
+    # Fill the subspace (or the limit) with old IDs, then request a full batch which
+    # mixes existing descriptions with new ones.
+    old = [f"old{i}" for i in range(max_batch_size)]
+    idman.get_ids(old, id_space, subspace=subspace)
+    time.sleep(0.01)
+    half = max_batch_size // 2
+    descriptions = old[:half] + [f"new{i}" for i in range(max_batch_size - half)]
+    descriptions += descriptions[:3]
+    ids = idman.get_ids(descriptions, id_space, subspace=subspace)
+    assert len(set(ids)) == max_batch_size
+    for id, description in zip(ids, descriptions):
+        assert idman.get_info(id).description == description
+
+
+def test_id_manager_needs_uploading_many():
+    """Test that needs_uploading_many agrees with needs_uploading."""
+    idman = IDManager(":memory:")
+    terminals = ["term1", "term2"]
+    ids = idman.get_ids([str(i) for i in range(50)], IDSpace())
+    for id in ids:
+        for term in terminals:
+            if random.random() < 0.7:
+                idman.mark_uploaded_for_testing(
+                    id, term, size=random.randint(0, 1000)
+                )
+    for id in random.sample(ids, 5):
+        idman.set_id(id, "changed")
+    # Include an unassigned ID and a duplicate.
+    unassigned = next(i for i in IDSpace().all_ids() if i not in ids)
+    query = ids + [unassigned, ids[0]]
+    for term in terminals + ["term3"]:
+        for kwargs in [{}, {"max_uploads_ago": 10}, {"max_bytes_ago": 5000}]:
+            expected = [idman.needs_uploading(id, term, **kwargs) for id in query]
+            assert idman.needs_uploading_many(query, term, **kwargs) == expected
+            infos = idman._get_terminal_upload_infos(term, ids)
+            for id in ids:
+                assert infos.get(id) == idman.get_upload_info(id, term)
+
+
+def test_id_manager_atime_update_interval():
+    """Test that the atime of existing IDs is updated only if it's old enough."""
+    idman = IDManager(":memory:", atime_update_interval=timedelta(minutes=1))
+    id = idman.get_id("image", IDSpace())
+    old_atime = datetime.now() - timedelta(seconds=30)
+    idman.set_id(id, "image", atime=old_atime)
+    # The atime is recent enough, it must not be updated.
+    assert idman.get_id("image", IDSpace()) == id
+    assert idman.get_info(id).atime == old_atime
+    # Now it's too old.
+    old_atime = datetime.now() - timedelta(minutes=2)
+    idman.set_id(id, "image", atime=old_atime)
+    assert idman.get_ids(["image", "image"], IDSpace()) == [id, id]
+    assert abs(idman.get_info(id).atime - datetime.now()) < timedelta(seconds=1)
+    # update_atime=False must be respected.
+    idman.set_id(id, "image", atime=old_atime)
+    assert idman.get_id("image", IDSpace(), update_atime=False) == id
+    assert idman.get_info(id).atime == old_atime
+
+
+def test_id_manager_lookup_respects_subspace():
+    """The same description in a different subspace must get a different ID."""
+    idman = IDManager(":memory:")
+    id_space = IDSpace.from_string("24bit")
+    id1 = idman.get_id("image", id_space, subspace=IDSubspace(1, 10))
+    id2 = idman.get_id("image", id_space, subspace=IDSubspace(10, 20))
+    assert id_space.contains_and_in_subspace(id1, IDSubspace(1, 10))
+    assert id_space.contains_and_in_subspace(id2, IDSubspace(10, 20))
+    assert idman.get_id("image", id_space, subspace=IDSubspace(1, 20)) in [id1, id2]
+    assert idman.get_id("image", id_space, subspace=IDSubspace(1, 10)) == id1
+
+
+def test_id_manager_migrate_unversioned_database(tmp_path):
+    """Databases created before schema versioning must be upgraded in place."""
+    import sqlite3
+
+    db_file = str(tmp_path / "old.db")
+    conn = sqlite3.connect(db_file)
+    conn.execute(
+        """CREATE TABLE ids_24bit (
+            id INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            atime TIMESTAMP NOT NULL
+        )"""
+    )
+    conn.execute(
+        """CREATE TABLE upload (
+            id INTEGER NOT NULL,
+            description TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            terminal TEXT NOT NULL,
+            upload_time TIMESTAMP NOT NULL,
+            status TEXT NOT NULL,
+            upload_id INTEGER NOT NULL,
+            PRIMARY KEY (id, terminal)
+        )"""
+    )
+    old_id = (5 << 16) | 0x1234
+    atime = datetime.now().replace(microsecond=123456)
+    conn.execute(
+        "INSERT INTO ids_24bit VALUES (?, ?, ?)",
+        (old_id, "old", atime.isoformat()),
+    )
+    conn.execute(
+        "INSERT INTO upload VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (old_id, "old", 10, "term", atime.isoformat(), UPLOADING_STATUS_UPLOADED, 1),
+    )
+    conn.commit()
+    conn.close()
+
+    idman = IDManager(db_file)
+    id_space = IDSpace.from_string("24bit")
+    assert idman.conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    assert idman.get_info(old_id).description == "old"
+    assert idman.get_info(old_id).atime == atime
+    # The upload state is kept too, with integer timestamps.
+    info = idman.get_upload_info(old_id, "term")
+    assert info.status == UPLOADING_STATUS_UPLOADED
+    assert info.upload_time == atime
+    assert not idman.needs_uploading(old_id, "term")
+    assert idman.conn.execute("SELECT typeof(upload_time) FROM upload").fetchall() == [
+        ("integer",)
+    ]
+    assert idman.count(id_space, IDSubspace(5, 6)) == 1
+    assert idman.count(id_space, IDSubspace(6, 7)) == 0
+    assert idman.get_id("old", id_space, subspace=IDSubspace(5, 6)) == old_id
+    idman.close()
+    # Opening it again must not try to migrate it again.
+    idman = IDManager(db_file)
+    assert idman.get_info(old_id).description == "old"
+
+
+def test_id_manager_get_id_keep():
+    """The IDs in `keep` are not reassigned even if they are the least recently
+    used ones."""
+    idman = IDManager(":memory:")
+    id_space = IDSpace.from_string("8bit")
+    subspace = IDSubspace(10, 20)
+    ids = []
+    for i in range(10):
+        ids.append(idman.get_id(f"image{i}", id_space, subspace=subspace))
+        time.sleep(0.001)
+    new_id = idman.get_id("new", id_space, subspace=subspace, keep=set(ids[:9]))
+    assert new_id == ids[9]
+    assert idman.get_info(ids[0]).description == "image0"
+    # Without `keep`, the least recently used ID is reassigned.
+    assert idman.get_id("newer", id_space, subspace=subspace) == ids[0]
+
+
+def test_id_manager_free_list():
+    """Allocation in small subspaces must pick unused IDs first and reuse the ones
+    freed by deletion or cleanup."""
+    idman = IDManager(":memory:")
+    id_space = IDSpace.from_string("8bit")
+    subspace = IDSubspace(10, 20)
+    ids = [idman.get_id(f"image{i}", id_space, subspace=subspace) for i in range(10)]
+    assert sorted(ids) == list(id_space.all_ids(subspace))
+    # Deleted IDs become available again.
+    idman.del_id(ids[3])
+    assert idman.get_id("new", id_space, subspace=subspace) == ids[3]
+    # When the subspace is full, the least recently used ID is reassigned.
+    time.sleep(0.01)
+    for i in range(10):
+        if i not in (3, 5):
+            idman.get_id(f"image{i}", id_space, subspace=subspace)
+    idman.get_id("new", id_space, subspace=subspace)
+    assert idman.get_id("newer", id_space, subspace=subspace) == ids[5]
+    # IDs outside of the subspace are not touched.
+    other = idman.get_id("other", id_space, subspace=IDSubspace(20, 30))
+    assert id_space.contains_and_in_subspace(other, IDSubspace(20, 30))
+
+
+def test_id_manager_migrate_upload_counters(tmp_path):
+    """Upload counters must be computed for uploads recorded before they existed."""
+    import sqlite3
+
+    db_file = str(tmp_path / "old.db")
+    idman = IDManager(db_file)
+    idman.close()
+    conn = sqlite3.connect(db_file)
+    conn.execute("DROP TABLE upload_counter")
+    conn.execute("ALTER TABLE upload DROP COLUMN seq")
+    conn.execute("ALTER TABLE upload DROP COLUMN cum_bytes")
+    conn.execute("ALTER TABLE upload DROP COLUMN locked")
+    conn.execute("DROP INDEX idx_upload_chunked_in_progress")
+    conn.execute("ALTER TABLE upload DROP COLUMN chunked")
+    base_time = datetime.now() - timedelta(minutes=1)
+    for i, size in enumerate([100, 200, 300]):
+        for terminal in ["term1", "term2"]:
+            conn.execute(
+                """INSERT INTO upload
+                   (id, description, size, terminal, upload_time, status, upload_id)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    i + 1,
+                    str(i),
+                    size,
+                    terminal,
+                    (base_time + timedelta(seconds=i)).isoformat(),
+                    UPLOADING_STATUS_UPLOADED,
+                    1,
+                ),
+            )
+    # The version before the upload counters were added.
+    conn.execute("PRAGMA user_version = 3")
+    conn.commit()
+    conn.close()
+
+    idman = IDManager(db_file)
+    for terminal in ["term1", "term2"]:
+        info = idman.get_upload_info(1, terminal)
+        assert (info.uploads_ago, info.bytes_ago) == (3, 600)
+        info = idman.get_upload_info(3, terminal)
+        assert (info.uploads_ago, info.bytes_ago) == (1, 300)
+    # New uploads continue the sequence.
+    idman.set_id(4, "3")
+    idman.mark_uploaded_for_testing(4, "term1", size=50)
+    assert idman.get_upload_info(1, "term1").uploads_ago == 4
+    assert idman.get_upload_info(1, "term1").bytes_ago == 650
+    assert idman.get_upload_info(1, "term2").uploads_ago == 3
+    assert sorted(info.terminal for info in idman.get_upload_infos(1)) == [
+        "term1",
+        "term2",
+    ]
+
+
+def test_id_manager_migrate_iso_timestamps(tmp_path):
+    """ISO timestamps written by older versions must be converted to integers."""
+    import sqlite3
+
+    db_file = str(tmp_path / "old.db")
+    idman = IDManager(db_file)
+    idman.close()
+    atime = datetime(2024, 3, 31, 2, 30, 15, 123456)
+    conn = sqlite3.connect(db_file)
+    conn.execute("ALTER TABLE upload DROP COLUMN locked")
+    conn.execute("DROP INDEX idx_upload_chunked_in_progress")
+    conn.execute("ALTER TABLE upload DROP COLUMN chunked")
+    conn.execute(
+        "INSERT INTO ids_32bit (id, description, atime) VALUES (?, ?, ?)",
+        (0x01020304, "old", atime.isoformat()),
+    )
+    conn.execute(
+        """INSERT INTO upload
+           (id, description, size, terminal, upload_time, status, upload_id, seq,
+            cum_bytes)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (0x01020304, "old", 10, "term", atime.isoformat(), "uploaded", 1, 1, 10),
+    )
+    conn.execute("INSERT INTO upload_counter VALUES ('term', 1, 10)")
+    # The version before timestamps became integers.
+    conn.execute("PRAGMA user_version = 4")
+    conn.commit()
+    conn.close()
+
+    idman = IDManager(db_file)
+    assert idman.get_info(0x01020304).atime == atime
+    assert idman.get_upload_info(0x01020304, "term").upload_time == atime
+    assert idman.conn.execute("SELECT typeof(atime) FROM ids_32bit").fetchall() == [
+        ("integer",)
+    ]
+    # Ordering by atime still works for new rows.
+    idman.set_id(0x01020305, "new")
+    assert [info.id for info in idman.get_all()] == [0x01020305, 0x01020304]
+
+
+def test_id_manager_query():
+    """`query` must return the same results as filtering `get_all` in python."""
+    idman = IDManager(":memory:")
+    base_time = datetime(2025, 1, 1)
+    infos = []
+    for i, id_space in enumerate(islice(cycle(IDSpace.all_values()), 50)):
+        description = json.dumps({"path": f"/img{i % 20}.png", "cols": i})
+        if i % 7 == 0:
+            description = f"not json {i}"
+        id = idman.get_id(description, id_space)
+        idman.set_id(id, description, atime=base_time + timedelta(seconds=i))
+    all_infos = idman.get_all()
+    assert list(idman.query()) == all_infos
+    assert list(idman.query(last=5)) == all_infos[:5]
+    assert list(idman.query(except_last=45)) == all_infos[45:]
+    assert list(idman.query(last=10, except_last=3)) == all_infos[3:10]
+    older = base_time + timedelta(seconds=30)
+    newer = base_time + timedelta(seconds=10)
+    assert list(idman.query(older=older, newer=newer, last=5)) == [
+        info for info in all_infos if newer < info.atime < older
+    ][:5]
+    ids = [all_infos[3].id, all_infos[17].id, 12345]
+    paths = ["/img4.png", "/missing.png"]
+    expected = [
+        info
+        for info in all_infos
+        if info.id in ids or f'"path": "/img4.png"' in info.description
+    ]
+    assert len(expected) > 2
+    assert list(idman.query(ids=ids, paths=paths)) == expected
+    assert list(idman.query(ids=[], paths=[])) == []
+
+
+def test_id_manager_bulk_operations():
+    idman = IDManager(":memory:")
+    ids = [
+        idman.get_id(str(i), id_space)
+        for i, id_space in enumerate(islice(cycle(IDSpace.all_values()), 20))
+    ]
+    for id in ids:
+        idman.mark_uploaded_for_testing(id, "term1", size=10)
+        idman.mark_uploaded_for_testing(id, "term2", size=10)
+    # Touch some IDs.
+    atime = datetime.now() + timedelta(hours=1)
+    idman.touch_ids(ids[:5], atime)
+    assert [idman.get_info(id).atime for id in ids[:5]] == [atime] * 5
+    assert idman.get_info(ids[5]).atime < atime
+    idman.touch_id(ids[5], atime)
+    assert idman.get_info(ids[5]).atime == atime
+    # Mark some IDs dirty in one terminal and in all terminals.
+    idman.mark_dirty_many(ids[:3], "term1")
+    idman.mark_dirty_many(ids[3:6])
+    for i, id in enumerate(ids):
+        assert idman.needs_uploading(id, "term1") == (i < 6)
+        assert idman.needs_uploading(id, "term2") == (3 <= i < 6)
+    # Delete some IDs.
+    idman.del_ids(ids[10:] + [12345])
+    assert [idman.get_info(id) is not None for id in ids] == [True] * 10 + [False] * 10
+    assert idman.count() == 10
+
+
+def test_id_manager_connection_pool(tmp_path):
+    """IDManagers of the same database in the same thread share the connection."""
+    db_file = str(tmp_path / "pool.db")
+    idman1 = IDManager(db_file)
+    idman2 = IDManager(str(tmp_path / "." / "pool.db"))
+    assert idman1.conn is idman2.conn
+    id = idman1.get_id("image", IDSpace())
+    assert idman2.get_id("image", IDSpace()) == id
+    # Connections are not shared between threads.
+    other_conns = []
+    thread = threading.Thread(target=lambda: other_conns.append(IDManager(db_file)))
+    thread.start()
+    thread.join()
+    assert other_conns[0].conn is not idman1.conn
+    # In-memory databases are never shared.
+    assert IDManager(":memory:").conn is not IDManager(":memory:").conn
+    # The connection is closed only when the last user releases it.
+    idman1.close()
+    assert idman2.get_info(id) is not None
+    idman2.close()
+    idman3 = IDManager(db_file)
+    assert idman3.conn is not idman2.conn
+    assert idman3.get_info(id) is not None
+    idman3.close()
+
+
+def test_id_manager_wait_for_concurrent_upload(tmp_path):
+    """A process waiting for a concurrent upload must resume as soon as the upload
+    finishes, not after the stall timeout."""
+    db_file = str(tmp_path / "uploads.db")
+    uploader = IDManager(db_file)
+    id = uploader.get_id("image", IDSpace())
+    upload = uploader.start_upload(id, "term", description="image", size=10)
+    assert upload.status == UPLOADING_STATUS_IN_PROGRESS
+
+    results = []
+
+    def wait_for_upload():
+        waiter = IDManager(db_file)
+        start = time.monotonic()
+        info = waiter.start_upload(
+            id, "term", description="image", size=10, stall_timeout=10
+        )
+        results.append((info.status, time.monotonic() - start))
+
+    thread = threading.Thread(target=wait_for_upload)
+    thread.start()
+    time.sleep(0.2)
+    uploader.report_upload(upload, set_status=UPLOADING_STATUS_UPLOADED)
+    thread.join()
+    status, elapsed = results[0]
+    assert status == UPLOADING_STATUS_UPLOADED
+    assert elapsed < 5
+
+
+def test_id_manager_stalled_upload_without_lock(tmp_path):
+    """If the uploader dies (its lock is released without finishing the upload), the
+    upload is considered stalled right away, without waiting for the stall timeout."""
+    db_file = str(tmp_path / "uploads.db")
+    idman = IDManager(db_file)
+    id = idman.get_id("image", IDSpace())
+    upload = idman.start_upload(id, "term", description="image", size=10)
+    # Simulate the death of the uploader.
+    idman._release_upload_lock(id, "term")
+    start = time.monotonic()
+    info = idman.start_upload(
+        id, "term", description="image", size=10, stall_timeout=10
+    )
+    assert info.status == UPLOADING_STATUS_IN_PROGRESS
+    assert info.upload_id != upload.upload_id
+    assert time.monotonic() - start < 5
+
+
+def test_id_manager_upload_without_lock_is_not_taken_over(tmp_path):
+    """If the uploader couldn't take its lock because the lock file was busy, a free
+    lock doesn't mean that it's dead, so it must not be taken over before the stall
+    timeout."""
+    db_file = str(tmp_path / "uploads.db")
+    uploader = IDManager(db_file)
+    id = uploader.get_id("image", IDSpace())
+    # Hold the lock file of the upload, as if another upload hashed to it.
+    fd = uploader._open_upload_lock(id, "term")
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    upload = uploader.start_upload(id, "term", description="image", size=10)
+    os.close(fd)
+
+    results = []
+
+    def wait_for_upload():
+        waiter = IDManager(db_file)
+        info = waiter.start_upload(
+            id, "term", description="image", size=10, stall_timeout=1
+        )
+        results.append(info)
+
+    thread = threading.Thread(target=wait_for_upload)
+    thread.start()
+    time.sleep(0.2)
+    uploader.report_upload(upload, set_status=UPLOADING_STATUS_UPLOADED)
+    thread.join()
+    assert results[0].status == UPLOADING_STATUS_UPLOADED
+    assert results[0].upload_id == upload.upload_id
+
+
+def test_id_manager_only_chunked_uploads_block():
+    """Uploads that are not chunked must not block other IDs, but they must wait for
+    chunked uploads in progress."""
+    idman = IDManager(":memory:")
+    id1 = idman.get_id("1", IDSpace())
+    id2 = idman.get_id("2", IDSpace())
+    id3 = idman.get_id("3", IDSpace())
+    idman.start_upload(id1, "term", description="1", size=10, chunked=False)
+    # A chunked upload doesn't wait for a file upload.
+    start = time.monotonic()
+    upload2 = idman.start_upload(
+        id2, "term", description="2", size=10, stall_timeout=10
+    )
+    assert upload2.status == UPLOADING_STATUS_IN_PROGRESS
+    assert time.monotonic() - start < 5
+    # A file upload waits for the chunked upload (until it's considered stalled).
+    upload3 = idman.start_upload(
+        id3, "term", description="3", size=10, stall_timeout=0.2, chunked=False
+    )
+    assert upload3.status == UPLOADING_STATUS_IN_PROGRESS
+    assert time.monotonic() - start >= 0.2
+    assert idman.get_upload_info(id2, "term").status == UPLOADING_STATUS_DIRTY
+    # So does a chunked upload.
+    upload2 = idman.start_upload(
+        id2, "term", description="2", size=10, stall_timeout=10, force_upload=True
+    )
+    start = time.monotonic()
+    upload1 = idman.start_upload(
+        id1, "term", description="1", size=10, stall_timeout=0.2, force_upload=True
+    )
+    assert time.monotonic() - start >= 0.2
+    assert idman.get_upload_info(id2, "term").status == UPLOADING_STATUS_DIRTY
+
+
+def test_id_manager_terminal_properties(tmp_path):
+    db_file = str(tmp_path / "props.db")
+    idman = IDManager(db_file)
+    assert idman.get_terminal_property("term1", "shm") is None
+    idman.set_terminal_property("term1", "shm", "1")
+    idman.set_terminal_property("term2", "shm", "0")
+    idman.set_terminal_property("term1", "shm", "0")
+    idman.close()
+    # The properties are visible to other processes.
+    idman = IDManager(db_file)
+    assert idman.get_terminal_property("term1", "shm") == "0"
+    assert idman.get_terminal_property("term2", "shm") == "0"
+    assert idman.get_terminal_property("term1", "other") is None
+    idman.close()
+
+
+def test_id_manager_wait_for_chunked_uploads(tmp_path):
+    db_file = str(tmp_path / "uploads.db")
+    uploader = IDManager(db_file)
+    id1 = uploader.get_id("1", IDSpace())
+    id2 = uploader.get_id("2", IDSpace())
+    # Uploads that are not chunked don't make anyone wait.
+    uploader.start_upload(id1, "term", description="1", size=10, chunked=False)
+    start = time.monotonic()
+    uploader.wait_for_chunked_uploads("term", stall_timeout=10)
+    assert time.monotonic() - start < 5
+    # A chunked upload does, until it finishes.
+    upload = uploader.start_upload(id2, "term", description="2", size=10)
+    thread = threading.Thread(
+        target=lambda: IDManager(db_file).wait_for_chunked_uploads(
+            "term", stall_timeout=10
+        )
+    )
+    thread.start()
+    time.sleep(0.2)
+    assert thread.is_alive()
+    uploader.report_upload(upload, set_status=UPLOADING_STATUS_UPLOADED)
+    thread.join(5)
+    assert not thread.is_alive()
+    # A chunked upload whose uploader is dead is marked dirty.
+    upload = uploader.start_upload(
+        id2, "term", description="2", size=10, force_upload=True
+    )
+    uploader._release_upload_lock(id2, "term")
+    start = time.monotonic()
+    uploader.wait_for_chunked_uploads("term", stall_timeout=10)
+    assert time.monotonic() - start < 5
+    assert uploader.get_upload_info(id2, "term").status == UPLOADING_STATUS_DIRTY
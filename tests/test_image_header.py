@@ -0,0 +1,79 @@
+import io
+
+import pytest
+from PIL import Image
+
+from ikup.image_header import probe_image, probe_image_file
+
+SIZES = [(1, 1), (3, 7), (255, 256), (1000, 17), (16383, 2)]
+
+
+def save_to_bytes(image: Image.Image, format: str, **kwargs) -> bytes:
+    bytesio = io.BytesIO()
+    image.save(bytesio, format=format, **kwargs)
+    return bytesio.getvalue()
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize(
+    "mode,format,kwargs",
+    [
+        ("RGB", "PNG", {}),
+        ("RGBA", "PNG", {}),
+        ("L", "PNG", {}),
+        ("RGB", "JPEG", {}),
+        ("RGB", "JPEG", {"progressive": True}),
+        ("L", "JPEG", {}),
+        ("RGB", "JPEG", {"exif": b"Exif\x00\x00" + b"\x00" * 60000}),
+        ("P", "GIF", {}),
+        ("RGB", "BMP", {}),
+        ("1", "BMP", {}),
+        ("RGB", "WEBP", {}),
+        ("RGB", "WEBP", {"lossless": True}),
+        ("RGBA", "WEBP", {}),
+        ("RGBA", "WEBP", {"lossless": True}),
+    ],
+)
+def test_probe_image_matches_pil(size, mode, format, kwargs):
+    data = save_to_bytes(Image.new(mode, size), format, **kwargs)
+    header = probe_image_file(io.BytesIO(data))
+    pil_image = Image.open(io.BytesIO(data))
+    assert header is not None
+    assert header.format == pil_image.format
+    assert header.size == pil_image.size
+
+
+def test_probe_image_file_offset():
+    data = save_to_bytes(Image.new("RGB", (12, 34)), "JPEG")
+    f = io.BytesIO(b"garbage" + data)
+    f.seek(7)
+    header = probe_image_file(f)
+    assert header is not None
+    assert header.size == (12, 34)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"not an image",
+        b"\x89PNG\r\n\x1a\n",
+        b"\xff\xd8\xff\xe0\x00\x10JFIF",
+        b"RIFF\x00\x00\x00\x00WEBPVP8 ",
+        b"RIFF\x00\x00\x00\x00WEBPVP8L\x00\x00\x00\x00",
+        b"RIFF\x00\x00\x00\x00WEBPVP8X\x00\x00\x00\x00",
+        b"GIF89a",
+    ],
+)
+def test_probe_image_unknown_or_truncated(data):
+    assert probe_image_file(io.BytesIO(data)) is None
+
+
+def test_probe_image_path(tmp_path):
+    path = tmp_path / "image.gif"
+    Image.new("P", (5, 6)).save(path)
+    header = probe_image(str(path))
+    assert header is not None
+    assert (header.format, header.width, header.height) == ("GIF", 5, 6)
+    with pytest.raises(OSError):
+        probe_image(str(tmp_path / "missing.png"))
@@ -0,0 +1,267 @@
+import io
+import itertools
+from typing import List
+
+import pytest
+
+from ikup import ImagePlaceholder, ImagePlaceholderMode
+from ikup.placeholder import (
+    ROWCOLUMN_DIACRITICS_UTF8,
+    AdditionalFormatting,
+    CellFormatting,
+    DiacriticLevel,
+    RowFormatting,
+    lines_to_stream_at_cursor,
+    placeholders_side_by_side_to_lines,
+)
+
+
+def reference_to_lines(
+    placeholder: ImagePlaceholder,
+    mode: ImagePlaceholderMode,
+    formatting: AdditionalFormatting = None,
+    no_escape: bool = False,
+) -> List[bytes]:
+    """The straightforward cell-by-cell implementation of `to_lines`."""
+    placeholder_bytes = mode.placeholder_char.encode("utf-8")
+
+    # Custom formatting.
+    cell_formatting = None
+    row_formatting = None
+    if formatting is None:
+        pass
+    elif isinstance(formatting, bytes):
+        row_formatting = lambda row: formatting
+    elif isinstance(formatting, CellFormatting):
+        cell_formatting = formatting.func
+    elif isinstance(formatting, RowFormatting):
+        row_formatting = formatting.func
+    else:
+        raise TypeError(
+            "formatting must be None, a bytes, a CellFormatting or a"
+            f" RowFormatting: {formatting}"
+        )
+
+    line_id_colors = b""
+    # Encode first 24 bits of IDs in the fg and underline colors.
+    if not no_escape:
+        if mode.allow_256colors_for_image_id and (placeholder.image_id & 0xFFFF00 == 0):
+            line_id_colors += b"\033[38;5;%dm" % (placeholder.image_id & 0xFF)
+        else:
+            line_id_colors += b"\033[38;2;%d;%d;%dm" % (
+                (placeholder.image_id >> 16) & 0xFF,
+                (placeholder.image_id >> 8) & 0xFF,
+                placeholder.image_id & 0xFF,
+            )
+        if not (mode.skip_placement_id_if_zero and placeholder.placement_id == 0):
+            if mode.allow_256colors_for_placement_id and (
+                placeholder.placement_id & 0xFFFF00 == 0
+            ):
+                line_id_colors += b"\033[58;5;%dm" % (placeholder.placement_id & 0xFF)
+            else:
+                line_id_colors += b"\033[58;2;%d;%d;%dm" % (
+                    (placeholder.placement_id >> 16) & 0xFF,
+                    (placeholder.placement_id >> 8) & 0xFF,
+                    placeholder.placement_id & 0xFF,
+                )
+
+    # Figure out how many diacritics to print.
+    image_id_4thbyte = (placeholder.image_id & 0xFF000000) >> 24
+    image_id_4thbyte_diacritic = ROWCOLUMN_DIACRITICS_UTF8[image_id_4thbyte]
+    firstcol_diacritic_count = mode.first_column_diacritic_level.value
+    othercol_diacritic_count = mode.other_columns_diacritic_level.value
+    if placeholder.start_col != 0:
+        firstcol_diacritic_count = max(firstcol_diacritic_count, 2)
+    if image_id_4thbyte != 0:
+        firstcol_diacritic_count = 3
+        if (
+            mode.other_columns_diacritic_level
+            == DiacriticLevel.ROW_COLUMN_ID4THBYTE_IF_NONZERO
+        ):
+            othercol_diacritic_count = 3
+    else:
+        if (
+            mode.first_column_diacritic_level
+            == DiacriticLevel.ROW_COLUMN_ID4THBYTE_IF_NONZERO
+        ):
+            firstcol_diacritic_count = 2
+        if (
+            mode.other_columns_diacritic_level
+            == DiacriticLevel.ROW_COLUMN_ID4THBYTE_IF_NONZERO
+        ):
+            othercol_diacritic_count = 2
+
+    result = []
+    # Print the placeholder.
+    for row in range(placeholder.start_row, placeholder.end_row):
+        line = b""
+        # Reset formatting before and after each line. This prevents color bleeding
+        # when used with utilities like head or tail.
+        if not no_escape:
+            line += b"\033[0m"
+        # Start the line with the custom row formatting.
+        if row_formatting is not None:
+            line += row_formatting(row)
+        # If the row is over the limit, print spaces.
+        if row >= len(ROWCOLUMN_DIACRITICS_UTF8):
+            for col in range(placeholder.start_col, placeholder.end_col):
+                if cell_formatting is not None:
+                    line += cell_formatting(col, row)
+                line += b" "
+            result.append(line)
+            continue
+        # Insert fg and underline colors encoding IDs.
+        line += line_id_colors
+        # Custom cell formatting.
+        if cell_formatting is not None:
+            line += cell_formatting(placeholder.start_col, row)
+        # The row diacritic.
+        row_diacritic = ROWCOLUMN_DIACRITICS_UTF8[row]
+        # Print the placeholder and diacritics for the first column.
+        line += placeholder_bytes
+        if firstcol_diacritic_count >= 1:
+            line += row_diacritic
+            if firstcol_diacritic_count >= 2:
+                line += ROWCOLUMN_DIACRITICS_UTF8[placeholder.start_col]
+                if firstcol_diacritic_count >= 3:
+                    line += image_id_4thbyte_diacritic
+        # Print the placeholders with diacritics for other columns.
+        for col in range(placeholder.start_col + 1, placeholder.end_col):
+            if cell_formatting is not None:
+                line += cell_formatting(col, row)
+            line += placeholder_bytes
+            if othercol_diacritic_count >= 1:
+                line += row_diacritic
+                if othercol_diacritic_count >= 2 and col < len(
+                    ROWCOLUMN_DIACRITICS_UTF8
+                ):
+                    line += ROWCOLUMN_DIACRITICS_UTF8[col]
+                    if othercol_diacritic_count >= 3:
+                        line += image_id_4thbyte_diacritic
+        # Reset formatting.
+        if not no_escape:
+            line += b"\033[0m"
+        result.append(line)
+    return result
+
+
+MODES = [
+    ImagePlaceholderMode.default(),
+    ImagePlaceholderMode.complete(),
+    ImagePlaceholderMode.minimal(),
+    ImagePlaceholderMode.default().with_only24bitcolors(),
+    ImagePlaceholderMode(
+        first_column_diacritic_level=DiacriticLevel.ROW_COLUMN,
+        other_columns_diacritic_level=DiacriticLevel.ROW,
+        skip_placement_id_if_zero=False,
+        placeholder_char="X",
+    ),
+]
+
+FORMATTINGS = [
+    None,
+    b"\033[48;5;3m",
+    RowFormatting(lambda row: b"<%d>" % row),
+    CellFormatting(lambda col, row: b"<%d,%d>" % (col, row)),
+]
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("formatting", FORMATTINGS)
+@pytest.mark.parametrize("no_escape", [False, True])
+def test_to_lines_matches_reference(mode, formatting, no_escape):
+    image_ids = [1, 0xAB, 0xABCDEF, 0x12000034, 0xFFFFFFFF]
+    placement_ids = [0, 5, 0x123456]
+    geometries = [
+        (0, 0, 1, 1),
+        (0, 0, 7, 3),
+        (2, 1, 5, 4),
+        (290, 290, len(ROWCOLUMN_DIACRITICS_UTF8) + 3, 300),
+    ]
+    for image_id, placement_id, (start_col, start_row, end_col, end_row) in (
+        itertools.product(image_ids, placement_ids, geometries)
+    ):
+        placeholder = ImagePlaceholder(
+            image_id=image_id,
+            placement_id=placement_id,
+            start_col=start_col,
+            start_row=start_row,
+            end_col=end_col,
+            end_row=end_row,
+        )
+        expected = reference_to_lines(placeholder, mode, formatting, no_escape)
+        # The second call may be served from the cache.
+        for _ in range(2):
+            lines = placeholder.to_lines(mode, formatting, no_escape=no_escape)
+            assert lines == expected, placeholder
+        # The result may be modified by the caller without affecting the cache.
+        lines.append(b"garbage")
+        assert placeholder.to_lines(mode, formatting, no_escape=no_escape) == expected
+
+
+def test_placeholders_side_by_side():
+    left = ImagePlaceholder(image_id=1, end_col=3, end_row=2)
+    right = ImagePlaceholder(image_id=0x1020304, start_col=2, end_col=5, end_row=2)
+    mode = ImagePlaceholderMode.default()
+    lines = placeholders_side_by_side_to_lines([left, right], mode)
+    assert lines == [
+        a + b for a, b in zip(left.to_lines(mode), right.to_lines(mode))
+    ]
+    with pytest.raises(ValueError):
+        placeholders_side_by_side_to_lines(
+            [left, ImagePlaceholder(image_id=2, end_col=1, end_row=3)]
+        )
+
+
+@pytest.mark.parametrize(
+    "use_save_cursor,use_line_feeds,expected",
+    [
+        (True, False, b"\033[sab\033[u\033D\033[scd\033[u\033Def"),
+        (False, False, b"ab\033[2D\033Dcd\033[2D\033Def"),
+        (True, True, b"ab\ncd\nef"),
+    ],
+)
+def test_lines_to_stream_at_cursor(use_save_cursor, use_line_feeds, expected):
+    stream = io.BytesIO()
+    lines_to_stream_at_cursor(
+        stream,
+        [b"ab", b"cd", b"ef"],
+        2,
+        use_save_cursor=use_save_cursor,
+        use_line_feeds=use_line_feeds,
+    )
+    assert stream.getvalue() == expected
+
+
+class WriteCounter(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.num_writes = 0
+
+    def write(self, data) -> int:
+        self.num_writes += 1
+        return super().write(data)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"use_save_cursor": False},
+        {"use_line_feeds": True},
+        {"pos": (3, 4)},
+    ],
+)
+def test_to_stream_single_write(kwargs):
+    placeholder = ImagePlaceholder(image_id=42, end_col=5, end_row=4)
+    stream = WriteCounter()
+    placeholder.to_stream(stream, **kwargs)
+    assert stream.num_writes == 1
+    assert stream.getvalue() == placeholder.to_bytes(**kwargs)
+    lines = placeholder.to_lines()
+    if "pos" in kwargs:
+        assert stream.getvalue() == b"".join(
+            b"\033[%d;4H" % (5 + i) + line for i, line in enumerate(lines)
+        )
+    else:
+        assert stream.getvalue().endswith(lines[-1])
@@ -0,0 +1,229 @@
+import os
+import zlib
+
+import pytest
+from PIL import Image
+
+from ikup import Compression, Format, TransmissionMedium
+from ikup.ikup_terminal import (
+    SHARED_MEMORY_DIR,
+    choose_raw_encoding,
+    create_shared_memory,
+    discard_upload_data,
+    link_shared_memory,
+    prepare_upload,
+    prepare_upload_without_decoding,
+    unlink_shared_memory,
+)
+from ikup.transcode_cache import TranscodeCache
+
+requires_shm = pytest.mark.skipif(
+    not os.path.isdir(SHARED_MEMORY_DIR), reason="no POSIX shared memory"
+)
+
+
+def read_shared_memory(name: str) -> bytes:
+    with open(os.path.join(SHARED_MEMORY_DIR, name.lstrip("/")), "rb") as f:
+        return f.read()
+
+
+@requires_shm
+@pytest.mark.parametrize(
+    "mode,format",
+    [
+        ("RGB", Format.RGB),
+        ("L", Format.RGB),
+        ("RGBA", Format.RGBA),
+        ("LA", Format.RGBA),
+    ],
+)
+def test_prepare_shared_memory_upload(tmp_path, mode, format):
+    path = tmp_path / "image.png"
+    Image.new(mode, (7, 5)).save(path)
+    prepared = prepare_upload(
+        str(path), TransmissionMedium.SHARED_MEMORY, 10**6, ["png"]
+    )
+    try:
+        assert prepared.medium == TransmissionMedium.SHARED_MEMORY
+        assert prepared.format == format
+        assert (prepared.pix_width, prepared.pix_height) == (7, 5)
+        data = read_shared_memory(prepared.data)
+        assert len(data) == prepared.size == 7 * 5 * format.value // 8
+    finally:
+        unlink_shared_memory(prepared.data)
+    assert not os.path.exists(os.path.join(SHARED_MEMORY_DIR, prepared.data[1:]))
+    # Unlinking twice is fine, the terminal may have done it already.
+    unlink_shared_memory(prepared.data)
+
+
+@requires_shm
+def test_prepare_shared_memory_upload_resized():
+    image = Image.new("RGB", (100, 100), (1, 2, 3))
+    prepared = prepare_upload(image, TransmissionMedium.SHARED_MEMORY, 3000, [])
+    try:
+        assert prepared.format == Format.RGB
+        assert prepared.size <= 3000
+        assert prepared.size == prepared.pix_width * prepared.pix_height * 3
+        data = read_shared_memory(prepared.data)
+        assert data[:6] == bytes([1, 2, 3, 1, 2, 3])
+    finally:
+        unlink_shared_memory(prepared.data)
+
+
+@pytest.mark.parametrize("encoding", ["png", "raw", "zlib"])
+@pytest.mark.parametrize(
+    "upload_method", [TransmissionMedium.DIRECT, TransmissionMedium.FILE]
+)
+def test_prepare_upload_encoding(upload_method, encoding):
+    image = Image.new("RGBA", (40, 30), (1, 2, 3, 4))
+    prepared = prepare_upload(
+        image, upload_method, 10**6, ["png"], encoding=encoding, zlib_level=9
+    )
+    if isinstance(prepared.data, str):
+        assert prepared.medium == TransmissionMedium.TEMP_FILE
+        with open(prepared.data, "rb") as f:
+            data = f.read()
+        os.remove(prepared.data)
+    else:
+        assert prepared.medium == TransmissionMedium.DIRECT
+        data = prepared.data
+    assert len(data) == prepared.size
+    if encoding == "png":
+        assert prepared.format == Format.PNG
+        assert prepared.compression is None
+        assert data.startswith(b"\x89PNG")
+        return
+    assert prepared.format == Format.RGBA
+    assert (prepared.pix_width, prepared.pix_height) == (40, 30)
+    if encoding == "zlib":
+        assert prepared.compression == Compression.ZLIB
+        data = zlib.decompress(data)
+    else:
+        assert prepared.compression is None
+    assert data == bytes([1, 2, 3, 4]) * 40 * 30
+
+
+def test_choose_raw_encoding():
+    compressible = bytes([1, 2, 3, 4]) * 100000
+    incompressible = os.urandom(400000)
+    # Over a slow link compression pays off unless the data is incompressible.
+    assert choose_raw_encoding(compressible, 1, 10**3) == "zlib"
+    assert choose_raw_encoding(incompressible, 1, 10**3) == "raw"
+    # Nothing is faster than sending data over an infinitely fast link.
+    assert choose_raw_encoding(compressible, 1, 10**30) == "raw"
+
+
+@pytest.mark.parametrize("link_throughput", [10**3, 10**30])
+def test_prepare_upload_auto_encoding(link_throughput):
+    image = Image.new("RGB", (400, 300), (1, 2, 3))
+    prepared = prepare_upload(
+        image,
+        TransmissionMedium.DIRECT,
+        10**6,
+        ["png"],
+        encoding="auto",
+        zlib_level=1,
+        link_throughput=link_throughput,
+    )
+    assert prepared.format == Format.RGB
+    if link_throughput < 10**6:
+        assert prepared.compression == Compression.ZLIB
+        assert zlib.decompress(prepared.data) == bytes([1, 2, 3]) * 400 * 300
+    else:
+        assert prepared.compression is None
+        assert prepared.data == bytes([1, 2, 3]) * 400 * 300
+
+
+def test_prepare_upload_without_decoding(tmp_path):
+    path = str(tmp_path / "image.png")
+    Image.new("RGB", (40, 30)).save(path)
+    size = os.path.getsize(path)
+    prepared = prepare_upload_without_decoding(
+        path, TransmissionMedium.FILE, 10**6, ["png"]
+    )
+    assert prepared is not None
+    assert (prepared.data, prepared.size) == (path, size)
+    # Unsupported formats, crops and too large files need decoding.
+    for args in [
+        (TransmissionMedium.FILE, 10**6, ["jpeg"]),
+        (TransmissionMedium.FILE, size - 1, ["png"]),
+        (TransmissionMedium.SHARED_MEMORY, 10**6, ["png"]),
+    ]:
+        assert prepare_upload_without_decoding(path, *args) is None
+    assert (
+        prepare_upload_without_decoding(
+            path, TransmissionMedium.FILE, 10**6, ["png"], crop=(0, 0, 5, 5)
+        )
+        is None
+    )
+    # Cache hits don't need decoding either.
+    cache = TranscodeCache(str(tmp_path / "cache"), 10**6)
+    assert (
+        prepare_upload_without_decoding(
+            path, TransmissionMedium.DIRECT, 10**6, ["jpeg"], cache
+        )
+        is None
+    )
+    prepared = prepare_upload(path, TransmissionMedium.DIRECT, 10**6, ["jpeg"], cache)
+    cached = prepare_upload_without_decoding(
+        path, TransmissionMedium.DIRECT, 10**6, ["jpeg"], cache
+    )
+    assert cached is not None
+    assert cached.size == prepared.size
+    assert (cached.pix_width, cached.pix_height) == (40, 30)
+
+
+def test_prepare_upload_auto_encoding_cache(tmp_path, monkeypatch):
+    """Raw pixel payloads of direct uploads are cached with their dimensions and
+    format, and the encoding chosen for them is reused."""
+    path = str(tmp_path / "image.png")
+    Image.new("RGBA", (40, 30), (1, 2, 3, 4)).save(path)
+    cache = TranscodeCache(str(tmp_path / "cache"), 10**6)
+    args = (path, TransmissionMedium.DIRECT, 10**6, ["jpeg"], cache)
+    kwargs = dict(encoding="auto", zlib_level=1)
+    assert prepare_upload_without_decoding(*args, **kwargs) is None
+    prepared = prepare_upload(*args, **kwargs, link_throughput=10**3)
+    assert prepared.compression == Compression.ZLIB
+    # Cache hits don't decode the image nor choose the encoding again.
+    monkeypatch.setattr(Image, "open", None)
+    for cached in [
+        prepare_upload_without_decoding(*args, **kwargs),
+        prepare_upload(*args, **kwargs, link_throughput=10**30),
+    ]:
+        assert cached is not None
+        assert cached.data == prepared.data
+        assert cached.medium == TransmissionMedium.DIRECT
+        assert (cached.pix_width, cached.pix_height) == (40, 30)
+        assert cached.format == Format.RGBA
+        assert cached.compression == Compression.ZLIB
+    # Other encodings have their own entries.
+    assert prepare_upload_without_decoding(*args, encoding="raw") is None
+    assert prepare_upload_without_decoding(*args) is None
+
+
+def test_discard_upload_data(tmp_path):
+    image = Image.new("RGB", (40, 30))
+    prepared = prepare_upload(image, TransmissionMedium.FILE, 10**6, ["png"])
+    assert prepared.medium == TransmissionMedium.TEMP_FILE
+    assert os.path.exists(prepared.data)
+    discard_upload_data(prepared.data, prepared.medium)
+    assert not os.path.exists(prepared.data)
+    # Files that are not temporary are never removed.
+    path = tmp_path / "image.png"
+    image.save(path)
+    discard_upload_data(str(path), TransmissionMedium.FILE)
+    assert path.exists()
+
+
+@requires_shm
+def test_link_shared_memory():
+    name = create_shared_memory(b"data")
+    try:
+        link = link_shared_memory(name)
+        assert link != name
+        assert read_shared_memory(link) == b"data"
+        # The terminal unlinks the name it receives, the original stays.
+        unlink_shared_memory(link)
+        assert read_shared_memory(name) == b"data"
+    finally:
+        unlink_shared_memory(name)
@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+
+import pytest
+
+from ikup.graphics_terminal import RESPONSE_READ_SIZE, ResponseReader
+
+
+@pytest.fixture
+def pipe():
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd, "rb", buffering=0) as r, os.fdopen(
+        write_fd, "wb", buffering=0
+    ) as w:
+        yield ResponseReader(r), w
+
+
+def test_read_queued_graphics_responses(pipe):
+    reader, w = pipe
+    w.write(b"junk\033_Gi=1;OK\033\\\033_Gi=2;ENOENT:no\033\\tail")
+    assert reader.read_graphics_response(1) == (b"junk", b"i=1;OK")
+    assert reader.read_graphics_response(1) == (b"", b"i=2;ENOENT:no")
+    assert reader.read_graphics_response(0) == (b"tail", None)
+    assert reader.read_graphics_response(0) == (b"", None)
+
+
+def test_read_many_graphics_responses(pipe):
+    reader, w = pipe
+    count = 3 * RESPONSE_READ_SIZE // 10
+
+    def write():
+        for i in range(count):
+            w.write(b"\033_Gi=%d;OK\033\\" % i)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    for i in range(count):
+        assert reader.read_graphics_response(5) == (b"", b"i=%d;OK" % i)
+    thread.join()
+    assert reader.get_buffered() == b""
+
+
+@pytest.mark.parametrize("split", range(1, 14))
+def test_read_split_graphics_response(pipe, split):
+    reader, w = pipe
+    data = b"x\033_Gi=1;OK\033\\"
+    w.write(data[:split])
+    if split < len(data) - 1:
+        # The beginning of the response is kept until the rest of it arrives.
+        non_response, response = reader.read_graphics_response(0)
+        assert response is None
+        assert non_response == data[: min(split, 1)]
+    w.write(data[split:])
+    non_response, response = reader.read_graphics_response(1)
+    assert response == b"i=1;OK"
+
+
+def test_read_graphics_response_timeout(pipe):
+    reader, w = pipe
+    start = time.time()
+    assert reader.read_graphics_response(0.1) == (b"", None)
+    assert time.time() - start >= 0.1
+
+
+def test_read_cursor_position_response(pipe):
+    reader, w = pipe
+    w.write(b"\033_Gi=1;OK\033\\\033[A\033[12;3")
+    assert reader.read_cursor_position_response(0) is None
+    w.write(b"4Rkey")
+    assert reader.read_cursor_position_response(1) == (12, 34)
+    # The bytes around the cursor position response are kept.
+    assert reader.read_graphics_response(1) == (b"", b"i=1;OK")
+    assert reader.read_buffered() == b"\033[Akey"
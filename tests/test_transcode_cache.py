@@ -0,0 +1,68 @@
+import os
+import time
+
+from ikup.transcode_cache import TranscodeCache
+
+
+def test_transcode_cache_key(tmp_path):
+    image = tmp_path / "image.png"
+    image.write_bytes(b"data")
+    key = TranscodeCache.make_key(str(image), "f", 100, ["png"])
+    assert key is not None
+    assert key == TranscodeCache.make_key(str(image), "f", 100, ["PNG"])
+    assert key != TranscodeCache.make_key(str(image), "d", 100, ["png"])
+    assert key != TranscodeCache.make_key(str(image), "f", 200, ["png"])
+    assert key != TranscodeCache.make_key(str(image), "f", 100, ["png", "jpeg"])
+    crop_key = TranscodeCache.make_key(str(image), "f", 100, ["png"], (0, 0, 5, 5))
+    assert crop_key not in (key, None)
+    assert crop_key != TranscodeCache.make_key(
+        str(image), "f", 100, ["png"], (0, 5, 5, 10)
+    )
+    raw_key = TranscodeCache.make_key(str(image), "d", 100, ["png"], encoding="raw")
+    assert raw_key not in (key, None)
+    assert raw_key != TranscodeCache.make_key(
+        str(image), "d", 100, ["png"], encoding="zlib:6"
+    )
+    # Modifying the file changes the key.
+    image.write_bytes(b"other data")
+    assert key != TranscodeCache.make_key(str(image), "f", 100, ["png"])
+    assert TranscodeCache.make_key(str(tmp_path / "missing.png"), "f", 100, []) is None
+
+
+def test_transcode_cache_lru_eviction(tmp_path):
+    cache = TranscodeCache(str(tmp_path / "cache"), max_bytes=300, grace_period=0)
+    assert cache.get("a") is None
+    path_a = cache.put("a", b"a" * 100)
+    assert cache.get("a") == path_a
+    with open(path_a, "rb") as f:
+        assert f.read() == b"a" * 100
+    cache.put("b", b"b" * 100)
+    cache.put("c", b"c" * 100)
+    # Make `a` the least recently used entry, then use it.
+    for i, key in enumerate(["a", "b", "c"]):
+        os.utime(cache.get_path(key), (time.time() - 100 + i, time.time() - 100 + i))
+    assert cache.get("a") is not None
+    # Adding one more entry evicts `b`, the least recently used one.
+    cache.put("d", b"d" * 100)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.get("d") is not None
+    # An entry larger than the budget is kept until the next insertion.
+    cache.put("e", b"e" * 1000)
+    assert cache.get("e") is not None
+    assert sorted(os.listdir(cache.directory)) == ["e"]
+
+
+def test_transcode_cache_eviction_grace_period(tmp_path):
+    cache = TranscodeCache(str(tmp_path / "cache"), max_bytes=150, grace_period=10)
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    # `a` may still be read by the terminal, so it's kept over the budget.
+    assert cache.get("a") is not None
+    # Once the grace period is over, the least recently used entry is evicted.
+    os.utime(cache.get_path("a"), (time.time() - 20, time.time() - 20))
+    cache.put("c", b"c" * 100)
+    assert not os.path.exists(cache.get_path("a"))
+    assert cache.get("b") is not None
+    assert cache.get("c") is not None
@@ -0,0 +1,117 @@
+import os
+
+import pytest
+from PIL import Image
+
+import ikup.graphics_terminal
+from ikup.id_manager import UPLOADING_STATUS_DIRTY, UPLOADING_STATUS_UPLOADED
+from ikup.ikup_terminal import (
+    SHARED_MEMORY_DIR,
+    SHARED_MEMORY_PROPERTY,
+    IkupTerminal,
+)
+
+SYNC_ID = 12345
+
+requires_shm = pytest.mark.skipif(
+    not os.path.isdir(SHARED_MEMORY_DIR), reason="no POSIX shared memory"
+)
+
+
+@pytest.fixture
+def term(tmp_path, monkeypatch):
+    """An IkupTerminal reading responses from a pty, and the master side of it."""
+    master, slave = os.openpty()
+    # The user input is read from the default tty, make it the pty too.
+    monkeypatch.setattr(
+        ikup.graphics_terminal, "DEFAULT_TTY_FILENAME", os.ttyname(slave)
+    )
+    with os.fdopen(master, "wb", buffering=0) as responses, os.fdopen(
+        slave, "rb", buffering=0
+    ) as in_response:
+        term = IkupTerminal(
+            out_command=str(tmp_path / "out"),
+            out_display=str(tmp_path / "out"),
+            in_response=in_response,
+            id_database=str(tmp_path / "ids.db"),
+            config="DEFAULT",
+            terminal_name="xterm-kitty",
+            terminal_id="test-terminal",
+            session_id="test-session",
+            allow_concurrent_uploads=False,
+        )
+        monkeypatch.setattr(term, "_gen_query_id", lambda: SYNC_ID)
+        yield term, responses
+        term.id_manager.close()
+
+
+def upload_images(term, tmp_path, count):
+    insts = []
+    for i in range(count):
+        path = str(tmp_path / f"image{i}.png")
+        Image.new("RGB", (4, 4), (i, 0, 0)).save(path)
+        insts.append(term.upload(path, check_response=True, upload_method="file"))
+    return insts
+
+
+def upload_status(term, inst):
+    return term.id_manager.get_upload_info(inst.id, "test-terminal").status
+
+
+def test_upload_error_marks_only_its_id_dirty(term, tmp_path):
+    term, responses = term
+    insts = upload_images(term, tmp_path, 3)
+    responses.write(
+        b"\033_Gi=%d;ENOENT:bad file\033\\\033_Gi=%d;OK\033\\" % (insts[1].id, SYNC_ID)
+    )
+    failed = term.wait_for_upload_responses(timeout=5)
+    assert [f.inst.id for f in failed] == [insts[1].id]
+    assert failed[0].message.startswith("ENOENT")
+    assert upload_status(term, insts[0]) == UPLOADING_STATUS_UPLOADED
+    assert upload_status(term, insts[1]) == UPLOADING_STATUS_DIRTY
+    assert upload_status(term, insts[2]) == UPLOADING_STATUS_UPLOADED
+    assert term.wait_for_upload_responses(timeout=0) == []
+
+
+def test_upload_errors_are_drained_within_frame(term, tmp_path):
+    term, responses = term
+    with term.term.frame():
+        first = upload_images(term, tmp_path, 1)[0]
+        responses.write(b"\033_Gi=%d;EINVAL:bad data\033\\" % first.id)
+        # The error is picked up after the next upload without waiting for a sync.
+        upload_images(term, tmp_path, 1)
+        assert upload_status(term, first) == UPLOADING_STATUS_DIRTY
+
+
+def test_upload_timeout_marks_remaining_ids_dirty(term, tmp_path):
+    term, responses = term
+    insts = upload_images(term, tmp_path, 3)
+    responses.write(b"\033_Gi=%d;ENOENT:bad file\033\\" % insts[0].id)
+    # No response to the sync query.
+    failed = term.wait_for_upload_responses(timeout=0.2)
+    assert sorted(f.inst.id for f in failed) == sorted(inst.id for inst in insts)
+    assert [f.response is None for f in failed].count(True) == 2
+    for inst in insts:
+        assert upload_status(term, inst) == UPLOADING_STATUS_DIRTY
+
+
+@requires_shm
+@pytest.mark.parametrize(
+    "reply,supported,stored",
+    [
+        (b"\033_Gi=%d;OK\033\\" % SYNC_ID, True, "1"),
+        (b"\033_Gi=%d;EBADF:no shm\033\\" % SYNC_ID, False, "0"),
+        # A timeout is not stored, the next process will probe again.
+        (b"", False, None),
+    ],
+)
+def test_supports_shared_memory(term, reply, supported, stored):
+    term, responses = term
+    term.inside_ssh = False
+    term.check_response_timeout = 0.2
+    responses.write(reply)
+    assert term.supports_shared_memory() == supported
+    assert (
+        term.id_manager.get_terminal_property("test-terminal", SHARED_MEMORY_PROPERTY)
+        == stored
+    )